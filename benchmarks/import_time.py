@@ -0,0 +1,80 @@
+"""Import and startup cost of fastapi_sqlalchemy, to keep cold starts (CLIs, serverless) fast.
+
+    python benchmarks/import_time.py [--runs 5] [--max-import-ms 600]
+
+Reports the best of ``--runs`` fresh interpreters for ``import fastapi_sqlalchemy`` and for
+creating an instance and declaring a model, which must not connect or build engines. Exits
+non-zero if the import is slower than ``--max-import-ms`` or pulls in a module that should
+only be imported on use.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only needed by async instances, the middleware and ORMResponse.
+LAZY_MODULES = ("sqlalchemy.ext.asyncio", "greenlet", "starlette", "fastapi")
+
+STARTUP = """
+import sys, time
+start = time.perf_counter()
+from sqlalchemy import Column, Integer
+from fastapi_sqlalchemy import SQLAlchemy
+db = SQLAlchemy("sqlite://")
+class Item(db.Base):
+    __tablename__ = "items"
+    id = Column(Integer, primary_key=True)
+print((time.perf_counter() - start) * 1000)
+print(",".join(name for name in {lazy!r} if name in sys.modules))
+print(db._engine is None)
+"""
+
+
+def import_ms() -> float:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import fastapi_sqlalchemy"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in reversed(result.stderr.splitlines()):
+        if line.rstrip().endswith("| fastapi_sqlalchemy"):
+            return int(line.split("|")[1]) / 1000
+    raise RuntimeError("fastapi_sqlalchemy missing from -X importtime output")
+
+
+def startup() -> tuple:
+    result = subprocess.run(
+        [sys.executable, "-c", STARTUP.format(lazy=LAZY_MODULES)],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    elapsed, imported, lazy_engine = result.stdout.splitlines()
+    return float(elapsed), [name for name in imported.split(",") if name], lazy_engine == "True"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, default=600)
+    args = parser.parse_args()
+    imports = [import_ms() for _ in range(args.runs)]
+    startups = [startup() for _ in range(args.runs)]
+    imported = sorted({name for _, names, _ in startups for name in names})
+    lazy_engine = all(lazy for _, _, lazy in startups)
+    print(f"import fastapi_sqlalchemy  {min(imports):8.1f} ms")
+    print(f"instance + model           {min(elapsed for elapsed, _, _ in startups):8.1f} ms")
+    print(f"eagerly imported           {', '.join(imported) or '-'}")
+    print(f"engine created lazily      {lazy_engine}")
+    failed = min(imports) > args.max_import_ms or imported or not lazy_engine
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Write and read throughput of a file SQLite database with and without ``sqlite_profile``.
+
+    python benchmarks/sqlite_profile.py [--threads 8] [--ops 2000]
+
+Every write is its own committed transaction, as with ``Model.new()`` in a request handler;
+reads fetch one row by primary key.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import Column, Integer, String
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi_sqlalchemy import SQLAlchemy  # noqa: E402
+
+
+def run(path: str, profile: bool, threads: int, ops: int) -> dict:
+    db = SQLAlchemy(
+        f"sqlite:///{path}",
+        sqlite_profile=profile,
+        engine_args={"pool_size": threads, "connect_args": {"timeout": 30}},
+    )
+
+    class Item(db.Base):
+        __tablename__ = "items"
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+
+    db.create_all()
+
+    def write(i: int) -> None:
+        with db():
+            Item.new(name=str(i))
+
+    def read(i: int) -> None:
+        with db():
+            Item.get(id=i % ops + 1)
+
+    results = {}
+    with ThreadPoolExecutor(threads) as pool:
+        for name, func in (("write", write), ("read", read)):
+            start = time.perf_counter()
+            list(pool.map(func, range(ops)))
+            results[name] = ops / (time.perf_counter() - start)
+    db.engine.dispose()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=2000)
+    args = parser.parse_args()
+    print(f"{'profile':<8} {'writes/s':>10} {'reads/s':>10}")
+    for profile in (False, True):
+        with tempfile.TemporaryDirectory() as directory:
+            results = run(os.path.join(directory, "bench.db"), profile, args.threads, args.ops)
+        print(f"{'on' if profile else 'off':<8} {results['write']:>10.0f} {results['read']:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
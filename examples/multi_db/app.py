@@ -66,9 +66,8 @@ def update_user(user_data: UserUpdate):
     Returns:
         dict: A message indicating the success of the operation.
     """
-    user = User.get(id=user_data.id)
-    user.update(**user_data.dict())
-    user.save()
+    # a single UPDATE statement, no need to load the user first
+    User.update_where(User.id == user_data.id, **user_data.dict(exclude={"id"}, exclude_none=True))
     return {"message": "User updated successfully"}
 
 
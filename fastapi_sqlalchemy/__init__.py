@@ -1,7 +1,51 @@
+from typing import TYPE_CHECKING, Any
+
 from .extensions import SQLAlchemy, db
-from .middleware import DBSessionMiddleware
-from .types import ModelBase
+from .types import AsyncModelBase, ModelBase, SyncModelBase
+
+if TYPE_CHECKING:
+    from .decorators import long_lived, no_db
+    from .middleware import DBSessionMiddleware
+    from .responses import ORMResponse
+    from .sharding import ShardedSQLAlchemy
+    from .tenancy import TenantSQLAlchemy
 
-__all__ = ["db", "DBSessionMiddleware", "SQLAlchemy"]
+__all__ = [
+    "db",
+    "DBSessionMiddleware",
+    "SQLAlchemy",
+    "ModelBase",
+    "SyncModelBase",
+    "AsyncModelBase",
+    "ORMResponse",
+    "ShardedSQLAlchemy",
+    "TenantSQLAlchemy",
+    "no_db",
+    "long_lived",
+]
 
 __version__ = "0.5.3"
+
+# Imported on first access, so that `import fastapi_sqlalchemy` does not pull in starlette.
+_lazy = {
+    "DBSessionMiddleware": ".middleware",
+    "ORMResponse": ".responses",
+    "ShardedSQLAlchemy": ".sharding",
+    "TenantSQLAlchemy": ".tenancy",
+    "no_db": ".decorators",
+    "long_lived": ".decorators",
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _lazy:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+
+    value = getattr(importlib.import_module(_lazy[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
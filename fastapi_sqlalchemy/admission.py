@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import Counter, deque
+from typing import TYPE_CHECKING, Any, Deque, Dict, Iterable, Optional
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+if TYPE_CHECKING:
+    from .extensions import SQLAlchemy
+
+
+def pool_capacity(engines: Iterable[Engine]) -> Optional[int]:
+    """Number of connections every one of the pools can hand out at once, None if unbounded."""
+    capacities = []
+    for engine in engines:
+        pool = engine.pool
+        if not isinstance(pool, QueuePool) or pool._max_overflow < 0:
+            continue
+        capacities.append(pool.size() + pool._max_overflow)
+    return min(capacities) if capacities else None
+
+
+class AdmissionController:
+    """Bounds the number of requests holding sessions of one SQLAlchemy instance.
+
+    Requests beyond ``limit`` wait in a FIFO queue of at most ``max_queue_depth`` entries for up
+    to ``max_wait`` seconds; anything else is rejected straight away so that callers can shed
+    load instead of piling up on the pool's checkout timeout. ``limit`` defaults to the pool
+    capacity (``pool_size + max_overflow``), the smallest one for sharded instances and
+    ``max_connections`` for tenant instances.
+    """
+
+    def __init__(
+        self,
+        db: SQLAlchemy,
+        limit: Optional[int] = None,
+        max_queue_depth: int = 100,
+        max_wait: float = 1.0,
+    ):
+        self.db = db
+        self._limit = limit
+        self.max_queue_depth = max_queue_depth
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.max_queue_depth_seen = 0
+        self.wait_time = 0.0
+        self.stats: Counter = Counter()
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def limit(self) -> Optional[int]:
+        if self._limit is None:
+            self._limit = self.db._admission_capacity()
+        return self._limit
+
+    def resize(self, limit: Optional[int] = None) -> None:
+        """Change the limit, re-reading the pool capacity when ``limit`` is None."""
+        self._limit = limit
+        while self._waiters and (self.limit is None or self.in_flight < self.limit):
+            if self._wake_next():
+                self.in_flight += 1
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> bool:
+        limit = self.limit
+        if limit is None or (self.in_flight < limit and not self._waiters):
+            self.in_flight += 1
+            self.stats["admitted"] += 1
+            return True
+        if len(self._waiters) >= self.max_queue_depth:
+            self.stats["rejected_queue_full"] += 1
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.stats["queued"] += 1
+        self.max_queue_depth_seen = max(self.max_queue_depth_seen, len(self._waiters))
+        start = time.perf_counter()
+        try:
+            await asyncio.wait({waiter}, timeout=self.max_wait)
+        except asyncio.CancelledError:
+            # The client went away or the server is shutting down while queued: give back
+            # the slot if release() handed it over in the meantime.
+            if self._withdraw(waiter):
+                self.release()
+            self.stats["cancelled"] += 1
+            raise
+        finally:
+            self.wait_time += time.perf_counter() - start
+        if self._withdraw(waiter):
+            # release() handed its slot over, in_flight already accounts for us.
+            self.stats["admitted"] += 1
+            return True
+        self.stats["rejected_timeout"] += 1
+        return False
+
+    def _withdraw(self, waiter: asyncio.Future) -> bool:
+        """Take ``waiter`` out of the queue; True if it had been handed a slot already."""
+        if waiter.done() and not waiter.cancelled():
+            return True
+        waiter.cancel()
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+        return False
+
+    def release(self) -> None:
+        if not self._wake_next():
+            self.in_flight -= 1
+
+    def _wake_next(self) -> bool:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return True
+        return False
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth_seen": self.max_queue_depth_seen,
+            "wait_time": self.wait_time,
+            **self.stats,
+        }
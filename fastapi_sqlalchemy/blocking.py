@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from contextvars import ContextVar, Token
+from typing import Any, Dict, List, Literal, Optional, Tuple
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .exceptions import BlockingCallError
+
+logger = logging.getLogger("fastapi_sqlalchemy.blocking")
+
+START_KEY = "_fastapi_sqlalchemy_blocking_start"
+
+# Frames from these directories are skipped when looking for the call site.
+_LIBRARY_DIRS = (
+    os.path.dirname(os.path.abspath(__file__)),
+    os.path.dirname(os.path.abspath(sqlalchemy.__file__)),
+)
+
+Event = Tuple["BlockingDetector", str, str, float]
+
+_request_events: ContextVar[Optional[List[Event]]] = ContextVar("_request_events", default=None)
+
+
+def start_request() -> Token:
+    return _request_events.set([])
+
+
+def finish_request(token: Token, route: str) -> None:
+    """Attribute the blocking calls of the request to ``route``."""
+    events = _request_events.get()
+    _request_events.reset(token)
+    for detector, site, _, duration in events or ():
+        detector.record_route(route, site, duration)
+
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def call_site() -> str:
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        # "<sqlalchemy generated ...>" wrappers have no real file.
+        if not filename.startswith("<") and not os.path.abspath(filename).startswith(_LIBRARY_DIRS):
+            return f"{frame.f_code.co_filename}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "<unknown>"
+
+
+def statement_shape(statement: str, limit: int = 200) -> str:
+    shape = " ".join(statement.split())
+    return shape if len(shape) <= limit else shape[: limit - 3] + "..."
+
+
+class BlockingDetector:
+    """Finds sync statements executed on a thread that runs an event loop.
+
+    Such statements block every other request served by the loop, typically when an ``async
+    def`` route uses a sync SQLAlchemy instance. A ``sample_rate`` share of the statements run
+    on a loop thread is timed; those taking ``threshold_ms`` or more are recorded by call site
+    and statement, and then logged (``mode="log"``) or raised as BlockingCallError
+    (``mode="raise"``, once the statement has run; only while serving a request, so that
+    startup code is logged instead). DBSessionMiddleware also totals them per route in
+    ``routes``.
+    """
+
+    def __init__(
+        self,
+        threshold_ms: float = 0,
+        mode: Literal["log", "raise"] = "log",
+        sample_rate: float = 1.0,
+    ):
+        if mode not in ("log", "raise"):
+            raise ValueError(f"Unknown mode {mode!r}, expected 'log' or 'raise'.")
+        self.threshold = threshold_ms / 1000
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.offenders: Dict[Tuple[str, str], Dict[str, float]] = defaultdict(
+            lambda: {"count": 0, "total": 0.0, "max": 0.0}
+        )
+        self.routes: Dict[str, Dict[str, Dict[str, float]]] = defaultdict(
+            lambda: defaultdict(lambda: {"count": 0, "total": 0.0})
+        )
+
+    def install(self, engine: Engine) -> None:
+        if event.contains(engine, "before_cursor_execute", self._before_cursor_execute):
+            return
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not _in_event_loop():
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        setattr(context, START_KEY, time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, START_KEY, None)
+        if start is None:
+            return
+        duration = time.perf_counter() - start
+        if duration < self.threshold:
+            return
+        site = call_site()
+        shape = statement_shape(statement)
+        in_request = self.record(site, shape, duration)
+        if self.mode == "raise" and in_request:
+            raise BlockingCallError(site, duration, shape)
+        logger.warning(
+            "Sync database call blocked the event loop for %.1fms at %s: %s",
+            duration * 1000,
+            site,
+            shape,
+        )
+
+    def record(self, site: str, shape: str, duration: float) -> bool:
+        """Record a blocking call, returning whether it happened while serving a request."""
+        offender = self.offenders[(site, shape)]
+        offender["count"] += 1
+        offender["total"] += duration
+        offender["max"] = max(offender["max"], duration)
+        events = _request_events.get()
+        if events is None:
+            return False
+        events.append((self, site, shape, duration))
+        return True
+
+    def record_route(self, route: str, site: str, duration: float) -> None:
+        entry = self.routes[route][site]
+        entry["count"] += 1
+        entry["total"] += duration
+
+    def summary(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """The worst offenders, by total blocked time."""
+        ranked = sorted(self.offenders.items(), key=lambda item: item[1]["total"], reverse=True)
+        return [
+            {"site": site, "statement": shape, **offender}
+            for (site, shape), offender in ranked[:limit]
+        ]
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import asyncio
+import sqlite3
+import time
+from contextvars import ContextVar, Token
+from typing import AsyncIterator, Callable, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .exceptions import DeadlineExceeded
+
+_deadline: ContextVar[Optional[float]] = ContextVar("_deadline", default=None)
+
+TIMEOUT_KEY = "fastapi_sqlalchemy.statement_timeout"
+
+# Errors the databases raise when one of the timeouts below fires.
+_PG_QUERY_CANCELED = "57014"
+_MYSQL_MAX_EXECUTION_TIME_EXCEEDED = 3024
+
+
+def set_deadline(seconds: float) -> Token:
+    """Give the current context ``seconds`` to finish, keeping any earlier existing deadline."""
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        deadline = min(deadline, current)
+    return _deadline.set(deadline)
+
+
+def reset_deadline(token: Token) -> None:
+    _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the current deadline, None when there is none."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def deadline(seconds: float) -> Callable[[], AsyncIterator[None]]:
+    """Route dependency setting a deadline, e.g. ``Depends(deadline(2.0))``.
+
+    It only bounds the statements of the route: DBSessionMiddleware reads the deadline before
+    dependencies run, so it cancels the endpoint and answers 504 at ``request_timeout`` only.
+    """
+
+    async def dependency() -> AsyncIterator[None]:
+        token = set_deadline(seconds)
+        try:
+            yield
+        finally:
+            reset_deadline(token)
+
+    return dependency
+
+
+def _apply_postgresql(conn, cursor, context, deadline: Optional[float], left: float) -> None:
+    # SET LOCAL only lasts until the end of the transaction, see _forget_timeout.
+    if deadline is None or conn.info.get(TIMEOUT_KEY) == deadline:
+        return
+    cursor.execute(f"SET LOCAL statement_timeout = {max(1, int(left * 1000))}")
+    conn.info[TIMEOUT_KEY] = deadline
+
+
+def _apply_mysql(conn, cursor, context, deadline: Optional[float], left: float) -> None:
+    # max_execution_time is a session variable and outlives the checkout, so reset it.
+    current = conn.info.get(TIMEOUT_KEY)
+    if deadline is None:
+        if current is not None:
+            cursor.execute("SET SESSION max_execution_time = 0")
+            del conn.info[TIMEOUT_KEY]
+        return
+    if current != deadline:
+        cursor.execute(f"SET SESSION max_execution_time = {max(1, int(left * 1000))}")
+        conn.info[TIMEOUT_KEY] = deadline
+
+
+def _apply_sqlite(conn, cursor, context, deadline: Optional[float], left: float) -> None:
+    driver_connection = conn.connection.driver_connection
+    if not isinstance(driver_connection, sqlite3.Connection):
+        # aiosqlite runs statements on its own thread; its interrupt() does not queue behind
+        # the running statement.
+        interrupt = getattr(driver_connection, "interrupt", None)
+        if deadline is not None and interrupt is not None:
+            loop = asyncio.get_running_loop()
+            handle = loop.call_later(left, lambda: loop.create_task(interrupt()))
+            context._fastapi_sqlalchemy_interrupt = handle
+        return
+    current = conn.info.get(TIMEOUT_KEY)
+    if current == deadline:
+        return
+    if deadline is None:
+        driver_connection.set_progress_handler(None, 0)
+        del conn.info[TIMEOUT_KEY]
+        return
+    monotonic = time.monotonic
+    driver_connection.set_progress_handler(lambda: monotonic() > deadline, 1000)
+    conn.info[TIMEOUT_KEY] = deadline
+
+
+def _cancel_interrupt(context) -> None:
+    handle = getattr(context, "_fastapi_sqlalchemy_interrupt", None)
+    if handle is not None:
+        handle.cancel()
+
+
+_APPLY = {
+    "postgresql": _apply_postgresql,
+    "mysql": _apply_mysql,
+    "mariadb": _apply_mysql,
+    "sqlite": _apply_sqlite,
+}
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    deadline = _deadline.get()
+    if deadline is None:
+        if TIMEOUT_KEY not in conn.info:
+            return
+        left = 0.0
+    else:
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise DeadlineExceeded()
+    apply = _APPLY.get(conn.dialect.name)
+    if apply is not None:
+        apply(conn, cursor, context, deadline, left)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    _cancel_interrupt(context)
+
+
+def _forget_timeout(conn) -> None:
+    if conn.dialect.name == "postgresql":
+        conn.info.pop(TIMEOUT_KEY, None)
+
+
+def _is_timeout(exc: BaseException) -> bool:
+    if getattr(exc, "pgcode", None) == _PG_QUERY_CANCELED:
+        return True
+    if getattr(exc, "sqlstate", None) == _PG_QUERY_CANCELED:
+        return True
+    args = getattr(exc, "args", ())
+    if args and args[0] == _MYSQL_MAX_EXECUTION_TIME_EXCEEDED:
+        return True
+    return "interrupted" in str(exc)
+
+
+def _handle_error(context) -> None:
+    if context.execution_context is not None:
+        _cancel_interrupt(context.execution_context)
+    left = remaining()
+    if left is not None and left <= 0 and _is_timeout(context.original_exception):
+        raise DeadlineExceeded() from context.original_exception
+
+
+def install(engine: Engine) -> None:
+    """Turn the current deadline into a statement timeout for every statement on ``engine``."""
+    if event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "commit", _forget_timeout)
+    event.listen(engine, "rollback", _forget_timeout)
+    event.listen(engine, "handle_error", _handle_error)
@@ -1,33 +1,23 @@
-import ast
-import asyncio
-import inspect
-from functools import wraps
-from typing import Any, Awaitable, Callable, Self
+from typing import Any, Callable, TypeVar
 
-from curio.meta import from_coroutine
+NO_DB_ATTR = "__fastapi_sqlalchemy_no_db__"
+LONG_LIVED_ATTR = "__fastapi_sqlalchemy_long_lived__"
 
+F = TypeVar("F", bound=Callable[..., Any])
 
-def awaitable(asyncfunc):
-    def coroutine(syncfunc):
-        @wraps(syncfunc)
-        def wrapper(cls, *args, **kwargs):
-            is_awaited = False
-            for code in inspect.getframeinfo(inspect.currentframe().f_back).code_context:
-                try:
-                    ast_tree = ast.parse(code.strip())
-                    for node in ast.walk(ast_tree):
-                        if isinstance(node, ast.Await):
-                            is_awaited = True
-                except:
-                    pass
-            if from_coroutine():
-                if is_awaited:
-                    return asyncfunc(cls, *args, **kwargs)
-                else:
-                    return syncfunc(cls, *args, **kwargs)
-            else:
-                return syncfunc(cls, *args, **kwargs)
 
-        return wrapper
+def no_db(endpoint: F) -> F:
+    """Mark a route as not using the database, DBSessionMiddleware then skips it entirely."""
+    setattr(endpoint, NO_DB_ATTR, True)
+    return endpoint
 
-    return coroutine
+
+def long_lived(endpoint: F) -> F:
+    """Mark a streaming route (server-sent events, long polling) that outlives its queries.
+
+    DBSessionMiddleware opens no request session, and applies no admission control or
+    deadline, for it. Wrap each operation in ``db.unit()`` instead, so that the connection
+    goes back to the pool in between and idle clients hold none.
+    """
+    setattr(endpoint, LONG_LIVED_ATTR, True)
+    return endpoint
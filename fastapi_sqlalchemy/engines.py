@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import threading
+from typing import Any, Callable, Dict, Hashable, List, Tuple, Union
+
+from sqlalchemy.engine.url import URL, make_url
+
+from .sqlite import is_memory, is_sqlite
+
+# Engine or AsyncEngine
+AnyEngine = Any
+
+_lock = threading.Lock()
+_engines: Dict[Hashable, List[Any]] = {}  # key: [engine, refcount]
+_keys: Dict[int, Hashable] = {}
+
+
+def _freeze(value: Any) -> Hashable:
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(_freeze(item) for item in value)
+    try:
+        hash(value)
+    except TypeError:
+        return ("id", id(value))
+    return value
+
+
+def normalise_url(url: Union[URL, str]) -> Tuple[Any, ...]:
+    """The parts of ``url`` that identify a database, with the default driver spelled out."""
+    url = make_url(url)
+    return (
+        url.get_backend_name(),
+        url.get_driver_name(),
+        url.username,
+        url.password,
+        url.host,
+        url.port,
+        url.database,
+        _freeze(dict(url.query)),
+    )
+
+
+def shareable(url: Union[URL, str]) -> bool:
+    # Every in-memory SQLite engine is its own database, sharing it would merge them.
+    return not (is_sqlite(url) and is_memory(url))
+
+
+def registry_key(url: Union[URL, str], engine_args: Dict[str, Any], *extra: Any) -> Hashable:
+    return (normalise_url(url), _freeze(engine_args), _freeze(extra))
+
+
+def acquire(key: Hashable, factory: Callable[[], AnyEngine]) -> AnyEngine:
+    """Return the engine registered under ``key``, creating it with ``factory`` if needed."""
+    with _lock:
+        entry = _engines.get(key)
+        if entry is None:
+            entry = _engines[key] = [factory(), 0]
+            _keys[id(entry[0])] = key
+        entry[1] += 1
+        return entry[0]
+
+
+def release(engine: AnyEngine) -> bool:
+    """Drop one reference to ``engine``; True once nobody uses it and it should be disposed.
+
+    Engines that were not created through the registry are always reported as unused.
+    """
+    with _lock:
+        key = _keys.get(id(engine))
+        if key is None:
+            return True
+        entry = _engines[key]
+        entry[1] -= 1
+        if entry[1] > 0:
+            return False
+        del _engines[key]
+        del _keys[id(engine)]
+        return True
+
+
+def refcount(engine: AnyEngine) -> int:
+    with _lock:
+        key = _keys.get(id(engine))
+        return _engines[key][1] if key is not None else 0
+
+
+class Generation:
+    """The engines built from one configuration of an instance, see SQLAlchemy.reconfigure.
+
+    Counts the sessions opened on them; once replaced, they are disposed after the last one
+    closes.
+    """
+
+    def __init__(self, engines: List[AnyEngine]):
+        self.engines = engines
+        self.sessions = 0
+        self.retired = False
+
+    @property
+    def drained(self) -> bool:
+        return self.retired and self.sessions == 0
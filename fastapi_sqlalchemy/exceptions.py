@@ -1,5 +1,7 @@
 from typing import List
 
+from sqlalchemy.orm.exc import StaleDataError  # noqa: F401, raised by __versioned__ models
+
 
 class MissingSessionError(Exception):
     """Excetion raised for when the user tries to access a database session before it is created."""
@@ -106,3 +108,52 @@ class TooManyBuiltinOverrides(AttributeError):
         msg = f"""Too many builtin overrides! Strict maximum of 1 builtin override per model."""
 
         super().__init__(msg)
+
+
+class ShardKeyMissing(ValueError):
+    """Exception raised when a sharded model is written without a value for its shard key."""
+
+    def __init__(self, model: str, key: str):
+        msg = f"""
+        Cannot choose a shard for {model}! Set the shard key attribute '{key}' before saving.
+        """
+
+        super().__init__(msg)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Exception raised when a statement is run, or interrupted, after the request deadline."""
+
+    def __init__(self):
+        msg = """
+        Request deadline exceeded! The database statement was not run or was interrupted.
+        """
+
+        super().__init__(msg)
+
+
+class BlockingCallError(RuntimeError):
+    """Exception raised when a sync statement blocks a running event loop for too long."""
+
+    def __init__(self, site: str, duration: float, statement: str):
+        msg = f"""
+        Sync database call blocked the event loop for {duration * 1000:.1f}ms at {site}!
+        Use an async SQLAlchemy instance or a sync endpoint. Statement: {statement}
+        """
+
+        super().__init__(msg)
+
+
+class UnknownTenant(LookupError):
+    """Exception raised when a request has no tenant, or one without a database."""
+
+    def __init__(self, tenant: object = None):
+        if tenant is None:
+            msg = """
+            No tenant bound! Use TenantSQLAlchemy inside DBSessionMiddleware, whose resolver
+            finds the tenant of each request, or bind one with `with db.tenant(tenant_id):`.
+            """
+        else:
+            msg = f"""Unknown tenant {tenant!r}! The tenant has no database URL."""
+
+        super().__init__(msg)
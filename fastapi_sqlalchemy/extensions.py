@@ -1,123 +1,321 @@
 from __future__ import annotations
 
-import ast
 import asyncio
 import gc
-import inspect
+import importlib.util
+import sys
+import threading
 import warnings
+from collections import Counter
+from contextlib import asynccontextmanager, nullcontext
 from contextvars import ContextVar, Token
 from functools import wraps
-from typing import Any, Dict, List, Literal, Optional, Type, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    ContextManager,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Set,
+    Type,
+    Union,
+)
 
-from curio.meta import from_coroutine
-from sqlalchemy import create_engine
+from sqlalchemy import Column, Integer, create_engine, event
 from sqlalchemy.engine import Engine
 from sqlalchemy.engine.url import URL
 from sqlalchemy.orm import DeclarativeMeta as DeclarativeMeta_
 from sqlalchemy.orm import Query, Session, declarative_base, sessionmaker
 from sqlalchemy.types import BigInteger
 
+from . import admission, deadlines, engines, forking, sqlite
+from .admission import AdmissionController
+from .blocking import BlockingDetector
 from .exceptions import SessionNotAsync, SessionNotInitialisedError, SQLAlchemyAsyncioMissing
-from .types import ModelBase
-
-try:
-    import sqlalchemy.ext.asyncio
-
-    sqlalchemy_asyncio = True
-except ImportError:
-    sqlalchemy_asyncio = False
-try:
-    from sqlalchemy.ext.asyncio import (
-        AsyncEngine,
-        AsyncSession,
-        async_sessionmaker,
-        create_async_engine,
-    )
-except ImportError:
-    create_async_engine = None
-
-_session: ContextVar[Dict[str, Dict[SQLAlchemy, Session | AsyncSession]]] = ContextVar(
-    "_session", default={"sync": {}, "async": {}}
+from .prefetch import AdaptivePrefetch
+from .retry import RetryingTransaction, is_retryable
+from .tracing import OpenTelemetryTracer, Tracing, default_tracer
+from .types import AsyncModelBase, ModelBase, SyncModelBase
+from .writebehind import OverflowPolicy, WriteBehind
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+
+def _asyncio_ext():
+    """Import sqlalchemy.ext.asyncio (and greenlet) only once an async instance needs it."""
+    try:
+        import sqlalchemy.ext.asyncio as asyncio_ext
+    except ImportError:
+        raise SQLAlchemyAsyncioMissing() from None
+    return asyncio_ext
+
+
+_session: ContextVar[Optional[Dict[str, Dict[SQLAlchemy, Session | AsyncSession]]]] = ContextVar(
+    "_session", default=None
+)
+
+MEMO_KEY = "fastapi_sqlalchemy.memo"
+RECONFIGURABLE = (
+    "url",
+    "async_url",
+    "custom_engine",
+    "async_custom_engine",
+    "engine_args",
+    "async_engine_args",
 )
 
 
+def _check_reconfigurable(options: Dict[str, Any], allowed: Iterable[str]) -> None:
+    unknown = set(options) - set(allowed)
+    if unknown:
+        raise TypeError(f"reconfigure() got an unexpected option {sorted(unknown)[0]!r}.")
+
+
 def start_session() -> Token[Dict[str, Session | AsyncSession]]:
-    return _session.set({"sync": {}, "async": {}})
+    return _session.set({"sync": {}, "async": {}, "memo": {}})
 
 
 def reset_session(token: Token[Dict[str, Session | AsyncSession]]) -> None:
     _session.reset(token)
 
 
+def _sessions() -> Dict[str, Dict[SQLAlchemy, Session | AsyncSession]]:
+    # Created per context rather than as the ContextVar default, which every thread would share.
+    sessions = _session.get()
+    if sessions is None:
+        sessions = {"sync": {}, "async": {}, "memo": {}}
+        _session.set(sessions)
+    return sessions
+
+
+def _clear_memo(session: Session, *args) -> None:
+    memo = session.info.get(MEMO_KEY)
+    if memo:
+        memo.clear()
+
+
+class MemoSession(Session):
+    """Session whose ``get``/``get_all`` memo is dropped on every flush, rollback and bulk write."""
+
+
+def _clear_memo_on_write(orm_execute_state) -> None:
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        _clear_memo(orm_execute_state.session)
+
+
+event.listen(MemoSession, "after_flush", _clear_memo)
+event.listen(MemoSession, "after_soft_rollback", _clear_memo)
+event.listen(MemoSession, "do_orm_execute", _clear_memo_on_write)
+
+
+def _memo_session_args(session_args: Dict[str, Any], key: str) -> Dict[str, Any]:
+    """Return a copy of ``session_args`` whose ``key`` session class is a MemoSession.
+
+    The memo is only invalidated by the listeners on MemoSession, so a custom session class has
+    to derive from it.
+    """
+    session_args = dict(session_args)
+    class_ = session_args.setdefault(key, MemoSession)
+    if not (isinstance(class_, type) and issubclass(class_, MemoSession)):
+        raise ValueError(
+            f"memoize=True needs {key} to be a subclass of MemoSession, got {class_!r}."
+        )
+    return session_args
+
+
 class DBSession:
     def __init__(self, db: SQLAlchemy):
         self.db = db
         self.child_session_sync = False
         self.child_session_async = False
+        self._trace = None
+        self._generation = None
 
     def __enter__(self):
+        # Counted before the sessionmaker is read, so that reconfigure() cannot dispose the
+        # engine it is bound to.
+        self._generation = self.db._enter_generation()
         if not isinstance(self.db.sync_session_maker, sessionmaker):
+            self._leave_generation()
             raise SessionNotInitialisedError
-        session = self.db.sync_session_maker(**self.db.sync_session_args)
-        session_dict = _session.get()
+        session = self.db.sync_session_maker()
+        session_dict = _sessions()
         if not session_dict["sync"].get(self.db):
             session_dict["sync"][self.db] = session
+            if self.db.memoize:
+                self._start_memo(session_dict, session, session)
+            if self.db.tracing is not None:
+                self._trace = self.db.tracing.start_session(self.db, session)
             _session.set(session_dict)
         else:
             self.child_session_sync = True
         return self.db
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        if exc_type is not None:
-            self.db.sync_session.rollback()
+    def _start_memo(self, session_dict, session, sync_session: Session) -> None:
+        memo = {}
+        sync_session.info[MEMO_KEY] = memo
+        session_dict.setdefault("memo", {})[session] = memo
 
-        elif self.db.commit_on_exit:
-            try:
-                self.db.sync_session.commit()
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is not None:
                 self.db.sync_session.rollback()
-            except:
-                pass
+            elif self.db.commit_on_exit:
+                try:
+                    self.db.sync_session.commit()
+                except Exception:
+                    # Never lose a failed commit silently, see SQLAlchemy.retrying_transaction.
+                    self.db.sync_session.rollback()
+                    raise
+        finally:
+            self._close_sync()
+            self._end_trace(exc_value)
+            self._leave_generation()
+
+    def _close_sync(self) -> None:
         try:
             if not self.child_session_sync:
                 self.db.sync_session.close()
-                session_dict = _session.get()
-                session_dict["sync"].pop(self.db)
+                session_dict = _sessions()
+                session = session_dict["sync"].pop(self.db)
+                session_dict.get("memo", {}).pop(session, None)
                 _session.set(session_dict)
         except:
             pass
 
     async def __aenter__(self):
-        if not isinstance(self.db.async_session_maker, async_sessionmaker):
+        self._generation = self.db._enter_generation()
+        if not isinstance(self.db.async_session_maker, _asyncio_ext().async_sessionmaker):
+            self._leave_generation()
             raise SessionNotInitialisedError
-        session = self.db.async_session_maker(**self.db.async_session_args)
-        session_dict = _session.get()
+        session = self.db.async_session_maker()
+        session_dict = _sessions()
         if not session_dict["async"].get(self.db):
             session_dict["async"][self.db] = session
+            if self.db.memoize:
+                self._start_memo(session_dict, session, session.sync_session)
+            if self.db.tracing is not None:
+                self._trace = self.db.tracing.start_session(self.db, session.sync_session)
             _session.set(session_dict)
         else:
             self.child_session_async = True
         return self.db
 
     async def __aexit__(self, exc_type, exc_value, traceback):
-        if exc_type is not None:
-            await self.db.session.rollback()
-        elif self.db.commit_on_exit:
-            try:
-                await self.db.session.commit()
+        try:
+            if exc_type is not None:
                 await self.db.session.rollback()
-            except:
-                pass
+            elif self.db.commit_on_exit:
+                try:
+                    await self.db.session.commit()
+                except Exception:
+                    await self.db.session.rollback()
+                    raise
+        finally:
+            await self._close_async()
+            self._end_trace(exc_value)
+            self._leave_generation()
+
+    def _end_trace(self, error: Optional[BaseException]) -> None:
+        if self._trace is not None:
+            self.db.tracing.end_session(self._trace, error)
+            self._trace = None
+
+    def _leave_generation(self) -> None:
+        generation, self._generation = self._generation, None
+        self.db._leave_generation(generation)
+
+    async def _close_async(self) -> None:
         try:
             if not self.child_session_async:
                 await self.db.session.close()
-                session_dict = _session.get()
-                session_dict["async"].pop(self.db)
+                session_dict = _sessions()
+                session = session_dict["async"].pop(self.db)
+                session_dict.get("memo", {}).pop(session, None)
                 _session.set(session_dict)
         except:
             pass
 
 
+class UnitOfWork:
+    """A short session of its own for one operation, see ``SQLAlchemy.unit``.
+
+    Committed on success even if ``commit_on_exit`` is off.
+    """
+
+    def __init__(self, db: SQLAlchemy):
+        self.db = db
+        self._context = None
+        self._token = None
+
+    def _isolate(self) -> None:
+        # A context of its own without the instance's current session, so that the session
+        # manager opens a new one; tasks sharing the outer sessions are left alone.
+        sessions = _sessions()
+        self._token = _session.set(
+            {
+                kind: {key: value for key, value in entries.items() if key is not self.db}
+                for kind, entries in sessions.items()
+            }
+        )
+        self._context = self.db.session_manager(db=self.db)
+
+    def __enter__(self) -> SQLAlchemy:
+        self._isolate()
+        try:
+            return self._context.__enter__()
+        except BaseException:
+            _session.reset(self._token)
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if exc_type is None and not self.db.commit_on_exit:
+                try:
+                    self.db.sync_session.commit()
+                except Exception as exc:
+                    exc_type, exc_value, traceback = type(exc), exc, exc.__traceback__
+                    self._context.__exit__(exc_type, exc_value, traceback)
+                    raise
+            self._context.__exit__(exc_type, exc_value, traceback)
+        finally:
+            _session.reset(self._token)
+
+    async def __aenter__(self) -> SQLAlchemy:
+        if not self.db.async_:
+            return self.__enter__()
+        self._isolate()
+        try:
+            return await self._context.__aenter__()
+        except BaseException:
+            _session.reset(self._token)
+            raise
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        if not self.db.async_:
+            return self.__exit__(exc_type, exc_value, traceback)
+        try:
+            if exc_type is None and not self.db.commit_on_exit:
+                try:
+                    await self.db.session.commit()
+                except Exception as exc:
+                    exc_type, exc_value, traceback = type(exc), exc, exc.__traceback__
+                    await self._context.__aexit__(exc_type, exc_value, traceback)
+                    raise
+            await self._context.__aexit__(exc_type, exc_value, traceback)
+        finally:
+            _session.reset(self._token)
+
+
 class SQLAlchemy:
+    model_base: Type[ModelBase] = ModelBase
+
     def __init__(
         self,
         url: Optional[URL] = None,
@@ -134,13 +332,17 @@ class SQLAlchemy:
         async_: bool = False,
         expire_on_commit: Optional[bool] = False,
         extended: bool = True,
+        memoize: bool = False,
+        statement_timeouts: bool = True,
+        sqlite_profile: Union[bool, Dict[str, Any]] = False,
+        share_engines: bool = True,
+        detect_blocking: Union[bool, BlockingDetector] = False,
+        tracing: Any = False,
+        adaptive_prefetch: Union[bool, AdaptivePrefetch] = False,
         _session_manager: DBSession = DBSession,
     ):
         self.initiated = False
-        self._Base: Type[DeclarativeMeta] = declarative_base(
-            metaclass=DeclarativeMeta, cls=ModelBase
-        )
-        setattr(self._Base, "db", self)
+        self._base: Optional[Type[DeclarativeMeta]] = None
         self.url = url
         self.async_url = async_url
         self.custom_engine = custom_engine
@@ -153,23 +355,60 @@ class SQLAlchemy:
         self.session_manager: DBSession = _session_manager
         self.verbose = verbose
         self.extended = extended
-        if async_ and not async_sessionmaker:
-            raise SQLAlchemyAsyncioMissing("async_sessionmaker")
+        self.memoize = memoize
+        self.statement_timeouts = statement_timeouts
+        self.sqlite_profile = sqlite_profile
+        self.share_engines = share_engines
+        if detect_blocking is True:
+            detect_blocking = BlockingDetector()
+        self.blocking_detector: Optional[BlockingDetector] = detect_blocking or None
+        if tracing is True:
+            tracing = default_tracer()
+        elif tracing and not hasattr(tracing, "activate"):
+            tracing = OpenTelemetryTracer(tracing)
+        self.tracing: Optional[Tracing] = Tracing(tracing) if tracing else None
+        if adaptive_prefetch is True:
+            adaptive_prefetch = AdaptivePrefetch()
+        self.adaptive_prefetch: Optional[AdaptivePrefetch] = adaptive_prefetch or None
+        self.sqlite_writer_locks: Dict[Engine, sqlite.WriterLock] = {}
+        self.admission: Optional[AdmissionController] = None
+        self.retry_stats: Counter = Counter()
+        self.write_behinds: List[WriteBehind] = []
         self.async_ = async_
         self.expire_on_commit = expire_on_commit
         self._check_optional_components()
         self._session_maker: sessionmaker = None
-        self.engine: Engine = None
-        self.async_engine: AsyncEngine = None
-        self.sync_session_maker: sessionmaker = None
-        self.async_session_maker: async_sessionmaker = None
+        # Engines and sessionmakers are built on first use, see _create_engines.
+        self._pending = False
+        self._engine: Engine = None
+        self._async_engine: AsyncEngine = None
+        self._sync_session_maker: sessionmaker = None
+        self._async_session_maker: async_sessionmaker = None
+        # Sessions in flight on the current engines, see reconfigure.
+        self._generation: Optional[engines.Generation] = None
+        self._generation_lock = threading.Lock()
+        self._reconfigure_lock = threading.Lock()
+        self._disposals: Set[asyncio.Task] = set()
+        self.sync_session_args.setdefault("expire_on_commit", bool(expire_on_commit))
+        self.async_session_args.setdefault("expire_on_commit", bool(expire_on_commit))
+        if memoize:
+            # Fail here rather than when the first session is opened.
+            _memo_session_args(self.sync_session_args, "class_")
+            _memo_session_args(self.async_session_args, "sync_session_class")
+        forking.register(self)
         if self.url:
             self.init()
-        self.sync_session_args["expire_on_commit"] = self.async_session_args["expire_on_commit"] = (
-            False
-        )
 
     def init(self, url: Optional[URL] = None, **options) -> None:
+        if "async_" in options and bool(options["async_"]) != bool(self.async_):
+            # Models pick their sync or async API once, when they are defined.
+            if self._base is not None and self._base.registry.mappers:
+                raise ValueError(
+                    "async_ cannot change once models are defined on db.Base, pass it to the "
+                    "constructor instead."
+                )
+        # Taken before the options replace custom_engine, which decides what the instance owns.
+        previous = self._own_engines() if self.initiated else []
         if url:
             self.url = url
         for key, value in options.items():
@@ -181,16 +420,152 @@ class SQLAlchemy:
             raise ValueError("You need to pass a url or a custom_engine parameter.")
         if not self.async_custom_engine and not self.async_url and self.async_:
             raise ValueError("You need to pass a async_url or a async_custom_engine parameter.")
+        if self.initiated:
+            self._dispose_engines([engine for engine in previous if engines.release(engine)])
+            self._forget_engines()
+        self._pending = True
+        self.initiated = True
+        self.metadata = False
+
+    def _create_engines(self) -> None:
+        self._pending = False
         self.engine = self._create_sync_engine()
         self.async_engine = self._create_async_engine()
+        self._install_engine_hooks()
         self.sync_session_maker = self._make_sync_session_maker()
         self.async_session_maker = self._make_async_session_maker()
+        self._generation = engines.Generation(self._own_engines())
+
+    def create_engines(self) -> None:
+        """Build the engines and sessionmakers now rather than on first use, e.g. at startup."""
+        if self._pending:
+            self._create_engines()
+
+    def reconfigure(self, url: Optional[URL] = None, **options: Any) -> None:
+        """Switch to engines built from a new configuration while the application runs.
+
+        Takes ``url`` and the engine options of the constructor, e.g. new ``engine_args`` to
+        resize the pools, or the URL of a new primary after a failover. The engines are built
+        before anything changes, so a bad configuration leaves the instance as it was. Sessions
+        opened afterwards use them; sessions in flight finish on the old engines, which are
+        disposed once the last of them closes.
+        """
+        _check_reconfigurable(options, RECONFIGURABLE)
+        if url:
+            options["url"] = url
+        for key in ("engine_args", "async_engine_args"):
+            if key in options:
+                options[key] = options[key] or {}
+        with self._reconfigure_lock:
+            if not self.initiated or self._pending:
+                # Nothing was built yet.
+                self.init(**options)
+                return
+            previous = {key: getattr(self, key) for key in options}
+            for key, value in options.items():
+                setattr(self, key, value)
+            built = []
+            try:
+                built.append(self._create_sync_engine())
+                built.append(self._create_async_engine())
+            except BaseException:
+                custom = (self.custom_engine, self.async_custom_engine)
+                for key, value in previous.items():
+                    setattr(self, key, value)
+                self._drain(engines.Generation([e for e in built if e not in custom]))
+                raise
+            old = self._generation
+            self.engine, self.async_engine = built
+            self._install_engine_hooks()
+            sync_maker = self._make_sync_session_maker()
+            async_maker = self._make_async_session_maker()
+            # The sessionmakers before the generation, see DBSession.__enter__.
+            self.sync_session_maker = sync_maker
+            self.async_session_maker = async_maker
+            with self._generation_lock:
+                self._generation = engines.Generation(self._own_engines())
+                old.retired = True
+                drained = old.drained
+        if drained:
+            self._drain(old)
+
+    def _enter_generation(self) -> Optional[engines.Generation]:
+        self.create_engines()
+        with self._generation_lock:
+            generation = self._generation
+            if generation is not None:
+                generation.sessions += 1
+            return generation
+
+    def _leave_generation(self, generation: Optional[engines.Generation]) -> None:
+        if generation is None:
+            return
+        with self._generation_lock:
+            generation.sessions -= 1
+            drained = generation.drained
+        if drained:
+            self._drain(generation)
+
+    def _drain(self, generation: engines.Generation) -> None:
+        for engine in generation.engines:
+            if not engines.release(engine):
+                continue
+            if isinstance(engine, Engine):
+                engine.dispose()
+                continue
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # Closing async connections needs their loop, just drop the pool.
+                engine.sync_engine.dispose(close=False)
+                continue
+            task = loop.create_task(engine.dispose())
+            self._disposals.add(task)
+            task.add_done_callback(self._disposals.discard)
 
-        self.initiated = True
-        self.metadata = False
+    @property
+    def engine(self) -> Engine:
+        if self._pending:
+            self._create_engines()
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine: Engine) -> None:
+        self._engine = engine
+
+    @property
+    def async_engine(self) -> Optional[AsyncEngine]:
+        if self._pending:
+            self._create_engines()
+        return self._async_engine
+
+    @async_engine.setter
+    def async_engine(self, engine: Optional[AsyncEngine]) -> None:
+        self._async_engine = engine
+
+    @property
+    def sync_session_maker(self) -> sessionmaker:
+        if self._pending:
+            self._create_engines()
+        return self._sync_session_maker
+
+    @sync_session_maker.setter
+    def sync_session_maker(self, maker: sessionmaker) -> None:
+        self._sync_session_maker = maker
+
+    @property
+    def async_session_maker(self) -> Optional[async_sessionmaker]:
+        if self._pending:
+            self._create_engines()
+        return self._async_session_maker
+
+    @async_session_maker.setter
+    def async_session_maker(self, maker: Optional[async_sessionmaker]) -> None:
+        self._async_session_maker = maker
 
     def create_all(self):
-        self._Base.metadata.create_all(self.engine)
+        for engine in self._engines():
+            self._Base.metadata.create_all(engine)
         self.metadata = True
         return None
 
@@ -205,17 +580,19 @@ class SQLAlchemy:
                     return None
                 else:
                     continue
+        asyncio_ext = sys.modules.get("sqlalchemy.ext.asyncio")
         for obj in gc.get_objects():
             if type(obj) == Session:
                 if obj.get_bind() == self.engine.url:
                     obj.rollback()
                     obj.close()
-            elif type(obj) == AsyncSession:
+            elif asyncio_ext is not None and type(obj) == asyncio_ext.AsyncSession:
                 loop = asyncio.get_event_loop()
                 if obj.get_bind() == self.engine.url:
                     loop.run_in_executor(None, obj.rollback)
                     loop.run_in_executor(None, obj.close)
-        self._Base.metadata.drop_all(self.engine)
+        for engine in self._engines():
+            self._Base.metadata.drop_all(engine)
         return None
 
     def print(self, *values):
@@ -250,42 +627,249 @@ class SQLAlchemy:
 
         return wrapper
 
+    def unit(self) -> UnitOfWork:
+        """A session of its own for one operation, committed on success and then closed.
+
+        Its connection goes back to the pool when the block ends, even inside a request
+        session. Use one per message in WebSocket handlers and ``long_lived`` routes::
+
+            async for message in websocket.iter_json():
+                async with db.unit():
+                    await Message.new(**message)
+        """
+        return UnitOfWork(self)
+
+    def retrying_transaction(
+        self,
+        max_attempts: int = 3,
+        backoff: float = 0.05,
+        *,
+        max_backoff: float = 1.0,
+        retryable: Callable[[BaseException], bool] = is_retryable,
+    ) -> RetryingTransaction:
+        """Re-run a unit of work on serialization failures and deadlocks, see RetryingTransaction."""
+        return RetryingTransaction(
+            self, max_attempts, backoff, max_backoff=max_backoff, retryable=retryable
+        )
+
+    def write_behind(
+        self,
+        model: type,
+        max_batch: int = 500,
+        max_latency_ms: float = 50,
+        *,
+        max_queue: int = 10_000,
+        overflow: OverflowPolicy = "block",
+        spill_path: Optional[str] = None,
+        max_retries: int = 10,
+    ) -> WriteBehind:
+        """Return a buffer inserting ``model`` rows in background batches, see WriteBehind."""
+        buffer = WriteBehind(
+            self,
+            model,
+            max_batch,
+            max_latency_ms,
+            max_queue=max_queue,
+            overflow=overflow,
+            spill_path=spill_path,
+            max_retries=max_retries,
+        )
+        self.write_behinds.append(buffer)
+        return buffer
+
+    async def close_write_behinds(self) -> None:
+        for buffer in self.write_behinds:
+            if self.async_:
+                await buffer.aclose()
+            else:
+                await asyncio.get_running_loop().run_in_executor(None, buffer.close)
+
+    @asynccontextmanager
+    async def lifespan(self, app: Any) -> AsyncIterator[None]:
+        """App lifespan for ``FastAPI(lifespan=...)``.
+
+        Connects the engines at startup, so that the first request does not pay for it, and
+        flushes the write-behind buffers on shutdown.
+        """
+        self.create_engines()
+        try:
+            yield
+        finally:
+            await self.close_write_behinds()
+
     def _check_optional_components(self):
-        exceptions = []
-        if not sqlalchemy_asyncio and self.async_:
-            raise SQLAlchemyAsyncioMissing()
-        async_classes = [async_sessionmaker, create_async_engine]
         if self.async_:
-            for cls in async_classes:
-                if not cls:
-                    exceptions.append(SQLAlchemyAsyncioMissing(cls.__name__))
-        if not self.async_ and all(async_classes):
+            _asyncio_ext()
+        elif self.verbose >= 3 and importlib.util.find_spec("greenlet") is not None:
             self.print(
                 "sqlalchemy[asyncio] is installed, to use set async_=True in SQLAlchemy constructor."
             )
 
-        if exceptions:
-            raise Exception(*exceptions)
-
     def _make_sync_session_maker(self) -> sessionmaker:
-        return sessionmaker(bind=self.engine, **self.sync_session_args)
+        session_args = self.sync_session_args
+        if self.memoize:
+            session_args = _memo_session_args(session_args, "class_")
+        return sessionmaker(bind=self.engine, **session_args)
 
     def _make_async_session_maker(self) -> async_sessionmaker:
         if self.async_:
-            return async_sessionmaker(bind=self.async_engine, **self.async_session_args)
+            session_args = self.async_session_args
+            if self.memoize:
+                session_args = _memo_session_args(session_args, "sync_session_class")
+            return _asyncio_ext().async_sessionmaker(bind=self.async_engine, **session_args)
 
     def _create_sync_engine(self) -> Union[AsyncEngine, Engine]:
         if self.custom_engine:
             return self.custom_engine
-        else:
-            return create_engine(self.url, **self.engine_args)
+        engine_args = self._engine_args(self.url, self.engine_args)
+        return self._shared_engine(self.url, engine_args, create_engine)
 
     def _create_async_engine(self) -> AsyncEngine:
         if self.async_:
             if self.async_custom_engine:
                 return self.async_custom_engine
+            engine_args = self._engine_args(self.async_url, self.async_engine_args)
+            return self._shared_engine(
+                self.async_url, engine_args, _asyncio_ext().create_async_engine
+            )
+
+    def _shared_engine(self, url: URL, engine_args: Dict[str, Any], create) -> Any:
+        """Create the engine, or reuse the one of another instance with the same configuration.
+
+        Options that install engine hooks are part of the key, so that instances with different
+        settings never share an engine.
+        """
+        if not self.share_engines or not engines.shareable(url):
+            return create(url, **engine_args)
+        key = engines.registry_key(
+            url,
+            engine_args,
+            create.__name__,
+            self.statement_timeouts,
+            self.sqlite_profile,
+            self.blocking_detector,
+            self.tracing,
+        )
+        return engines.acquire(key, lambda: create(url, **engine_args))
+
+    def _engine_args(self, url: URL, engine_args: Dict[str, Any]) -> Dict[str, Any]:
+        if self.sqlite_profile and sqlite.is_sqlite(url):
+            return sqlite.profile_engine_args(url, engine_args)
+        return engine_args
+
+    def _engines(self) -> List[Engine]:
+        return [self.engine]
+
+    def _all_engines(self) -> List[Engine]:
+        engines = self._engines()
+        if self.async_engine is not None:
+            engines.append(self.async_engine.sync_engine)
+        return engines
+
+    def _admission_capacity(self) -> Optional[int]:
+        """Default limit of the AdmissionController, see admission.pool_capacity."""
+        return admission.pool_capacity(self._all_engines())
+
+    def _install_engine_hooks(self) -> None:
+        for engine in self._all_engines():
+            forking.install(engine)
+            if self.statement_timeouts:
+                deadlines.install(engine)
+            if self.tracing is not None:
+                self.tracing.install(engine)
+        if self.blocking_detector is not None:
+            # Async engines run their cursors in greenlets that do not block the loop.
+            for engine in self._engines():
+                self.blocking_detector.install(engine)
+        if self.sqlite_profile:
+            self._install_sqlite_profile()
+
+    def _install_sqlite_profile(self) -> None:
+        # Custom engines are left as they were configured.
+        for engine in self._own_engines():
+            engine = getattr(engine, "sync_engine", engine)
+            if engine.dialect.name != "sqlite" or engine in self.sqlite_writer_locks:
+                continue
+            self.sqlite_writer_locks[engine] = sqlite.install(engine, self.sqlite_profile)
+
+    def _release_engines(self) -> List[Any]:
+        """Give up the engines of the instance, returning those nobody else uses any more."""
+        return [engine for engine in self._own_engines() if engines.release(engine)]
+
+    def _own_engines(self) -> List[Any]:
+        # Custom engines belong to the caller, who disposes them.
+        return [
+            engine
+            for engine, custom in (
+                (self._engine, self.custom_engine),
+                (self._async_engine, self.async_custom_engine),
+            )
+            if engine is not None and engine is not custom
+        ]
+
+    def dispose(self) -> None:
+        """Release the engines; shared engines are disposed once their last instance is gone.
+
+        Async engines are closed by ``adispose()``, here their pools are only dropped.
+        """
+        self._dispose_engines(self._release_engines())
+        self._forget_engines()
+
+    @staticmethod
+    def _dispose_engines(released: List[Any]) -> None:
+        for engine in released:
+            if isinstance(engine, Engine):
+                engine.dispose()
+            else:
+                engine.sync_engine.dispose(close=False)
+
+    async def adispose(self) -> None:
+        for engine in self._release_engines():
+            if isinstance(engine, Engine):
+                engine.dispose()
             else:
-                return create_async_engine(self.async_url, **self.async_engine_args)
+                await engine.dispose()
+        self._forget_engines()
+
+    def _forget_engines(self) -> None:
+        self._pending = False
+        self.engine = None
+        self.async_engine = None
+        self.sync_session_maker = None
+        self.async_session_maker = None
+        self._generation = None
+        self.initiated = False
+
+    def _reset_after_fork(self) -> None:
+        # The child must neither use nor close the sockets it shares with the parent: forget the
+        # sessions the forking thread had open on them and swap in fresh pools, which open their
+        # own connections on first checkout.
+        sessions = _session.get()
+        if sessions is not None:
+            for kind in ("sync", "async"):
+                session = sessions[kind].pop(self, None)
+                if session is not None:
+                    sessions.get("memo", {}).pop(session, None)
+        if not self.initiated or self._pending:
+            return
+        for engine in self._all_engines():
+            engine.dispose(close=False)
+        # Sessions other threads of the parent had open never close here. The child runs a
+        # single thread at this point, the lock may have been copied while held.
+        self._generation = engines.Generation(self._own_engines())
+
+    def bind_request(self, request: Any) -> ContextManager[Any]:
+        """Context ``DBSessionMiddleware`` enters around the sessions of each request.
+
+        Subclasses use it to pick the database from the request, see TenantSQLAlchemy.
+        """
+        return nullcontext()
+
+    @asynccontextmanager
+    async def abind_request(self, request: Any) -> AsyncIterator[Any]:
+        """Async variant entered by ``DBSessionMiddleware``, wrapping ``bind_request``."""
+        with self.bind_request(request) as bound:
+            yield bound
 
     def __call__(self) -> SQLAlchemy:
         local_session = self.session_manager(db=self)
@@ -305,7 +889,7 @@ class SQLAlchemy:
 
     @property
     def session(self) -> Union[Session, AsyncSession]:
-        sessions = _session.get()
+        sessions = _sessions()
         if sessions["async"].get(self):
             return sessions["async"][self]
         elif sessions["sync"].get(self):
@@ -313,9 +897,23 @@ class SQLAlchemy:
         else:
             raise SessionNotInitialisedError
 
+    def memo_for(self, session: Union[Session, AsyncSession]) -> Optional[Dict[Any, Any]]:
+        """Return the request memo of ``session``, or None when memoization is off.
+
+        Pending changes would be autoflushed by the next query, so they invalidate the memo.
+        """
+        if not self.memoize:
+            return None
+        memo = _sessions().get("memo", {}).get(session)
+        if memo:
+            sync_session = getattr(session, "sync_session", session)
+            if sync_session.new or sync_session.dirty or sync_session.deleted:
+                memo.clear()
+        return memo
+
     @property
     def sync_session(self) -> Session:
-        sessions = _session.get()
+        sessions = _sessions()
         if sessions["sync"].get(self):
             return sessions["sync"][self]
         elif sessions["async"].get(self):
@@ -328,6 +926,13 @@ class SQLAlchemy:
         self.BigInteger.with_variant()
         return None
 
+    @property
+    def _Base(self) -> Type[DeclarativeMeta]:
+        if self._base is None:
+            self._base = declarative_base(metaclass=DeclarativeMeta, cls=self.model_base)
+            setattr(self._base, "db", self)
+        return self._base
+
     @property
     def BaseModel(self) -> Type[ModelBase]:
         return self._Base
@@ -337,10 +942,57 @@ class SQLAlchemy:
         return self._Base
 
 
+VERSION_COLUMN = "version_id"
+
+
+def _add_version_column(bases, attrs) -> None:
+    """Map ``__versioned__`` models with a version counter for optimistic concurrency.
+
+    ``__versioned__ = True`` adds a ``version_id`` column (a string names it instead, an
+    existing column of that name is used as is). Updates and deletes then check it, and raise
+    StaleDataError when the row was changed since it was loaded. Bulk ``update_where()``
+    statements bump it too.
+    """
+    if "__versioned__" in attrs:
+        versioned = attrs["__versioned__"]
+    else:
+        versioned = next(
+            (base.__versioned__ for base in bases if hasattr(base, "__versioned__")), False
+        )
+    # Subclasses of a mapped model inherit its version column.
+    if (
+        not versioned
+        or "__tablename__" not in attrs
+        or any(hasattr(base, "__table__") for base in bases)
+    ):
+        return
+    name = versioned if isinstance(versioned, str) else VERSION_COLUMN
+    column = attrs.get(name)
+    if column is None:
+        # The default covers Core inserts (import_stream, write-behind) the mapper never sees.
+        column = attrs[name] = Column(name, Integer, nullable=False, default=1)
+    mapper_args = dict(attrs.get("__mapper_args__", {}))
+    mapper_args.setdefault("version_id_col", column)
+    attrs["__mapper_args__"] = mapper_args
+
+
 class DeclarativeMeta(DeclarativeMeta_):
     db: SQLAlchemy
     session: Session
 
+    def __new__(mcs, name, bases, attrs, **kwargs):
+        # Pick the model API once, when the class is defined, from the bound instance's mode.
+        # It is appended so that methods defined on user mixins still take precedence.
+        db = next(
+            (base.db for base in bases if isinstance(getattr(base, "db", None), SQLAlchemy)), None
+        )
+        if db is not None and not any(
+            issubclass(base, (SyncModelBase, AsyncModelBase)) for base in bases
+        ):
+            bases = bases + (AsyncModelBase if db.async_ else SyncModelBase,)
+        _add_version_column(bases, attrs)
+        return super().__new__(mcs, name, bases, attrs, **kwargs)
+
     def __init__(self, name, bases, attrs):
         for base in bases:
             if hasattr(base, "db"):
@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import os
+import weakref
+from typing import TYPE_CHECKING
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+
+if TYPE_CHECKING:
+    from .extensions import SQLAlchemy
+
+PID_KEY = "fastapi_sqlalchemy.pid"
+
+_instances: weakref.WeakSet[SQLAlchemy] = weakref.WeakSet()
+
+
+def register(db: SQLAlchemy) -> None:
+    """Have ``db`` drop the pools it inherits when the process forks."""
+    _instances.add(db)
+
+
+def _after_fork_in_child() -> None:
+    for db in list(_instances):
+        db._reset_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _connect(dbapi_connection, connection_record) -> None:
+    connection_record.info[PID_KEY] = os.getpid()
+
+
+def _checkout(dbapi_connection, connection_record, connection_proxy) -> None:
+    # Covers forks register_at_fork does not see, e.g. a pool copied into a child before the
+    # instance was registered; the pool then replaces the connection with a fresh one.
+    pid = os.getpid()
+    if connection_record.info.get(PID_KEY, pid) != pid:
+        connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+        raise exc.DisconnectionError(
+            f"Connection record belongs to pid {connection_record.info[PID_KEY]}, "
+            f"attempting to check out in pid {pid}"
+        )
+
+
+def install(engine: Engine) -> None:
+    """Refuse to hand out connections that were opened in another process."""
+    if event.contains(engine, "connect", _connect):
+        return
+    event.listen(engine, "connect", _connect)
+    event.listen(engine, "checkout", _checkout)
@@ -0,0 +1,312 @@
+from __future__ import annotations
+
+import codecs
+import csv
+import datetime
+import decimal
+import json
+import mmap
+import os
+import uuid
+from typing import (
+    Any,
+    AsyncIterable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from sqlalchemy import Table, insert
+from sqlalchemy.orm import Session
+
+ImportFormat = Literal["csv", "ndjson"]
+Chunk = Union[bytes, str]
+Source = Union[str, os.PathLike, Iterable[Chunk], AsyncIterable[Chunk]]
+
+CHUNK_SIZE = 1 << 18
+# Drivers with a COPY fast path, see copy_rows and acopy_rows.
+COPY_DRIVERS = ("psycopg", "asyncpg")
+
+_TRUE = {"1", "true", "t", "yes", "y", "on"}
+_FALSE = {"0", "false", "f", "no", "n", "off"}
+
+
+def _to_bool(value: str) -> bool:
+    lowered = value.strip().lower()
+    if lowered in _TRUE:
+        return True
+    if lowered in _FALSE:
+        return False
+    raise ValueError(f"invalid boolean {value!r}")
+
+
+_PARSERS: Dict[type, Callable[[str], Any]] = {
+    bool: _to_bool,
+    int: int,
+    float: float,
+    decimal.Decimal: decimal.Decimal,
+    datetime.datetime: datetime.datetime.fromisoformat,
+    datetime.date: datetime.date.fromisoformat,
+    datetime.time: datetime.time.fromisoformat,
+    uuid.UUID: uuid.UUID,
+}
+
+
+def _python_type(column) -> Optional[type]:
+    try:
+        return column.type.python_type
+    except NotImplementedError:
+        return None
+
+
+def converter(column) -> Callable[[Any], Any]:
+    """Coerce a text value (a CSV field, or a JSON string) to the type of ``column``.
+
+    Empty CSV fields are NULL except for string columns; other JSON values are kept as they
+    are.
+    """
+    python_type = _python_type(column)
+    parse = _PARSERS.get(python_type)
+    if parse is None:
+        return lambda value: value
+
+    def convert(value: Any) -> Any:
+        if not isinstance(value, str):
+            return value
+        if value == "":
+            return None
+        return parse(value)
+
+    return convert
+
+
+def _path_chunks(path: Union[str, os.PathLike]) -> Iterator[bytes]:
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for start in range(0, len(mapped), CHUNK_SIZE):
+                yield mapped[start : start + CHUNK_SIZE]
+
+
+def _is_path(source: Any) -> bool:
+    return isinstance(source, (str, os.PathLike))
+
+
+class StreamParser:
+    """Turns chunks of a CSV or NDJSON stream into rows for ``table``, keeping only the
+    incomplete tail of the stream in memory.
+
+    CSV records may span lines inside quoted fields: lines are collected until the number of
+    quotes is even. The first CSV record is the header.
+    """
+
+    def __init__(
+        self, table: Table, format: ImportFormat, encoding: str = "utf-8", delimiter: str = ","
+    ):
+        if format not in ("csv", "ndjson"):
+            raise ValueError(f"Unknown import format {format!r}, use 'csv' or 'ndjson'.")
+        self.table = table
+        self.format = format
+        self.delimiter = delimiter
+        self.line = 0
+        self.columns: Optional[List[str]] = None
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._tail = ""
+        self._record: List[str] = []
+        self._quotes = 0
+        self._converters: Dict[str, Callable[[Any], Any]] = {}
+
+    def _converter(self, name: str) -> Callable[[Any], Any]:
+        convert = self._converters.get(name)
+        if convert is None:
+            if name not in self.table.c:
+                raise ValueError(f"Line {self.line}: {self.table.name} has no column {name!r}.")
+            convert = self._converters[name] = converter(self.table.c[name])
+        return convert
+
+    def _row(self, values: Iterable[Tuple[str, Any]]) -> Dict[str, Any]:
+        row = {}
+        for name, value in values:
+            convert = self._converter(name)
+            try:
+                row[name] = convert(value)
+            except (ValueError, ArithmeticError) as exc:
+                raise ValueError(f"Line {self.line}, column {name!r}: {exc}") from None
+        return row
+
+    def _parse_line(self, line: str) -> Optional[Dict[str, Any]]:
+        self.line += 1
+        if line.endswith("\r"):
+            line = line[:-1]
+        if self.format == "ndjson":
+            if not line.strip():
+                return None
+            values = json.loads(line)
+            if not isinstance(values, dict):
+                raise ValueError(f"Line {self.line}: expected a JSON object.")
+            return self._row(values.items())
+        self._record.append(line)
+        self._quotes += line.count('"')
+        if self._quotes % 2:
+            return None
+        record = "\n".join(self._record)
+        self._record, self._quotes = [], 0
+        if not record:
+            return None
+        fields = next(csv.reader([record], delimiter=self.delimiter))
+        if self.columns is None:
+            self.columns = [name.strip() for name in fields]
+            for name in self.columns:
+                self._converter(name)
+            return None
+        if len(fields) != len(self.columns):
+            raise ValueError(
+                f"Line {self.line}: expected {len(self.columns)} fields, got {len(fields)}."
+            )
+        return self._row(zip(self.columns, fields))
+
+    def feed(self, chunk: Chunk) -> List[Dict[str, Any]]:
+        text = self._decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        lines = (self._tail + text).split("\n")
+        self._tail = lines.pop()
+        return [row for row in map(self._parse_line, lines) if row is not None]
+
+    def close(self) -> List[Dict[str, Any]]:
+        tail = self._tail + self._decoder.decode(b"", final=True)
+        self._tail = ""
+        rows = [] if not tail else [row for row in [self._parse_line(tail)] if row is not None]
+        if self._record:
+            raise ValueError(f"Line {self.line}: unterminated quoted field.")
+        return rows
+
+
+def _batched(
+    rows: Iterable[Dict[str, Any]], batch: List[Dict[str, Any]], size: int
+) -> Iterator[List[Dict[str, Any]]]:
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch[:]
+            batch.clear()
+
+
+def _groups(batch: List[Dict[str, Any]]) -> Iterator[Tuple[Tuple[str, ...], List[Dict[str, Any]]]]:
+    # NDJSON rows may leave out columns; an executemany needs the same ones in every row.
+    groups: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+    for row in batch:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    return iter(groups.items())
+
+
+def _can_copy(table: Table, columns: Tuple[str, ...], driver: str) -> bool:
+    # COPY skips Python side defaults, leave rows that need them to INSERT.
+    if driver not in COPY_DRIVERS:
+        return False
+    return all(column.name in columns or column.default is None for column in table.columns)
+
+
+def _copy_sql(dialect, table: Table, columns: Tuple[str, ...]) -> str:
+    preparer = dialect.identifier_preparer
+    names = ", ".join(preparer.quote(name) for name in columns)
+    return f"COPY {preparer.format_table(table)} ({names}) FROM STDIN"
+
+
+def copy_rows(session: Session, table: Table, batch: List[Dict[str, Any]]) -> None:
+    """Insert ``batch`` with COPY when the driver supports it, a multi-row INSERT otherwise."""
+    connection = session.connection()
+    for columns, rows in _groups(batch):
+        if not _can_copy(table, columns, connection.dialect.driver):
+            session.execute(insert(table), rows)
+            continue
+        raw = connection.connection.driver_connection
+        with raw.cursor() as cursor:
+            with cursor.copy(_copy_sql(connection.dialect, table, columns)) as copy:
+                for row in rows:
+                    copy.write_row([row[name] for name in columns])
+
+
+async def acopy_rows(session: Any, table: Table, batch: List[Dict[str, Any]]) -> None:
+    connection = await session.connection()
+    for columns, rows in _groups(batch):
+        if not _can_copy(table, columns, connection.dialect.driver):
+            await session.execute(insert(table), rows)
+            continue
+        raw = (await connection.get_raw_connection()).driver_connection
+        await raw.copy_records_to_table(
+            table.name,
+            records=[tuple(row[name] for name in columns) for row in rows],
+            columns=list(columns),
+            schema_name=table.schema,
+        )
+
+
+def import_rows(
+    session: Session,
+    table: Table,
+    source: Source,
+    format: ImportFormat = "csv",
+    batch_size: int = 1000,
+    insert_batch: Callable[[Any, Table, List[Dict[str, Any]]], None] = copy_rows,
+    **options: Any,
+) -> int:
+    """Parse ``source`` incrementally and insert its rows ``batch_size`` at a time; commits.
+
+    ``insert_batch(session, table, batch)`` inserts each batch, ``copy_rows`` by default.
+    """
+    if hasattr(source, "__aiter__"):
+        raise TypeError("Async iterables need the async model API, `await import_stream(...)`.")
+    parser = StreamParser(table, format, **options)
+    chunks = _path_chunks(source) if _is_path(source) else source
+    count = 0
+    pending: List[Dict[str, Any]] = []
+    for chunk in chunks:
+        for batch in _batched(parser.feed(chunk), pending, batch_size):
+            insert_batch(session, table, batch)
+            count += len(batch)
+    pending.extend(parser.close())
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start : start + batch_size]
+        insert_batch(session, table, batch)
+        count += len(batch)
+    session.commit()
+    return count
+
+
+async def aimport_rows(
+    session: Any,
+    table: Table,
+    source: Source,
+    format: ImportFormat = "csv",
+    batch_size: int = 1000,
+    **options: Any,
+) -> int:
+    parser = StreamParser(table, format, **options)
+    count = 0
+    pending: List[Dict[str, Any]] = []
+
+    async def insert_ready(rows: List[Dict[str, Any]]) -> None:
+        nonlocal count
+        for batch in _batched(rows, pending, batch_size):
+            await acopy_rows(session, table, batch)
+            count += len(batch)
+
+    if hasattr(source, "__aiter__"):
+        async for chunk in source:
+            await insert_ready(parser.feed(chunk))
+    else:
+        for chunk in _path_chunks(source) if _is_path(source) else source:
+            await insert_ready(parser.feed(chunk))
+    pending.extend(parser.close())
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start : start + batch_size]
+        await acopy_rows(session, table, batch)
+        count += len(batch)
+    await session.commit()
+    return count
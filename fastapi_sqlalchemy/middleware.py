@@ -4,16 +4,20 @@ import asyncio
 import inspect
 import logging
 from contextlib import AsyncExitStack, ExitStack
-from typing import Dict, List, Optional, Union
+from typing import Callable, Dict, List, Optional, Union
 
-from curio.meta import from_coroutine
 from sqlalchemy.engine.url import URL
 from sqlalchemy.orm import sessionmaker
 from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
 from starlette.requests import Request
-from starlette.types import ASGIApp
+from starlette.responses import JSONResponse, Response
+from starlette.routing import BaseRoute, Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-from .exceptions import SQLAlchemyType
+from . import blocking, deadlines
+from .admission import AdmissionController
+from .decorators import LONG_LIVED_ATTR, NO_DB_ATTR
+from .exceptions import DeadlineExceeded, SQLAlchemyType, UnknownTenant
 from .extensions import SQLAlchemy
 from .extensions import db as db_
 from .extensions import reset_session, start_session
@@ -34,6 +38,103 @@ class DBStateMap:
             raise ValueError("DBStateMap is already initialized")
 
 
+def route_for(request: Request) -> Optional[BaseRoute]:
+    """Return the route the router will dispatch ``request`` to, if it can be found."""
+    router = getattr(request.scope.get("app"), "router", None)
+    for route in getattr(router, "routes", ()):
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route
+    return None
+
+
+def endpoint_for(request: Request) -> Optional[Callable]:
+    return getattr(route_for(request), "endpoint", None)
+
+
+CANCEL_ON_DEADLINE = "fastapi_sqlalchemy.cancel_on_deadline"
+
+
+def timeout_response() -> Response:
+    return JSONResponse({"detail": "Request deadline exceeded."}, status_code=504)
+
+
+def unknown_tenant_response() -> Response:
+    return JSONResponse({"detail": "Unknown tenant."}, status_code=404)
+
+
+def client_closed_response() -> Response:
+    # Nobody is listening any more, this only completes the ASGI exchange.
+    return Response(status_code=499)
+
+
+class DeadlineApp:
+    """Runs the wrapped app under the current deadline and answers 504 once it has passed.
+
+    Async endpoints run in their own task, which is cancelled at the deadline or as soon as the
+    client disconnects, cancelling their in-flight queries with it. Sync endpoints run in a
+    worker thread that cannot be cancelled; their statements are bounded by the statement
+    timeouts derived from the deadline instead.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        response_started = False
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            if not scope.get(CANCEL_ON_DEADLINE):
+                await self.app(scope, receive, send_wrapper)
+            elif await self.run_cancellable(scope, receive, send_wrapper):
+                if not response_started:
+                    await client_closed_response()(scope, receive, send)
+        except (DeadlineExceeded, asyncio.TimeoutError) as exc:
+            left = deadlines.remaining()
+            expired = isinstance(exc, DeadlineExceeded) or (left is not None and left <= 0)
+            if response_started or not expired:
+                raise
+            await timeout_response()(scope, receive, send)
+
+    async def run_cancellable(self, scope: Scope, receive: Receive, send: Send) -> bool:
+        """Run the app until it finishes or the deadline passes; True if the client went away."""
+        # The app reads its messages through a one slot queue fed by the watcher, so that the
+        # watcher is the only reader of ``receive`` and sees the disconnect first.
+        messages: asyncio.Queue = asyncio.Queue(maxsize=1)
+        task = asyncio.ensure_future(self.app(scope, messages.get, send))
+        disconnected = False
+
+        async def watch() -> None:
+            nonlocal disconnected
+            while True:
+                message = await receive()
+                if task.done():
+                    # Nobody reads the queue any more, a put could block forever.
+                    return
+                if message["type"] == "http.disconnect":
+                    disconnected = True
+                    task.cancel()
+                    return
+                await messages.put(message)
+
+        watcher = asyncio.ensure_future(watch())
+        left = deadlines.remaining()
+        try:
+            await asyncio.wait_for(task, None if left is None else max(left, 0))
+        except asyncio.CancelledError:
+            if not disconnected:
+                raise
+        finally:
+            watcher.cancel()
+        return disconnected
+
+
 def is_async():
     try:
         asyncio.get_running_loop()
@@ -48,61 +149,97 @@ class DBSessionMiddleware(BaseHTTPMiddleware):
         app: ASGIApp,
         db: Optional[Union[List[SQLAlchemy], SQLAlchemy]] = None,
         db_url: Optional[URL] = None,
+        *,
+        admission_control: bool = False,
+        admission_limit: Optional[int] = None,
+        max_queue_depth: int = 100,
+        max_wait: float = 1.0,
+        retry_after: int = 1,
+        request_timeout: Optional[float] = None,
         **options,
     ):
-        super().__init__(app)
+        super().__init__(DeadlineApp(app))
         self.state_map = DBStateMap()
-        if not (type(db) == list or type(db) == SQLAlchemy) and not db_url:
+        if not (isinstance(db, (list, SQLAlchemy))) and not db_url:
             raise SQLAlchemyType()
         if db_url and not db:
             global db_
             if not db_.initiated:
                 db_.init(url=db_url, **options)
             self.dbs = [db_]
-        if type(db) == SQLAlchemy:
+        if isinstance(db, SQLAlchemy):
             self.dbs = [
                 db,
             ]
-        elif type(db) == list:
+        elif isinstance(db, list):
             self.dbs = db
         for db in self.dbs:
             db.create_all()
+        self.retry_after = retry_after
+        self.request_timeout = request_timeout
+        if admission_control:
+            for db in self.dbs:
+                if db.admission is None:
+                    db.admission = AdmissionController(
+                        db, admission_limit, max_queue_depth=max_queue_depth, max_wait=max_wait
+                    )
 
     async def dispatch(self, request: Request, call_next: RequestResponseEndpoint):
-        req_async = False
+        endpoint = endpoint_for(request)
+        if getattr(endpoint, NO_DB_ATTR, False) or getattr(endpoint, LONG_LIVED_ATTR, False):
+            return await call_next(request)
+        req_async = inspect.iscoroutinefunction(endpoint)
+        request.scope[CANCEL_ON_DEADLINE] = req_async
+        admitted: List[AdmissionController] = []
+        deadline_token = None
+        if self.request_timeout is not None:
+            deadline_token = deadlines.set_deadline(self.request_timeout)
         try:
-            for route in self.app.app.app.routes:
-                if route.path == request.scope["path"]:
-                    req_async = inspect.iscoroutinefunction(route.endpoint)
-        except:
-            req_async = False
-        token = start_session()
-        exception = None
-        async with AsyncExitStack() as async_stack:
-            with ExitStack() as sync_stack:
-                contexts = [
-                    await async_stack.enter_async_context(ctx())
-                    for ctx in self.dbs
-                    if ctx.async_ and req_async
-                ]
-                contexts.extend([sync_stack.enter_context(ctx()) for ctx in self.dbs])
-                try:
-                    response = await call_next(request)
-                except Exception as e:
-                    exception = e
-                    for db in self.dbs:
-                        db.session.rollback()
+            for db in self.dbs:
+                if db.admission is not None:
+                    if not await db.admission.acquire():
+                        return self.overloaded_response()
+                    admitted.append(db.admission)
+            return await self.dispatch_with_sessions(request, call_next, req_async)
+        finally:
+            for controller in admitted:
+                controller.release()
+            if deadline_token is not None:
+                deadlines.reset_deadline(deadline_token)
 
-        if exception:
-            raise exception
+    def overloaded_response(self) -> Response:
+        return JSONResponse(
+            {"detail": "Service temporarily overloaded, please retry."},
+            status_code=503,
+            headers={"Retry-After": str(self.retry_after)},
+        )
 
-        reset_session(token)
+    async def dispatch_with_sessions(
+        self, request: Request, call_next: RequestResponseEndpoint, req_async: bool
+    ) -> Response:
+        token = start_session()
+        blocking_token = None
+        if any(db.blocking_detector is not None for db in self.dbs):
+            blocking_token = blocking.start_request()
+        try:
+            async with AsyncExitStack() as async_stack:
+                for db in self.dbs:
+                    await async_stack.enter_async_context(db.abind_request(request))
+                with ExitStack() as sync_stack:
+                    contexts = [
+                        await async_stack.enter_async_context(ctx())
+                        for ctx in self.dbs
+                        if ctx.async_ and req_async
+                    ]
+                    contexts.extend([sync_stack.enter_context(ctx()) for ctx in self.dbs])
+                    response = await call_next(request)
+        except DeadlineExceeded:
+            return timeout_response()
+        except UnknownTenant:
+            return unknown_tenant_response()
+        finally:
+            reset_session(token)
+            if blocking_token is not None:
+                route = route_for(request)
+                blocking.finish_request(blocking_token, getattr(route, "path", request.url.path))
         return response
-
-        # if req_async:
-        #     return dispatch_inner()
-        # else:
-        #     with ExitStack() as stack:
-        #         contexts = [stack.enter_context(ctx()) for ctx in self.dbs]
-        #         response = call_next(request)
-        # return response
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import threading
+from collections import Counter
+from types import FrameType
+from typing import Any, Dict, Hashable, List, Optional, Set
+
+from sqlalchemy import event
+from sqlalchemy.orm import ORMExecuteState, Session
+from sqlalchemy.orm.interfaces import UserDefinedOption
+
+
+def relationship_path(path: Any) -> str:
+    """``"user.team"`` for the loader path Post -> Post.user -> User -> User.team."""
+    return ".".join(prop.key for prop in path.natural_path[1::2])
+
+
+class SiteStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.lazy_loads = 0
+        self.warmup_lazy_loads = 0
+        # Number of warm-up calls whose objects lazily loaded each path.
+        self.paths: Counter = Counter()
+        # Learned once the warm-up is over.
+        self.prefetch: Optional[List[str]] = None
+
+
+class CallSite(UserDefinedOption):
+    """Tags a ``get``/``get_all`` statement with its call site.
+
+    Lazy loads from the objects it returns carry the option along, so that they can be
+    recorded under the site.
+    """
+
+    __slots__ = ("adaptive", "stats", "learning", "seen")
+
+    propagate_to_loaders = True
+
+    def __init__(self, adaptive: AdaptivePrefetch, stats: SiteStats, learning: bool):
+        super().__init__(stats.name)
+        self.adaptive = adaptive
+        self.stats = stats
+        self.learning = learning
+        self.seen: Set[str] = set()
+
+    def record(self, path: str) -> None:
+        with self.adaptive._lock:
+            self.stats.lazy_loads += 1
+            if not self.learning:
+                return
+            self.stats.warmup_lazy_loads += 1
+            if path not in self.seen:
+                self.seen.add(path)
+                self.stats.paths[path] += 1
+
+
+def _record_lazy_load(state: ORMExecuteState) -> None:
+    # Only SELECTs have load options, lazy_loaded_from raises for bulk UPDATE and DELETE.
+    if not state.is_select or state.lazy_loaded_from is None:
+        return
+    for option in state.user_defined_options:
+        if isinstance(option, CallSite):
+            option.record(relationship_path(state.loader_strategy_path))
+            return
+
+
+class AdaptivePrefetch:
+    """Learns which relationships the results of each ``get``/``get_all`` call site load lazily.
+
+    For the first ``warmup`` calls of a site (a model method called from a line of code), every
+    lazy load from the objects it returned is recorded under its relationship path. Paths that
+    were loaded lazily in at least ``threshold`` of those calls are then selectin loaded by the
+    following calls. Calls passing ``prefetch`` explicitly are left alone.
+    """
+
+    def __init__(self, warmup: int = 20, threshold: float = 0.5):
+        self.warmup = warmup
+        self.threshold = threshold
+        self.sites: Dict[Hashable, SiteStats] = {}
+        self._lock = threading.Lock()
+        if not event.contains(Session, "do_orm_execute", _record_lazy_load):
+            event.listen(Session, "do_orm_execute", _record_lazy_load)
+
+    def call(self, cls: type, method: str, frame: FrameType) -> CallSite:
+        code = frame.f_code
+        key = (cls, method, code.co_filename, frame.f_lineno)
+        with self._lock:
+            stats = self.sites.get(key)
+            if stats is None:
+                name = f"{cls.__name__}.{method} at {code.co_filename}:{frame.f_lineno}"
+                stats = self.sites[key] = SiteStats(name)
+            if stats.prefetch is None and stats.calls >= self.warmup:
+                needed = self.threshold * stats.calls
+                stats.prefetch = sorted(
+                    path for path, calls in stats.paths.items() if calls >= needed
+                )
+            stats.calls += 1
+            return CallSite(self, stats, learning=stats.prefetch is None)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Per call site: the learned paths (None while warming up) and the lazy loads per call
+        during the warm-up and since."""
+        report = []
+        with self._lock:
+            for stats in self.sites.values():
+                warmup_calls = min(stats.calls, self.warmup)
+                later_calls = stats.calls - warmup_calls
+                report.append(
+                    {
+                        "site": stats.name,
+                        "calls": stats.calls,
+                        "prefetch": stats.prefetch,
+                        "warmup_lazy_loads_per_call": stats.warmup_lazy_loads / warmup_calls,
+                        "lazy_loads_per_call": (
+                            (stats.lazy_loads - stats.warmup_lazy_loads) / later_calls
+                            if later_calls
+                            else None
+                        ),
+                    }
+                )
+        return report
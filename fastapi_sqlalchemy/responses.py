@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+from typing import Any, Iterable, Optional
+
+from starlette.responses import JSONResponse
+
+from .serializers import _is_mapped, dumps, serialize_many, to_dict
+
+
+class ORMResponse(JSONResponse):
+    """JSON response that serializes mapped instances with the precompiled serializers.
+
+    Return an instance from a route, e.g. ``return ORMResponse(User.get_all())``, so that
+    FastAPI skips ``jsonable_encoder`` for the ORM objects. ``fields`` and ``depth`` are
+    passed to the serializer.
+    """
+
+    media_type = "application/json"
+
+    def __init__(
+        self,
+        content: Any = None,
+        *args: Any,
+        fields: Optional[Iterable[str]] = None,
+        depth: int = 0,
+        **kwargs: Any,
+    ) -> None:
+        self.fields = fields
+        self.depth = depth
+        super().__init__(content, *args, **kwargs)
+
+    def render(self, content: Any) -> bytes:
+        fields = getattr(self, "fields", None)
+        depth = getattr(self, "depth", 0)
+        if _is_mapped(content):
+            return dumps(to_dict(content, fields, depth))
+        if isinstance(content, (list, tuple)) and content and all(map(_is_mapped, content)):
+            return serialize_many(content, fields, depth)
+        return dumps(content)
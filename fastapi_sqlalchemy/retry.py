@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import asyncio
+import inspect
+import random
+import time
+from functools import wraps
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable, Iterator, Optional
+
+from sqlalchemy.orm.exc import StaleDataError
+
+from . import deadlines
+
+if TYPE_CHECKING:
+    from .extensions import SQLAlchemy
+
+# Serialization failure and deadlock detected (Postgres, and the SQL standard for the former).
+RETRYABLE_SQLSTATES = {"40001", "40P01"}
+# ER_LOCK_DEADLOCK
+RETRYABLE_MYSQL_ERRORS = {1213}
+RETRYABLE_MESSAGES = ("database is locked",)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """True if ``exc`` (or the DBAPI error it wraps) means the transaction can simply be re-run.
+
+    That includes StaleDataError from ``__versioned__`` models, the unit of work must then
+    load the rows it changes again.
+    """
+    if isinstance(exc, StaleDataError):
+        return True
+    for error in (exc, getattr(exc, "orig", None)):
+        if error is None:
+            continue
+        if getattr(error, "pgcode", None) in RETRYABLE_SQLSTATES:
+            return True
+        if getattr(error, "sqlstate", None) in RETRYABLE_SQLSTATES:
+            return True
+        args = getattr(error, "args", ())
+        if args and args[0] in RETRYABLE_MYSQL_ERRORS:
+            return True
+        if any(message in str(error) for message in RETRYABLE_MESSAGES):
+            return True
+    return False
+
+
+class Attempt:
+    """One run of the unit of work, see ``RetryingTransaction``."""
+
+    def __init__(self, retrying: RetryingTransaction, number: int):
+        self.retrying = retrying
+        self.number = number
+        self.succeeded = False
+        self._context = None
+
+    def __enter__(self) -> Attempt:
+        self._context = self.retrying.db()
+        self._context.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        raised_by_block = exc_value is not None
+        if not raised_by_block:
+            try:
+                self.retrying.db.sync_session.commit()
+            except Exception as exc:
+                exc_type, exc_value, traceback = type(exc), exc, exc.__traceback__
+        self._context.__exit__(exc_type, exc_value, traceback)
+        if exc_value is None:
+            self.succeeded = True
+            self.retrying.record_success(self.number)
+            return False
+        delay = self.retrying.retry_delay(self.number, exc_value)
+        if delay is None:
+            if raised_by_block:
+                return False
+            raise exc_value
+        time.sleep(delay)
+        return True
+
+    async def __aenter__(self) -> Attempt:
+        self._context = self.retrying.db()
+        if self.retrying.db.async_:
+            await self._context.__aenter__()
+        else:
+            self._context.__enter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> bool:
+        raised_by_block = exc_value is not None
+        db = self.retrying.db
+        if not raised_by_block:
+            try:
+                if db.async_:
+                    await db.session.commit()
+                else:
+                    db.sync_session.commit()
+            except Exception as exc:
+                exc_type, exc_value, traceback = type(exc), exc, exc.__traceback__
+        if db.async_:
+            await self._context.__aexit__(exc_type, exc_value, traceback)
+        else:
+            self._context.__exit__(exc_type, exc_value, traceback)
+        if exc_value is None:
+            self.succeeded = True
+            self.retrying.record_success(self.number)
+            return False
+        delay = self.retrying.retry_delay(self.number, exc_value)
+        if delay is None:
+            if raised_by_block:
+                return False
+            raise exc_value
+        await asyncio.sleep(delay)
+        return True
+
+
+class RetryingTransaction:
+    """Runs a unit of work in a transaction and re-runs it on serialization failures and deadlocks.
+
+    The work runs in the current session (or a new one outside of a request), is committed at
+    the end and, if that raises a retryable error (see ``is_retryable``), is rolled back and run
+    again after a jittered exponential backoff, at most ``max_attempts`` times. As a rollback
+    discards everything pending in the session, the whole unit of work must happen inside, and
+    it should stage its writes with ``session.add`` or ``session.execute`` rather than ``save()``,
+    ``new()`` or ``update_where()``, which commit on their own.
+
+    Use it as a decorator on sync or async functions::
+
+        @db.retrying_transaction(max_attempts=5)
+        def transfer(source_id, target_id, amount): ...
+
+    or, for a block of code, iterate over the attempts::
+
+        for attempt in db.retrying_transaction():
+            with attempt:
+                ...
+
+    with ``async for`` and ``async with`` for async sessions. Counts are kept in
+    ``db.retry_stats``.
+    """
+
+    def __init__(
+        self,
+        db: SQLAlchemy,
+        max_attempts: int = 3,
+        backoff: float = 0.05,
+        max_backoff: float = 1.0,
+        retryable: Callable[[BaseException], bool] = is_retryable,
+    ):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1.")
+        self.db = db
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retryable = retryable
+
+    def retry_delay(self, attempt: int, exc: BaseException) -> Optional[float]:
+        """Seconds to wait before running again after ``exc``, None to give up."""
+        if not isinstance(exc, Exception) or not self.retryable(exc):
+            return None
+        if attempt >= self.max_attempts:
+            self.db.retry_stats["gave_up"] += 1
+            return None
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        left = deadlines.remaining()
+        if left is not None and left <= delay:
+            self.db.retry_stats["gave_up"] += 1
+            return None
+        self.db.retry_stats["retries"] += 1
+        return delay
+
+    def record_success(self, attempt: int) -> None:
+        self.db.retry_stats["committed"] += 1
+        if attempt > 1:
+            self.db.retry_stats["committed_after_retry"] += 1
+
+    def __iter__(self) -> Iterator[Attempt]:
+        for number in range(1, self.max_attempts + 1):
+            attempt = Attempt(self, number)
+            yield attempt
+            if attempt.succeeded:
+                return
+
+    async def __aiter__(self) -> AsyncIterator[Attempt]:
+        for number in range(1, self.max_attempts + 1):
+            attempt = Attempt(self, number)
+            yield attempt
+            if attempt.succeeded:
+                return
+
+    def __call__(self, func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                async for attempt in self:
+                    async with attempt:
+                        result = await func(*args, **kwargs)
+                return result
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            for attempt in self:
+                with attempt:
+                    result = func(*args, **kwargs)
+            return result
+
+        return wrapper
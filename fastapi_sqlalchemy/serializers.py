@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import datetime
+import decimal
+import enum
+import json
+import uuid
+from operator import attrgetter
+from typing import Any, Callable, Dict, Iterable, Optional, Sequence, Tuple, Type
+
+from sqlalchemy import inspect as sa_inspect
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+Serializer = Callable[[Any], Dict[str, Any]]
+
+_serializers: Dict[Tuple[type, Optional[Tuple[str, ...]], int], Serializer] = {}
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, enum.Enum):
+        return obj.value
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return bytes(obj).decode("utf-8", errors="replace")
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    """Encode ``content`` to JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(
+        content, default=_default, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def compile_serializer(
+    model: Type[Any], fields: Optional[Iterable[str]] = None, depth: int = 0
+) -> Serializer:
+    """Build (once) and return a function turning ``model`` instances into plain dicts.
+
+    Columns come from the mapper, so attribute keys are used rather than column names.
+    Relationships are only followed while ``depth`` is greater than zero.
+    """
+    if isinstance(fields, str):
+        fields = (fields,)
+    fields = tuple(sorted(fields)) if fields is not None else None
+    key = (model, fields, depth)
+    serializer = _serializers.get(key)
+    if serializer is not None:
+        return serializer
+
+    mapper = sa_inspect(model)
+    columns = [attr.key for attr in mapper.column_attrs]
+    relationships = {rel.key: rel for rel in mapper.relationships} if depth > 0 else {}
+    if fields is not None:
+        unknown = set(fields) - set(columns) - set(relationships)
+        if unknown:
+            raise AttributeError(
+                f"{model.__name__} has no serializable field(s): {', '.join(sorted(unknown))}"
+            )
+        columns = [name for name in columns if name in fields]
+        relationships = {name: rel for name, rel in relationships.items() if name in fields}
+
+    names = tuple(columns)
+    if len(names) == 1:
+        getter = attrgetter(*names)
+
+        def get_values(obj: Any) -> Tuple[Any, ...]:
+            return (getter(obj),)
+
+    elif names:
+        get_values = attrgetter(*names)
+    else:
+
+        def get_values(obj: Any) -> Tuple[Any, ...]:
+            return ()
+
+    nested = [
+        (name, rel.uselist, compile_serializer(rel.mapper.class_, None, depth - 1))
+        for name, rel in relationships.items()
+    ]
+
+    def serializer(obj: Any) -> Dict[str, Any]:
+        state = sa_inspect(obj)
+        # Deferred or expired columns are left out rather than loaded one row at a time, e.g.
+        # after get_all(only=...); async sessions could not load them here anyway.
+        unloaded = state.unloaded if state.has_identity else ()
+        if unloaded and not unloaded.isdisjoint(names):
+            data = {name: getattr(obj, name) for name in names if name not in unloaded}
+        else:
+            data = dict(zip(names, get_values(obj)))
+        for name, uselist, child in nested:
+            # Sync sessions load relationships on demand; async ones would raise.
+            if name in unloaded and state.async_session is not None:
+                continue
+            value = getattr(obj, name)
+            if value is None:
+                data[name] = None
+            elif uselist:
+                data[name] = [child(item) for item in value]
+            else:
+                data[name] = child(value)
+        return data
+
+    _serializers[key] = serializer
+    return serializer
+
+
+def to_dict(obj: Any, fields: Optional[Iterable[str]] = None, depth: int = 0) -> Dict[str, Any]:
+    return compile_serializer(type(obj), fields, depth)(obj)
+
+
+def serialize_many(
+    objs: Sequence[Any], fields: Optional[Iterable[str]] = None, depth: int = 0
+) -> bytes:
+    if not objs:
+        return b"[]"
+    serializer = None
+    model = None
+    data = []
+    for obj in objs:
+        if type(obj) is not model:
+            model = type(obj)
+            serializer = compile_serializer(model, fields, depth)
+        data.append(serializer(obj))
+    return dumps(data)
+
+
+def _is_mapped(obj: Any) -> bool:
+    return hasattr(type(obj), "__mapper__")
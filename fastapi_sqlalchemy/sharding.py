@@ -0,0 +1,573 @@
+from __future__ import annotations
+
+import contextvars
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Self,
+    Set,
+    Union,
+)
+
+from sqlalchemy import Row, create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import URL
+from sqlalchemy.orm import Session, object_session, sessionmaker
+from sqlalchemy.sql import ColumnExpressionArgument, operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+
+from . import engines, importing
+from .exceptions import SessionNotInitialisedError, ShardKeyMissing
+from .extensions import DBSession, SQLAlchemy, _check_reconfigurable, _session, _sessions
+from .types import Columns, SynchronizeSession, SyncModelBase, _names, _scalars
+
+
+class ShardSessions:
+    """The request "session" of a ShardedSQLAlchemy: one Session per shard, created on first use.
+
+    Commits are issued shard by shard; there is no two-phase commit across shards.
+    """
+
+    def __init__(self, db: ShardedSQLAlchemy):
+        self.db = db
+        self.sessions: Dict[Hashable, Session] = {}
+
+    def shard(self, shard_id: Hashable) -> Session:
+        session = self.sessions.get(shard_id)
+        if session is None:
+            session = self.db.sync_session_makers[shard_id]()
+            self.sessions[shard_id] = session
+        return session
+
+    def for_instance(self, obj: Any) -> Session:
+        session = object_session(obj)
+        if session is not None and session in self.sessions.values():
+            return session
+        return self.shard(self.db.shard_for_instance(obj))
+
+    def add(self, obj: Any) -> None:
+        self.for_instance(obj).add(obj)
+
+    def delete(self, obj: Any) -> None:
+        self.for_instance(obj).delete(obj)
+
+    def commit(self) -> None:
+        for session in self.sessions.values():
+            session.commit()
+
+    def rollback(self) -> None:
+        for session in self.sessions.values():
+            session.rollback()
+
+    def close(self) -> None:
+        for session in self.sessions.values():
+            session.close()
+        self.sessions.clear()
+
+
+class ShardedDBSession(DBSession):
+    def __enter__(self):
+        if not self.db.sync_session_makers:
+            raise SessionNotInitialisedError
+        session_dict = _sessions()
+        if not session_dict["sync"].get(self.db):
+            # Counted before the sessionmakers are read, see DBSession.__enter__.
+            self._generation = self.db._enter_generation()
+            session_dict["sync"][self.db] = ShardSessions(self.db)
+            _session.set(session_dict)
+        else:
+            self.child_session_sync = True
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sessions: ShardSessions = self.db.sync_session
+        try:
+            if exc_type is not None:
+                sessions.rollback()
+            elif self.db.commit_on_exit:
+                try:
+                    sessions.commit()
+                except Exception:
+                    sessions.rollback()
+                    raise
+        finally:
+            if not self.child_session_sync:
+                sessions.close()
+                session_dict = _sessions()
+                session_dict["sync"].pop(self.db, None)
+                _session.set(session_dict)
+                self._leave_generation()
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.__exit__(exc_type, exc_value, traceback)
+
+
+def _criterion_values(criterion: Any, column: Any) -> Optional[Set[Any]]:
+    """Return the shard key values a criterion pins ``column`` to, or None if unconstrained."""
+    if isinstance(criterion, BooleanClauseList):
+        if criterion.operator is not operators.and_:
+            return None
+        values = None
+        for clause in criterion.clauses:
+            found = _criterion_values(clause, column)
+            if found is not None:
+                values = found if values is None else values & found
+        return values
+    if not isinstance(criterion, BinaryExpression):
+        return None
+    left, right = criterion.left, criterion.right
+    if getattr(left, "key", None) != column.key or getattr(left, "table", None) is not column.table:
+        return None
+    if not isinstance(right, BindParameter):
+        return None
+    if criterion.operator is operators.eq:
+        return {right.effective_value}
+    if criterion.operator is operators.in_op:
+        return set(right.effective_value)
+    return None
+
+
+class ShardedModelBase(SyncModelBase):
+    """Model API of a ShardedSQLAlchemy.
+
+    Reads that pin the shard key (``tenant_id=3`` or ``Model.tenant_id == 3``) go to one shard,
+    any other read is scattered to every shard in parallel and the results are concatenated.
+    Writes go to the shard chosen from the instance's shard key.
+    """
+
+    @property
+    def session(self) -> Session:
+        return self.db.sync_session.for_instance(self)
+
+    @property
+    def sync_session(self) -> Session:
+        return self.session
+
+    @classmethod
+    def get_all(
+        cls,
+        *criterion: ColumnExpressionArgument[bool],
+        only: Optional[Iterable[str]] = None,
+        defer: Optional[Iterable[str]] = None,
+        load: Optional[Mapping[str, str]] = None,
+        prefetch: Optional[Iterable[str]] = None,
+        **kwargs: Any,
+    ) -> List[Self]:
+        load, site = cls._prefetch("get_all", load, prefetch)
+        stmt = cls._select(criterion, kwargs, only, defer, load, site)
+        results = cls.db.scatter(
+            cls.db.shards_for_query(cls, criterion, kwargs),
+            lambda session: _scalars(session.execute(stmt), load).all(),
+        )
+        return [obj for objs in results for obj in objs]
+
+    @classmethod
+    def get(
+        cls,
+        *criterion: ColumnExpressionArgument[bool],
+        only: Optional[Iterable[str]] = None,
+        defer: Optional[Iterable[str]] = None,
+        load: Optional[Mapping[str, str]] = None,
+        prefetch: Optional[Iterable[str]] = None,
+        **kwargs: Any,
+    ) -> Optional[Self]:
+        load, site = cls._prefetch("get", load, prefetch)
+        stmt = cls._select(criterion, kwargs, only, defer, load, site).limit(1)
+        results = cls.db.scatter(
+            cls.db.shards_for_query(cls, criterion, kwargs),
+            lambda session: _scalars(session.execute(stmt), load).first(),
+        )
+        return next((obj for obj in results if obj is not None), None)
+
+    @classmethod
+    def count(cls, *criterion: ColumnExpressionArgument[bool], **kwargs: Any) -> int:
+        stmt = cls._count_stmt(criterion, kwargs)
+        return sum(
+            cls.db.scatter(
+                cls.db.shards_for_query(cls, criterion, kwargs),
+                lambda session: session.execute(stmt).scalar_one(),
+            )
+        )
+
+    @classmethod
+    def exists(cls, *criterion: ColumnExpressionArgument[bool], **kwargs: Any) -> bool:
+        stmt = cls._exists_stmt(criterion, kwargs)
+        return any(
+            cls.db.scatter(
+                cls.db.shards_for_query(cls, criterion, kwargs),
+                lambda session: session.execute(stmt).scalar_one(),
+            )
+        )
+
+    @classmethod
+    def aggregate(
+        cls,
+        *criterion: ColumnExpressionArgument[bool],
+        group_by: Columns = None,
+        sum: Columns = None,
+        avg: Columns = None,
+        min: Columns = None,
+        max: Columns = None,
+        count: bool = False,
+        **kwargs: Any,
+    ) -> List[Row]:
+        """Aggregate on every shard involved and merge the groups.
+
+        Averages cannot be merged from per-shard results, so ``avg`` needs the criteria to pin
+        a single shard; aggregate ``sum`` with ``count=True`` instead.
+        """
+        shard_ids = cls.db.shards_for_query(cls, criterion, kwargs)
+        if avg is not None and len(shard_ids) > 1:
+            raise ValueError("avg cannot be merged across shards, use sum and count instead.")
+        stmt = cls._aggregate_stmt(
+            criterion, kwargs, group_by, count, sum=sum, avg=avg, min=min, max=max
+        )
+        results = cls.db.scatter(shard_ids, lambda session: session.execute(stmt).all())
+        if len(results) == 1:
+            return results[0]
+        return _merge_groups(results, len(_names(group_by)))
+
+    @classmethod
+    def update_where(
+        cls,
+        *criterion: ColumnExpressionArgument[bool],
+        synchronize_session: SynchronizeSession = "auto",
+        returning: bool = False,
+        all: bool = False,
+        **values: Any,
+    ) -> Union[int, List[Self]]:
+        """Update matching rows on every shard involved, see SyncModelBase.update_where.
+
+        Shards are committed one after the other, not atomically. The shard key cannot be
+        changed, as rows would be left on the wrong shard.
+        """
+        cls._require_criterion("update_where", criterion, all)
+        key = cls.db.key_for(cls)
+        if key in values:
+            raise ValueError(f"update_where() cannot change the shard key {key!r}.")
+        stmt = cls._update_stmt(criterion, values, synchronize_session, returning)
+        return cls._scatter_write(criterion, stmt, returning)
+
+    @classmethod
+    def delete_where(
+        cls,
+        *criterion: ColumnExpressionArgument[bool],
+        synchronize_session: SynchronizeSession = "auto",
+        returning: bool = False,
+        all: bool = False,
+    ) -> Union[int, List[Self]]:
+        cls._require_criterion("delete_where", criterion, all)
+        stmt = cls._delete_stmt(criterion, synchronize_session, returning)
+        return cls._scatter_write(criterion, stmt, returning)
+
+    @classmethod
+    def import_stream(
+        cls,
+        source: importing.Source,
+        format: importing.ImportFormat = "csv",
+        batch_size: int = 1000,
+        **options: Any,
+    ) -> int:
+        """Import a stream as SyncModelBase.import_stream does, each batch split over the shards
+        by the shard key of its rows. Shards are committed one after the other, not atomically.
+        """
+        key = cls.db.key_for(cls)
+        name = cls.__table__.c[key].name
+
+        def insert_batch(sessions: ShardSessions, table: Any, batch: List[Dict[str, Any]]) -> None:
+            by_shard: Dict[Hashable, List[Dict[str, Any]]] = {}
+            for row in batch:
+                if row.get(name) is None:
+                    raise ShardKeyMissing(cls.__name__, key)
+                by_shard.setdefault(cls.db.shard_for_value(row[name]), []).append(row)
+            for shard_id, rows in by_shard.items():
+                importing.copy_rows(sessions.shard(shard_id), table, rows)
+
+        return importing.import_rows(
+            cls.db.session,
+            cls.__table__,
+            source,
+            format,
+            batch_size,
+            insert_batch=insert_batch,
+            **options,
+        )
+
+    @classmethod
+    def _scatter_write(cls, criterion, stmt: Any, returning: bool) -> Union[int, List[Self]]:
+        def execute(session: Session) -> Any:
+            result = session.execute(stmt)
+            return result.scalars().all() if returning else result.rowcount
+
+        results = cls.db.scatter(cls.db.shards_for_query(cls, criterion, {}), execute)
+        cls.db.session.commit()
+        if returning:
+            return [obj for objs in results for obj in objs]
+        return sum(results)
+
+
+def _merge_groups(results: List[List[Row]], group_size: int) -> List[Row]:
+    """Combine per-shard rows of the same group, following each column's aggregate function."""
+    merged: Dict[tuple, list] = {}
+    fields = None
+    for rows in results:
+        for row in rows:
+            fields = row._fields
+            key = tuple(row[:group_size])
+            current = merged.get(key)
+            if current is None:
+                merged[key] = list(row)
+                continue
+            for index in range(group_size, len(row)):
+                value, name = row[index], fields[index]
+                if value is None:
+                    continue
+                if current[index] is None:
+                    current[index] = value
+                elif name.startswith("min_"):
+                    current[index] = min(current[index], value)
+                elif name.startswith("max_"):
+                    current[index] = max(current[index], value)
+                else:
+                    current[index] += value
+    if fields is None:
+        return []
+    row_type = namedtuple("Row", fields, rename=True)
+    return [row_type(*values) for values in merged.values()]
+
+
+def default_shard_chooser(shard_ids: List[Hashable]) -> Callable[[Any], Hashable]:
+    """Map a key value to a shard: values naming a shard go there, others are hashed (crc32)."""
+
+    def choose(value: Any) -> Hashable:
+        if value in shard_ids:
+            return value
+        return shard_ids[zlib.crc32(str(value).encode("utf-8")) % len(shard_ids)]
+
+    return choose
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    """A SQLAlchemy instance spread over several databases, routed by a shard key.
+
+    ``shards`` maps shard ids to URLs (or engines). ``shard_key`` names the model attribute
+    used for routing and can be overridden per model with ``__shard_key__``; ``shard_chooser``
+    maps a key value to a shard id. DBSessionMiddleware treats the instance as one database,
+    and a Session is only opened for a shard once a query or write touches it.
+    """
+
+    model_base = ShardedModelBase
+
+    def __init__(
+        self,
+        shards: Optional[Mapping[Hashable, Union[URL, str, Engine]]] = None,
+        *,
+        shard_key: Optional[str] = None,
+        shard_chooser: Optional[Callable[[Any], Hashable]] = None,
+        max_workers: Optional[int] = None,
+        engine_args: Dict[str, Any] = None,
+        session_args: Dict[str, Any] = None,
+        commit_on_exit: bool = False,
+        verbose: int = 0,
+        **kwargs: Any,
+    ):
+        self.shards: Dict[Hashable, Union[URL, str, Engine]] = dict(shards or {})
+        self.shard_key = shard_key
+        self.shard_chooser = shard_chooser
+        self.max_workers = max_workers
+        self.engines: Dict[Hashable, Engine] = {}
+        self.sync_session_makers: Dict[Hashable, sessionmaker] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        super().__init__(
+            engine_args=engine_args,
+            session_args=session_args,
+            commit_on_exit=commit_on_exit,
+            verbose=verbose,
+            _session_manager=ShardedDBSession,
+            **kwargs,
+        )
+        if self.shards:
+            self.init()
+
+    def init(self, shards: Optional[Mapping[Hashable, Union[URL, str, Engine]]] = None, **options):
+        if shards:
+            self.shards = dict(shards)
+        for key, value in options.items():
+            if hasattr(self, key):
+                setattr(self, key, value)
+            else:
+                raise AttributeError(f"Attribute {key} not a valid attribute.")
+        if not self.shards:
+            raise ValueError("You need to pass at least one shard.")
+        if self.initiated:
+            self.dispose()
+        if self.shard_chooser is None:
+            self.shard_chooser = default_shard_chooser(list(self.shards))
+        for shard_id, target in self.shards.items():
+            if isinstance(target, Engine):
+                engine = target
+            else:
+                engine_args = self._engine_args(target, self.engine_args)
+                engine = self._shared_engine(target, engine_args, create_engine)
+            self.engines[shard_id] = engine
+            self.sync_session_makers[shard_id] = sessionmaker(bind=engine, **self.sync_session_args)
+        self.engine = next(iter(self.engines.values()))
+        self._install_engine_hooks()
+        self.sync_session_maker = self.sync_session_makers[next(iter(self.engines))]
+        self._generation = engines.Generation(self._own_engines())
+        self.initiated = True
+        self.metadata = False
+
+    def reconfigure(
+        self, shards: Optional[Mapping[Hashable, Union[URL, str, Engine]]] = None, **options: Any
+    ) -> None:
+        """Switch shards to engines built from a new configuration while the application runs.
+
+        ``shards`` maps some of the shard ids to their new URL or engine; new ``engine_args``
+        rebuild every shard given as a URL. Shards cannot be added or removed here, as keys
+        would be routed elsewhere, use ``init()``. As with SQLAlchemy.reconfigure, the engines
+        are built first and sessions in flight finish on the old ones.
+        """
+        _check_reconfigurable(options, ("engine_args",))
+        shards = dict(shards or {})
+        unknown = [shard_id for shard_id in shards if shard_id not in self.shards]
+        if unknown:
+            raise ValueError(f"Unknown shard {unknown[0]!r}, call init() to change the shards.")
+        with self._reconfigure_lock:
+            if not self.initiated:
+                self.init({**self.shards, **shards}, **options)
+                return
+            engine_args = options.get("engine_args", self.engine_args) or {}
+            targets = {**self.shards, **shards}
+            swapped = targets if "engine_args" in options else shards
+            built: Dict[Hashable, Engine] = {}
+            try:
+                for shard_id, target in swapped.items():
+                    if isinstance(target, Engine):
+                        built[shard_id] = target
+                    else:
+                        args = self._engine_args(target, engine_args)
+                        built[shard_id] = self._shared_engine(target, args, create_engine)
+            except BaseException:
+                self._drain(
+                    engines.Generation(
+                        [e for i, e in built.items() if not isinstance(targets[i], Engine)]
+                    )
+                )
+                raise
+            old = self._generation
+            replaced = [
+                self.engines[shard_id]
+                for shard_id in built
+                if not isinstance(self.shards[shard_id], Engine)
+            ]
+            self.shards, self.engine_args = targets, engine_args
+            for shard_id, engine in built.items():
+                self.engines[shard_id] = engine
+                self.sync_session_makers[shard_id] = sessionmaker(
+                    bind=engine, **self.sync_session_args
+                )
+            first = next(iter(self.engines))
+            self.engine = self.engines[first]
+            self.sync_session_maker = self.sync_session_makers[first]
+            self._install_engine_hooks()
+            with self._generation_lock:
+                self._generation = engines.Generation(self._own_engines())
+                # The shards left alone carry their engines over to the new generation.
+                old.engines = replaced
+                old.retired = True
+                drained = old.drained
+        if drained:
+            self._drain(old)
+
+    def _engines(self) -> List[Engine]:
+        return list(self.engines.values())
+
+    def _own_engines(self) -> List[Any]:
+        return [
+            engine
+            for shard_id, engine in self.engines.items()
+            if not isinstance(self.shards.get(shard_id), Engine)
+        ]
+
+    def _forget_engines(self) -> None:
+        super()._forget_engines()
+        self.engines = {}
+        self.sync_session_makers = {}
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def key_for(self, model: type) -> str:
+        key = getattr(model, "__shard_key__", None) or self.shard_key
+        if key is None:
+            raise AttributeError(
+                f"No shard key for {model.__name__}, set shard_key= or __shard_key__."
+            )
+        return key
+
+    def shard_for_value(self, value: Any) -> Hashable:
+        return self.shard_chooser(value)
+
+    def shard_for_instance(self, obj: Any) -> Hashable:
+        key = self.key_for(type(obj))
+        value = getattr(obj, key, None)
+        if value is None:
+            raise ShardKeyMissing(type(obj).__name__, key)
+        return self.shard_for_value(value)
+
+    def shards_for_query(
+        self, model: type, criterion: Iterable[Any], kwargs: Mapping[str, Any]
+    ) -> List[Hashable]:
+        key = self.key_for(model)
+        values = None
+        if key in kwargs:
+            values = {kwargs[key]}
+        else:
+            column = model.__table__.c[key]
+            for clause in criterion:
+                found = _criterion_values(clause, column)
+                if found is not None:
+                    values = found if values is None else values & found
+        if values is None:
+            return list(self.engines)
+        chosen = {self.shard_for_value(value) for value in values}
+        return [shard_id for shard_id in self.engines if shard_id in chosen]
+
+    def scatter(self, shard_ids: List[Hashable], func: Callable[[Session], Any]) -> List[Any]:
+        """Run ``func`` against the request session of each shard, in parallel, in shard order."""
+        sessions: ShardSessions = self.sync_session
+        targets = [sessions.shard(shard_id) for shard_id in shard_ids]
+        if len(targets) <= 1:
+            return [func(session) for session in targets]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers or len(self.engines),
+                thread_name_prefix="fastapi-sqlalchemy-shard",
+            )
+        # Each call runs in a copy of the caller's context so that deadlines, statement
+        # timeouts and tracing spans set for the request still apply on the worker threads.
+        futures = [
+            self._executor.submit(contextvars.copy_context().run, func, session)
+            for session in targets
+        ]
+        return [future.result() for future in futures]
+
+    def _make_sync_session_maker(self) -> sessionmaker:
+        return self.sync_session_maker
+
+    @property
+    def session(self) -> ShardSessions:
+        return self.sync_session
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import threading
+import weakref
+from collections import Counter
+from typing import Any, Dict, Optional, Union
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import URL, make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+DEFAULT_PRAGMAS: Dict[str, Any] = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,  # negative: KiB rather than pages
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+}
+
+WRITER_KEY = "fastapi_sqlalchemy.sqlite_writer"
+
+# Engines already profiled, they can be shared by several instances.
+_installed: weakref.WeakKeyDictionary[Engine, Optional[WriterLock]] = weakref.WeakKeyDictionary()
+
+_WRITE_KEYWORDS = ("INSERT", "UPDATE", "DELETE", "REPLACE", "CREATE", "DROP", "ALTER")
+
+
+def is_sqlite(url: Union[URL, str, None]) -> bool:
+    return url is not None and make_url(url).get_backend_name() == "sqlite"
+
+
+def is_memory(url: Union[URL, str]) -> bool:
+    url = make_url(url)
+    database = url.database or ""
+    return database in ("", ":memory:") or url.query.get("mode") == "memory"
+
+
+def profile_pragmas(profile: Union[bool, Dict[str, Any]]) -> Dict[str, Any]:
+    """Pragmas of a ``sqlite_profile=`` value: True for the defaults, a dict to override them."""
+    pragmas = dict(DEFAULT_PRAGMAS)
+    if isinstance(profile, dict):
+        pragmas.update(profile)
+    return {name: value for name, value in pragmas.items() if value is not None}
+
+
+def profile_engine_args(url: Union[URL, str], engine_args: Dict[str, Any]) -> Dict[str, Any]:
+    """Engine arguments of the profile, ``engine_args`` taking precedence.
+
+    In-memory databases get a single connection that is handed to one thread (or task) at a
+    time, otherwise each connection would see its own empty database.
+    """
+    url = make_url(url)
+    engine_args = dict(engine_args)
+    if is_memory(url):
+        is_async = url.get_dialect().is_async
+        engine_args.setdefault("poolclass", AsyncAdaptedQueuePool if is_async else QueuePool)
+        engine_args.setdefault("pool_size", 1)
+        engine_args.setdefault("max_overflow", 0)
+        connect_args = dict(engine_args.get("connect_args", {}))
+        connect_args.setdefault("check_same_thread", False)
+        engine_args["connect_args"] = connect_args
+    return engine_args
+
+
+class WriterLock:
+    """Serializes writing transactions of one engine within the process.
+
+    SQLite allows a single writer; instead of letting concurrent writers spin on the busy
+    timeout, the first write statement of a transaction waits for this lock, which is released
+    when the transaction ends. Readers never take it and run on the pool concurrently.
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.stats: Counter = Counter()
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if conn.info.get(WRITER_KEY) or not statement.lstrip().upper().startswith(_WRITE_KEYWORDS):
+            return
+        if self.lock.acquire(blocking=False):
+            self.stats["uncontended"] += 1
+        elif self.lock.acquire(timeout=self.timeout):
+            self.stats["waited"] += 1
+        else:
+            # Let SQLite's own busy handling deal with it rather than failing here.
+            self.stats["timed_out"] += 1
+            return
+        conn.info[WRITER_KEY] = True
+
+    def end(self, conn) -> None:
+        if conn.info.pop(WRITER_KEY, False):
+            self.lock.release()
+
+    def checkin(self, dbapi_connection, connection_record) -> None:
+        if connection_record.info.pop(WRITER_KEY, False):
+            self.lock.release()
+
+
+def _set_pragmas(pragmas: Dict[str, Any], memory: bool):
+    def connect(dbapi_connection, connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            if memory and name in ("journal_mode", "mmap_size"):
+                continue
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    return connect
+
+
+def install(
+    engine: Engine, profile: Union[bool, Dict[str, Any]], writer_lock: bool = True
+) -> Optional[WriterLock]:
+    """Apply the profile to ``engine``: pragmas on connect and, optionally, a writer lock.
+
+    The lock is skipped for in-memory databases, whose single pooled connection already
+    serializes everything, and for async drivers, where waiting on it would block the loop.
+    """
+    if engine in _installed:
+        return _installed[engine]
+    pragmas = profile_pragmas(profile)
+    memory = is_memory(engine.url)
+    event.listen(engine, "connect", _set_pragmas(pragmas, memory))
+    lock = None
+    if writer_lock and not memory and not engine.dialect.is_async:
+        lock = WriterLock(timeout=pragmas.get("busy_timeout", 5000) / 1000)
+        event.listen(engine, "before_cursor_execute", lock.before_cursor_execute)
+        event.listen(engine, "commit", lock.end)
+        event.listen(engine, "rollback", lock.end)
+        event.listen(engine, "checkin", lock.checkin)
+    _installed[engine] = lock
+    return lock
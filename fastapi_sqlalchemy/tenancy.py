@@ -0,0 +1,487 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Union,
+)
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import URL
+from sqlalchemy.orm import sessionmaker
+
+from . import deadlines, forking, sqlite
+from .exceptions import SessionNotInitialisedError, UnknownTenant
+from .extensions import SQLAlchemy, _asyncio_ext, _check_reconfigurable, _memo_session_args
+
+TenantResolver = Callable[[Any], Optional[Hashable]]
+TenantURLs = Union[Mapping[Hashable, Union[URL, str]], Callable[[Hashable], Union[URL, str, None]]]
+
+TENANT_RECONFIGURABLE = ("tenant_url", "async_tenant_url", "engine_args", "async_engine_args")
+
+
+def from_header(name: str = "X-Tenant-ID") -> TenantResolver:
+    """Resolve the tenant from a request header."""
+
+    def resolve(request: Any) -> Optional[str]:
+        return request.headers.get(name) or None
+
+    return resolve
+
+
+def from_subdomain(domain: Optional[str] = None) -> TenantResolver:
+    """Resolve the tenant from the first label of the host, ``acme`` in ``acme.example.com``.
+
+    With ``domain``, only hosts directly below it have a tenant.
+    """
+
+    def resolve(request: Any) -> Optional[str]:
+        host = (request.url.hostname or "").lower()
+        if domain is not None:
+            suffix = "." + domain.lower()
+            label = host[: -len(suffix)] if host.endswith(suffix) else ""
+            return label if label and "." not in label else None
+        labels = host.split(".")
+        return labels[0] if len(labels) > 2 else None
+
+    return resolve
+
+
+class ConnectionBudget:
+    """Caps the connections open at once over the engines of every tenant.
+
+    When the cap is reached, a new connection first has the least recently used idle tenants
+    evicted to close theirs, then waits up to ``timeout`` for one to close. Async engines do
+    not wait, as that would block the event loop: they fail at once with a pool TimeoutError.
+    """
+
+    def __init__(self, limit: int, timeout: float, reclaim: Callable[[Engine], None]):
+        self.limit = limit
+        self.timeout = timeout
+        self.reclaim = reclaim
+        self.open = 0
+        self.stats: Counter = Counter()
+        self._by_engine: Dict[Engine, int] = {}
+        self._changed = threading.Condition()
+
+    def install(self, engine: Engine) -> None:
+        def do_connect(dialect, connection_record, cargs, cparams):
+            self.acquire(engine)
+            try:
+                return dialect.connect(*cargs, **cparams)
+            except BaseException:
+                self.release(engine)
+                raise
+
+        def close(dbapi_connection, connection_record=None) -> None:
+            self.release(engine)
+
+        self._by_engine[engine] = 0
+        event.listen(engine, "do_connect", do_connect)
+        event.listen(engine, "close", close)
+        event.listen(engine, "close_detached", close)
+
+    def _take(self, engine: Engine) -> bool:
+        if self.open >= self.limit:
+            return False
+        self.open += 1
+        self._by_engine[engine] = self._by_engine.get(engine, 0) + 1
+        return True
+
+    def acquire(self, engine: Engine) -> None:
+        with self._changed:
+            if self._take(engine):
+                return
+        timeout = 0 if engine.dialect.is_async else self.timeout
+        deadline = time.monotonic() + timeout
+        self.stats["waited"] += 1
+        while True:
+            # Tenants whose last request just finished only become idle later: try again.
+            self.reclaim(engine)
+            left = deadline - time.monotonic()
+            with self._changed:
+                if self._changed.wait_for(lambda: self._take(engine), min(max(left, 0), 0.05)):
+                    return
+            if left <= 0:
+                break
+        self.stats["timed_out"] += 1
+        raise exc.TimeoutError(
+            f"Connection limit of {self.limit} reached over all tenants, timed out after "
+            f"{timeout}s."
+        )
+
+    def release(self, engine: Engine) -> None:
+        with self._changed:
+            if self._by_engine.get(engine, 0) > 0:
+                self._by_engine[engine] -= 1
+                self.open -= 1
+                self._changed.notify()
+
+    def forget(self, engine: Engine) -> None:
+        """Stop counting the connections of ``engine``, whose pool was dropped without closing."""
+        with self._changed:
+            self.open -= self._by_engine.pop(engine, 0)
+            self._changed.notify_all()
+
+
+class TenantEngines:
+    """Engines and sessionmakers of one tenant, disposed once evicted and no longer in use."""
+
+    def __init__(self, tenant: Hashable, engine: Engine, async_engine: Any = None):
+        self.tenant = tenant
+        self.engine = engine
+        self.async_engine = async_engine
+        self.sync_session_maker: Optional[sessionmaker] = None
+        self.async_session_maker: Any = None
+        self.users = 0
+        self.evicted = False
+
+    def sync_engines(self) -> List[Engine]:
+        engines = [self.engine]
+        if self.async_engine is not None:
+            engines.append(self.async_engine.sync_engine)
+        return engines
+
+
+class TenantSQLAlchemy(SQLAlchemy):
+    """A SQLAlchemy instance whose database depends on the tenant of the request.
+
+    ``tenant_url`` maps a tenant id to its database URL, either as a mapping or a callable
+    returning None for unknown tenants; async instances also need ``async_tenant_url``.
+    Inside ``DBSessionMiddleware`` the ``resolver`` finds the tenant of each request, from a
+    header by default (see ``from_header`` and ``from_subdomain``), and the request's sessions
+    are bound to that tenant's engine. Requests without a known tenant get a 404. Elsewhere,
+    bind one explicitly::
+
+        with db.tenant("acme"), db():
+            User.get_all()
+
+    Engines are created on first use and kept in an LRU of ``max_engines``; evicted engines
+    are disposed once their last request is done. ``max_connections`` caps the connections
+    open over every tenant, see ``ConnectionBudget``. ``engine_args`` apply to each tenant.
+    """
+
+    def __init__(
+        self,
+        tenant_url: Optional[TenantURLs] = None,
+        *,
+        async_tenant_url: Optional[TenantURLs] = None,
+        resolver: Optional[TenantResolver] = None,
+        max_engines: int = 32,
+        max_connections: Optional[int] = None,
+        **kwargs: Any,
+    ):
+        if max_engines < 1:
+            raise ValueError("max_engines must be at least 1.")
+        self.tenant_url = tenant_url
+        self.async_tenant_url = async_tenant_url
+        self.resolver: TenantResolver = resolver or from_header()
+        self.max_engines = max_engines
+        self.max_connections = max_connections
+        self.tenant_stats: Counter = Counter()
+        self.connection_budget: Optional[ConnectionBudget] = None
+        self._tenants: OrderedDict[Hashable, TenantEngines] = OrderedDict()
+        self._tenants_lock = threading.RLock()
+        self._current: ContextVar[Optional[TenantEngines]] = ContextVar(
+            f"fastapi_sqlalchemy.tenant.{id(self)}", default=None
+        )
+        self._disposals: set = set()
+        super().__init__(**kwargs)
+        if self.tenant_url is not None:
+            self.init()
+
+    def init(self, tenant_url: Optional[TenantURLs] = None, **options: Any) -> None:
+        if tenant_url is not None:
+            self.tenant_url = tenant_url
+        for key, value in options.items():
+            if hasattr(self, key):
+                setattr(self, key, value)
+            else:
+                raise AttributeError(f"Attribute {key} not a valid attribute.")
+        if self.tenant_url is None:
+            raise ValueError("You need to pass a tenant_url parameter.")
+        if self.async_ and self.async_tenant_url is None:
+            raise ValueError("You need to pass a async_tenant_url parameter.")
+        if self.initiated:
+            self.dispose()
+        if self.max_connections is not None:
+            self.connection_budget = ConnectionBudget(
+                self.max_connections, self.engine_args.get("pool_timeout", 30), self._reclaim
+            )
+        self.initiated = True
+        self.metadata = False
+
+    @staticmethod
+    def _lookup(urls: TenantURLs, tenant: Hashable) -> Union[URL, str]:
+        url = urls.get(tenant) if isinstance(urls, Mapping) else urls(tenant)
+        if url is None:
+            raise UnknownTenant(tenant)
+        return url
+
+    def _load(self, tenant: Hashable) -> TenantEngines:
+        url = self._lookup(self.tenant_url, tenant)
+        engine = create_engine(url, **self._engine_args(url, self.engine_args))
+        async_engine = None
+        if self.async_:
+            async_url = self._lookup(self.async_tenant_url, tenant)
+            async_engine = _asyncio_ext().create_async_engine(
+                async_url, **self._engine_args(async_url, self.async_engine_args)
+            )
+        entry = TenantEngines(tenant, engine, async_engine)
+        for sync_engine in entry.sync_engines():
+            self._install_tenant_hooks(sync_engine)
+        if self.blocking_detector is not None:
+            self.blocking_detector.install(engine)
+        session_args = self.sync_session_args
+        if self.memoize:
+            session_args = _memo_session_args(session_args, "class_")
+        entry.sync_session_maker = sessionmaker(bind=engine, **session_args)
+        if self.async_:
+            async_session_args = self.async_session_args
+            if self.memoize:
+                async_session_args = _memo_session_args(async_session_args, "sync_session_class")
+            entry.async_session_maker = _asyncio_ext().async_sessionmaker(
+                bind=async_engine, **async_session_args
+            )
+        if self.metadata:
+            self._Base.metadata.create_all(engine)
+        self.tenant_stats["loaded"] += 1
+        return entry
+
+    def _install_tenant_hooks(self, engine: Engine) -> None:
+        forking.install(engine)
+        if self.statement_timeouts:
+            deadlines.install(engine)
+        if self.tracing is not None:
+            self.tracing.install(engine)
+        if self.sqlite_profile and engine.dialect.name == "sqlite":
+            self.sqlite_writer_locks[engine] = sqlite.install(engine, self.sqlite_profile)
+        if self.connection_budget is not None:
+            self.connection_budget.install(engine)
+
+    def _hit(self, tenant: Hashable) -> Optional[TenantEngines]:
+        """The loaded entry of ``tenant``, now in use, or None; called under the lock."""
+        entry = self._tenants.get(tenant)
+        if entry is not None:
+            self._tenants.move_to_end(tenant)
+            self.tenant_stats["hits"] += 1
+            entry.users += 1
+        return entry
+
+    def _cached(self, tenant: Hashable) -> Optional[TenantEngines]:
+        with self._tenants_lock:
+            return self._hit(tenant)
+
+    def _acquire(self, tenant: Hashable) -> TenantEngines:
+        entry = self._cached(tenant)
+        if entry is not None:
+            return entry
+        # Built outside the lock, so that first hits on other tenants are not serialised.
+        loaded: Optional[TenantEngines] = self._load(tenant)
+        with self._tenants_lock:
+            entry = self._hit(tenant)
+            if entry is None:
+                entry = self._tenants[tenant] = loaded
+                entry.users += 1
+                loaded = None
+            evicted = self._evict(self.max_engines)
+        if loaded is not None:
+            # Another request loaded the tenant meanwhile.
+            self._dispose(loaded)
+        for old in evicted:
+            self._dispose(old)
+        return entry
+
+    def _release(self, entry: TenantEngines) -> None:
+        with self._tenants_lock:
+            entry.users -= 1
+            done = entry.evicted and entry.users == 0
+        if done:
+            self._dispose(entry)
+
+    def _evict(self, keep: int, spare: Optional[Engine] = None) -> List[TenantEngines]:
+        """Drop least recently used tenants down to ``keep``; returns those to dispose now.
+
+        Tenants still serving requests are disposed by their last ``_release``.
+        """
+        unused = []
+        for entry in list(self._tenants.values()):
+            if len(self._tenants) <= keep:
+                break
+            if spare is not None and (entry.users or spare in entry.sync_engines()):
+                continue
+            del self._tenants[entry.tenant]
+            entry.evicted = True
+            self.tenant_stats["evicted"] += 1
+            if entry.users == 0:
+                unused.append(entry)
+        return unused
+
+    def _reclaim(self, engine: Engine) -> None:
+        # Closes the idle connections of every other tenant that is not serving a request.
+        with self._tenants_lock:
+            unused = self._evict(0, spare=engine)
+        for entry in unused:
+            self._dispose(entry)
+
+    def _dispose(self, entry: TenantEngines) -> None:
+        entry.engine.dispose()
+        self._forget(entry.engine)
+        if entry.async_engine is None:
+            return
+        sync_engine = entry.async_engine.sync_engine
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Closing async connections needs their loop, just drop the pool.
+            sync_engine.dispose(close=False)
+            self._forget(sync_engine)
+            return
+        task = loop.create_task(entry.async_engine.dispose())
+        self._disposals.add(task)
+        task.add_done_callback(self._disposals.discard)
+        task.add_done_callback(lambda _: self._forget(sync_engine))
+
+    def _forget(self, engine: Engine) -> None:
+        if self.connection_budget is not None:
+            self.connection_budget.forget(engine)
+
+    @contextmanager
+    def tenant(self, tenant: Hashable) -> Iterator[TenantSQLAlchemy]:
+        """Bind sessions opened in the block to the database of ``tenant``."""
+        if not self.initiated:
+            raise SessionNotInitialisedError
+        with self._bound_to(self._acquire(tenant)):
+            yield self
+
+    @contextmanager
+    def _bound_to(self, entry: TenantEngines) -> Iterator[None]:
+        token = self._current.set(entry)
+        try:
+            yield
+        finally:
+            self._current.reset(token)
+            self._release(entry)
+
+    def _request_tenant(self, request: Any) -> Hashable:
+        tenant = self.resolver(request)
+        if tenant is None:
+            raise UnknownTenant()
+        return tenant
+
+    def bind_request(self, request: Any):
+        return self.tenant(self._request_tenant(request))
+
+    @asynccontextmanager
+    async def abind_request(self, request: Any) -> AsyncIterator[TenantSQLAlchemy]:
+        # Loading a tenant creates its engines and maybe its tables: keep that off the loop.
+        if not self.initiated:
+            raise SessionNotInitialisedError
+        tenant = self._request_tenant(request)
+        entry = self._cached(tenant) or await asyncio.to_thread(self._acquire, tenant)
+        with self._bound_to(entry):
+            yield self
+
+    @property
+    def current_tenant(self) -> Optional[Hashable]:
+        entry = self._current.get()
+        return entry.tenant if entry is not None else None
+
+    @property
+    def tenants(self) -> List[Hashable]:
+        """Tenants with a loaded engine, least recently used first."""
+        with self._tenants_lock:
+            return list(self._tenants)
+
+    def _bound(self) -> TenantEngines:
+        entry = self._current.get()
+        if entry is None:
+            raise UnknownTenant()
+        return entry
+
+    @property
+    def engine(self) -> Engine:
+        return self._bound().engine
+
+    @property
+    def async_engine(self) -> Any:
+        return self._bound().async_engine
+
+    @property
+    def sync_session_maker(self) -> sessionmaker:
+        return self._bound().sync_session_maker
+
+    @property
+    def async_session_maker(self) -> Any:
+        return self._bound().async_session_maker
+
+    def reconfigure(self, tenant_url: Optional[TenantURLs] = None, **options: Any) -> None:
+        """Switch to a new ``tenant_url`` while the application runs.
+
+        Also takes ``async_tenant_url``, ``engine_args`` and ``async_engine_args``. Every
+        loaded tenant is evicted: tenants serving requests keep their engines until the last
+        one is done, the others are disposed now. Engines are then built from the new
+        configuration on first use.
+        """
+        _check_reconfigurable(options, TENANT_RECONFIGURABLE)
+        if tenant_url is not None:
+            options["tenant_url"] = tenant_url
+        for key in ("engine_args", "async_engine_args"):
+            if key in options:
+                options[key] = options[key] or {}
+        with self._reconfigure_lock:
+            if not self.initiated:
+                self.init(**options)
+                return
+            if self.async_ and options.get("async_tenant_url", self.async_tenant_url) is None:
+                raise ValueError("You need to pass a async_tenant_url parameter.")
+            with self._tenants_lock:
+                for key, value in options.items():
+                    setattr(self, key, value)
+                unused = self._evict(0)
+        for entry in unused:
+            self._dispose(entry)
+
+    def _admission_capacity(self) -> Optional[int]:
+        # The pools of loaded tenants come and go, only the overall budget bounds connections.
+        return self.max_connections
+
+    def _engines(self) -> List[Engine]:
+        with self._tenants_lock:
+            return [entry.engine for entry in self._tenants.values()]
+
+    def _all_engines(self) -> List[Engine]:
+        with self._tenants_lock:
+            return [engine for entry in self._tenants.values() for engine in entry.sync_engines()]
+
+    def _release_engines(self) -> List[Any]:
+        with self._tenants_lock:
+            entries = list(self._tenants.values())
+            self._tenants.clear()
+            for entry in entries:
+                entry.evicted = True
+            # Tenants serving requests are disposed by their last _release, see _evict.
+            idle = [entry for entry in entries if entry.users == 0]
+        unused = []
+        for entry in idle:
+            unused.append(entry.engine)
+            if entry.async_engine is not None:
+                unused.append(entry.async_engine)
+        return unused
+
+    def _forget_engines(self) -> None:
+        self.initiated = False
@@ -0,0 +1,206 @@
+"""Pytest fixtures running every test in a transaction that is rolled back at teardown.
+
+Enable them in ``conftest.py`` and point them at the application's instance::
+
+    pytest_plugins = ["fastapi_sqlalchemy.testing"]
+
+
+    @pytest.fixture(scope="session")
+    def sqlalchemy_db():
+        from app.database import db
+
+        return db
+
+then request ``sqlalchemy_transaction`` in tests (or make it autouse). The schema is created
+once per test session. Each test runs inside an outer transaction, sessions opened by
+``DBSessionMiddleware`` or ``with db():`` join it with a savepoint, so that their commits,
+including those of ``save()`` and ``new()``, only release the savepoint, and everything is
+rolled back when the test ends.
+
+File SQLite databases are not created per session: the schema is built once into a template
+file next to the database, keyed by a hash of the schema, and copied for each pytest-xdist
+worker, which then uses its own file.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import Any, Iterator, Optional
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.engine.url import URL, make_url
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from .extensions import SQLAlchemy
+from .sqlite import is_memory, is_sqlite
+
+
+def worker_id() -> str:
+    """The pytest-xdist worker running the tests, "master" without xdist."""
+    return os.environ.get("PYTEST_XDIST_WORKER", "master")
+
+
+def _sqlite_begin(conn: Connection) -> None:
+    conn.exec_driver_sql("BEGIN")
+
+
+def _sqlite_connect(dbapi_connection, connection_record) -> None:
+    dbapi_connection.isolation_level = None
+
+
+def sqlite_savepoints(engine: Engine) -> bool:
+    """Let SQLAlchemy emit BEGIN itself, pysqlite's own transaction handling breaks SAVEPOINT.
+
+    Returns True if the engine was changed; connections already in its pool keep the old
+    behaviour, dispose it then.
+    """
+    if engine.dialect.name != "sqlite" or event.contains(engine, "begin", _sqlite_begin):
+        return False
+    event.listen(engine, "connect", _sqlite_connect)
+    event.listen(engine, "begin", _sqlite_begin)
+    return True
+
+
+def schema_digest(db: SQLAlchemy, dialect: Any) -> str:
+    ddl = []
+    for table in db.Base.metadata.sorted_tables:
+        ddl.append(str(CreateTable(table).compile(dialect=dialect)))
+        ddl.extend(str(CreateIndex(index).compile(dialect=dialect)) for index in table.indexes)
+    return hashlib.sha1("\n".join(ddl).encode()).hexdigest()[:12]
+
+
+def sqlite_template(db: SQLAlchemy, url: URL) -> str:
+    """Build, unless it exists, a SQLite file holding the schema of ``db``; returns its path.
+
+    Workers may race to build it: each builds its own copy and moves it in place atomically.
+    """
+    stem, _ = os.path.splitext(os.path.abspath(url.database))
+    path = f"{stem}.{schema_digest(db, url.get_dialect()())}.template.db"
+    if os.path.exists(path):
+        return path
+    fd, building = tempfile.mkstemp(suffix=".db", dir=os.path.dirname(path))
+    os.close(fd)
+    engine = create_engine(url.set(database=building))
+    try:
+        db.Base.metadata.create_all(engine)
+    finally:
+        engine.dispose()
+    os.replace(building, path)
+    return path
+
+
+def _worker_url(url: URL, worker: str) -> URL:
+    stem, ext = os.path.splitext(url.database)
+    return url.set(database=f"{stem}.{worker}{ext or '.db'}")
+
+
+def create_schema(db: SQLAlchemy, worker: Optional[str] = None) -> Optional[str]:
+    """Create the schema of ``db`` for a test session.
+
+    File SQLite databases are cloned from the template into a file of their own for
+    ``worker``, whose path is returned; ``db`` is re-initialised to use it. Other databases
+    get ``create_all()``.
+    """
+    url = make_url(db.url) if db.url is not None else None
+    if db.custom_engine is None and is_sqlite(url) and not is_memory(url):
+        worker_url = _worker_url(url, worker or worker_id())
+        shutil.copyfile(sqlite_template(db, url), worker_url.database)
+        options = {}
+        if db.async_url is not None and is_sqlite(db.async_url):
+            options["async_url"] = make_url(db.async_url).set(database=worker_url.database)
+        db.init(url=worker_url, **options)
+        db.metadata = True
+        return worker_url.database
+    db.create_all()
+    return None
+
+
+class TestTransaction:
+    """Runs sessions of ``db`` in one transaction rolled back on exit, see the module docstring.
+
+    ``with`` swaps the sync sessionmaker, ``async with`` the async one as well.
+    """
+
+    __test__ = False  # not a test class despite the name
+
+    def __init__(self, db: SQLAlchemy):
+        self.db = db
+        self._connection = None
+        self._transaction = None
+        self._async_connection = None
+        self._async_transaction = None
+        self._makers = None
+
+    def _prepare(self) -> None:
+        self.db.create_engines()
+        for engine in self.db._all_engines():
+            if sqlite_savepoints(engine):
+                engine.dispose()
+        self._makers = (self.db.sync_session_maker, self.db.async_session_maker)
+
+    def __enter__(self) -> SQLAlchemy:
+        self._prepare()
+        self._connection = self.db.engine.connect()
+        self._transaction = self._connection.begin()
+        maker = self.db._make_sync_session_maker()
+        maker.configure(bind=self._connection, join_transaction_mode="create_savepoint")
+        self.db.sync_session_maker = maker
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            self._transaction.rollback()
+            self._connection.close()
+        finally:
+            self.db.sync_session_maker, self.db.async_session_maker = self._makers
+
+    async def __aenter__(self) -> SQLAlchemy:
+        self.__enter__()
+        if self.db.async_:
+            self._async_connection = await self.db.async_engine.connect()
+            self._async_transaction = await self._async_connection.begin()
+            maker = self.db._make_async_session_maker()
+            maker.configure(bind=self._async_connection, join_transaction_mode="create_savepoint")
+            self.db.async_session_maker = maker
+        return self.db
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if self._async_connection is not None:
+                await self._async_transaction.rollback()
+                await self._async_connection.close()
+        finally:
+            self.__exit__(exc_type, exc_value, traceback)
+
+
+@pytest.fixture(scope="session")
+def sqlalchemy_db() -> SQLAlchemy:
+    """The instance under test, override it in ``conftest.py``."""
+    raise pytest.UsageError(
+        "fastapi_sqlalchemy.testing needs a session scoped `sqlalchemy_db` fixture returning "
+        "the SQLAlchemy instance to test."
+    )
+
+
+@pytest.fixture(scope="session")
+def sqlalchemy_schema(sqlalchemy_db: SQLAlchemy) -> Iterator[SQLAlchemy]:
+    """Creates the schema once per test session (and worker)."""
+    path = create_schema(sqlalchemy_db)
+    yield sqlalchemy_db
+    if path is not None:
+        sqlalchemy_db.dispose()
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+@pytest.fixture
+def sqlalchemy_transaction(sqlalchemy_schema: SQLAlchemy) -> Iterator[SQLAlchemy]:
+    """Rolls back everything the test writes through the sync sessions of the instance."""
+    with TestTransaction(sqlalchemy_schema) as db:
+        yield db
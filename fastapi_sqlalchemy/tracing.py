@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import re
+import time
+import warnings
+from contextvars import ContextVar, Token
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from .blocking import statement_shape
+
+SPAN_KEY = "fastapi_sqlalchemy.span"
+TRANSACTION_SPAN_KEY = "fastapi_sqlalchemy.transaction_span"
+POOL_WAIT_KEY = "fastapi_sqlalchemy.pool_wait"
+
+# Literals left in the SQL text, e.g. by literal_binds; bound parameters are never recorded.
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def statement_attribute(statement: str) -> str:
+    return statement_shape(_LITERALS.sub("?", statement), limit=1000)
+
+
+class RecordedSpan:
+    def __init__(self, name: str, parent: Optional[RecordedSpan], attributes: Dict[str, Any]):
+        self.name = name
+        self.parent = parent
+        self.attributes = dict(attributes)
+        self.start = time.perf_counter()
+        self.end_time: Optional[float] = None
+        self.error: Optional[BaseException] = None
+
+    @property
+    def duration(self) -> Optional[float]:
+        return None if self.end_time is None else self.end_time - self.start
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def __repr__(self) -> str:
+        return f"<RecordedSpan {self.name} {self.attributes}>"
+
+
+class InMemoryTracer:
+    """Keeps finished spans in ``spans``, for tests and when OpenTelemetry is not installed."""
+
+    def __init__(self):
+        self.spans: List[RecordedSpan] = []
+        self._current: ContextVar[Optional[RecordedSpan]] = ContextVar(
+            "fastapi_sqlalchemy.current_span", default=None
+        )
+
+    def start(
+        self, name: str, parent: Optional[RecordedSpan] = None, attributes: Dict[str, Any] = None
+    ) -> RecordedSpan:
+        return RecordedSpan(name, parent or self._current.get(), attributes or {})
+
+    def activate(self, span: RecordedSpan) -> Token:
+        return self._current.set(span)
+
+    def deactivate(self, token: Token) -> None:
+        self._current.reset(token)
+
+    def end(self, span: RecordedSpan, error: Optional[BaseException] = None) -> None:
+        span.end_time = time.perf_counter()
+        span.error = error
+        self.spans.append(span)
+
+    def named(self, name: str) -> List[RecordedSpan]:
+        return [span for span in self.spans if span.name == name]
+
+
+class OpenTelemetryTracer:
+    """Adapts an OpenTelemetry tracer, spans are parented under the current span."""
+
+    def __init__(self, tracer: Any = None):
+        from opentelemetry import context, trace
+
+        self._context = context
+        self._trace = trace
+        self.tracer = tracer or trace.get_tracer("fastapi_sqlalchemy")
+
+    def start(self, name: str, parent: Any = None, attributes: Dict[str, Any] = None) -> Any:
+        ctx = self._trace.set_span_in_context(parent) if parent is not None else None
+        return self.tracer.start_span(
+            name, context=ctx, kind=self._trace.SpanKind.CLIENT, attributes=attributes
+        )
+
+    def activate(self, span: Any) -> Any:
+        return self._context.attach(self._trace.set_span_in_context(span))
+
+    def deactivate(self, token: Any) -> None:
+        self._context.detach(token)
+
+    def end(self, span: Any, error: Optional[BaseException] = None) -> None:
+        if error is not None:
+            span.record_exception(error)
+            span.set_status(self._trace.Status(self._trace.StatusCode.ERROR, str(error)))
+        span.end()
+
+
+def default_tracer() -> Optional[OpenTelemetryTracer]:
+    try:
+        return OpenTelemetryTracer()
+    except ImportError:
+        warnings.warn("opentelemetry-api is not installed, tracing is disabled.")
+        return None
+
+
+class Tracing:
+    """Emits spans for the sessions, transactions, commits and statements of an instance.
+
+    ``db.session`` spans cover a ``DBSessionMiddleware`` or ``with db():`` session and parent
+    the others: ``db.transaction`` from BEGIN to COMMIT or ROLLBACK on a connection, with the
+    time spent waiting for it in the pool; ``db.commit`` for ``session.commit()``, flush
+    included; and one span per statement, named after its operation, with the statement
+    shape and row count. Parameters are never recorded.
+    """
+
+    def __init__(self, tracer: Any):
+        self.tracer = tracer
+
+    def install(self, engine: Engine) -> None:
+        if event.contains(engine, "before_cursor_execute", self._before_cursor_execute):
+            return
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(engine, "handle_error", self._handle_error)
+        event.listen(engine, "begin", self._begin)
+        event.listen(engine, "commit", self._commit)
+        event.listen(engine, "rollback", self._rollback)
+        event.listen(engine, "engine_disposed", self._time_pool)
+        self._time_pool(engine)
+
+    # Sessions.
+
+    def start_session(self, db: Any, session: Session) -> Tuple[Any, Any]:
+        bind = db.engine
+        span = self.tracer.start(
+            "db.session", attributes={"db.system": bind.dialect.name, "db.async": db.async_}
+        )
+        token = self.tracer.activate(span)
+        event.listen(session, "before_commit", self._before_commit)
+        event.listen(session, "after_commit", self._after_commit)
+        event.listen(session, "after_rollback", self._after_rollback)
+        return span, token
+
+    def end_session(self, state: Tuple[Any, Any], error: Optional[BaseException]) -> None:
+        span, token = state
+        self.tracer.deactivate(token)
+        self.tracer.end(span, error)
+
+    def _before_commit(self, session: Session) -> None:
+        session.info[SPAN_KEY] = self.tracer.start("db.commit")
+
+    def _after_commit(self, session: Session) -> None:
+        span = session.info.pop(SPAN_KEY, None)
+        if span is not None:
+            self.tracer.end(span)
+
+    def _after_rollback(self, session: Session) -> None:
+        # A failed commit, e.g. a constraint violated by the flush.
+        span = session.info.pop(SPAN_KEY, None)
+        if span is not None:
+            span.set_attribute("db.commit.failed", True)
+            self.tracer.end(span)
+
+    # Connections.
+
+    def _time_pool(self, engine: Engine) -> None:
+        # Pools have no event before a checkout, so wrap connect(); again once disposed, as
+        # dispose() replaces the pool.
+        pool = engine.pool
+        connect = pool.connect
+
+        def timed_connect():
+            start = time.perf_counter()
+            connection = connect()
+            connection.info[POOL_WAIT_KEY] = time.perf_counter() - start
+            return connection
+
+        pool.connect = timed_connect
+
+    def _begin(self, conn) -> None:
+        attributes = {"db.system": conn.dialect.name}
+        wait = conn.info.pop(POOL_WAIT_KEY, None)
+        if wait is not None:
+            attributes["db.pool.wait_ms"] = wait * 1000
+        conn.info[TRANSACTION_SPAN_KEY] = self.tracer.start("db.transaction", attributes=attributes)
+
+    def _end_transaction(self, conn, outcome: str) -> None:
+        span = conn.info.pop(TRANSACTION_SPAN_KEY, None)
+        if span is not None:
+            span.set_attribute("db.transaction.outcome", outcome)
+            self.tracer.end(span)
+
+    def _commit(self, conn) -> None:
+        self._end_transaction(conn, "commit")
+
+    def _rollback(self, conn) -> None:
+        self._end_transaction(conn, "rollback")
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "SQL"
+        attributes = {
+            "db.system": conn.dialect.name,
+            "db.operation": operation,
+            "db.statement": statement_attribute(statement),
+        }
+        if executemany:
+            attributes["db.executemany"] = True
+        parent = conn.info.get(TRANSACTION_SPAN_KEY)
+        context._fastapi_sqlalchemy_span = self.tracer.start(operation, parent, attributes)
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        span = getattr(context, "_fastapi_sqlalchemy_span", None)
+        if span is None:
+            return
+        context._fastapi_sqlalchemy_span = None
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            span.set_attribute("db.response.rows", cursor.rowcount)
+        self.tracer.end(span)
+
+    def _handle_error(self, exception_context) -> None:
+        context = exception_context.execution_context
+        span = getattr(context, "_fastapi_sqlalchemy_span", None)
+        if span is not None:
+            context._fastapi_sqlalchemy_span = None
+            self.tracer.end(span, exception_context.original_exception)
@@ -1,31 +1,161 @@
 from __future__ import annotations
 
-import ast
-import asyncio
-import inspect
-from typing import Any, Awaitable, Callable, Coroutine, List, Optional, Self, Union, overload
-
-from curio.meta import from_coroutine
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import DeclarativeMeta as DeclarativeMeta_
-from sqlalchemy.orm import Query, Session, aliased
+import sys
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Mapping,
+    Optional,
+    Self,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from sqlalchemy import Row, Select, delete, func, literal_column, select, update
+from sqlalchemy.inspection import inspect as sa_inspect
+from sqlalchemy.orm import (
+    Query,
+    Session,
+    defaultload,
+    defer,
+    immediateload,
+    joinedload,
+    lazyload,
+    load_only,
+    noload,
+    object_session,
+    raiseload,
+    selectinload,
+    subqueryload,
+)
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.sql import ColumnExpressionArgument
 
-from .decorators import awaitable
+from . import importing, serializers
+from .prefetch import CallSite
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+SynchronizeSession = Literal["auto", "evaluate", "fetch", False]
+
+Columns = Union[str, Iterable[str], None]
+
+AGGREGATES: Dict[str, Callable] = {
+    "sum": func.sum,
+    "avg": func.avg,
+    "min": func.min,
+    "max": func.max,
+}
+
+LOADER_STRATEGIES: Dict[str, Callable] = {
+    "selectin": selectinload,
+    "joined": joinedload,
+    "subquery": subqueryload,
+    "immediate": immediateload,
+    "lazy": lazyload,
+    "raise": raiseload,
+    "noload": noload,
+}
+
+
+def _under(path: str, load: Mapping[str, str]) -> bool:
+    """Whether ``path`` or one of its prefixes is a key of ``load``."""
+    names = path.split(".")
+    return any(".".join(names[:depth]) in load for depth in range(1, len(names) + 1))
+
+
+def _loader_options(
+    cls,
+    only: Optional[Iterable[str]] = None,
+    defer_: Optional[Iterable[str]] = None,
+    load: Optional[Mapping[str, str]] = None,
+) -> list:
+    """Translate the ``only``/``defer``/``load`` arguments into ORM loader options.
+
+    ``only`` and ``defer`` take column attribute names; ``load`` maps relationship paths
+    (dotted for nested relationships, e.g. ``"posts.comments"``) to a strategy name.
+    """
+    options = []
+    if only:
+        options.append(load_only(*(getattr(cls, name) for name in only)))
+    if defer_:
+        options.extend(defer(getattr(cls, name)) for name in defer_)
+    load = load or {}
+    for path in load:
+        # Segments before the leaf keep the strategy given for their own path, if any, so that
+        # the options of "posts" and "posts.comments" never conflict.
+        names = path.split(".")
+        option = None
+        entity = cls
+        for depth, name in enumerate(names, 1):
+            prefix = ".".join(names[:depth])
+            loader = _loader(load[prefix]) if prefix in load else defaultload
+            attr = getattr(entity, name)
+            option = loader(attr) if option is None else getattr(option, loader.__name__)(attr)
+            entity = attr.property.mapper.class_
+        options.append(option)
+    return options
+
+
+def _loader(strategy: str) -> Callable:
+    try:
+        return LOADER_STRATEGIES[strategy]
+    except KeyError:
+        raise ValueError(
+            f"Unknown loading strategy {strategy!r}, expected one of {list(LOADER_STRATEGIES)}"
+        ) from None
+
+
+def _scalars(result: Any, load: Optional[Mapping[str, str]]) -> Any:
+    # Joined eager loads of collections repeat the parent rows, the ORM wants them de-duplicated.
+    if load and "joined" in load.values():
+        result = result.unique()
+    return result.scalars()
+
+
+def _memo_key(cls, method: str, criterion, kwargs, only, defer_, load) -> tuple:
+    clauses = []
+    for clause in criterion:
+        compiled = clause.compile()
+        clauses.append((str(compiled), repr(sorted(compiled.params.items()))))
+    return (
+        cls,
+        method,
+        tuple(clauses),
+        repr(sorted(kwargs.items())),
+        tuple(only or ()),
+        tuple(defer_ or ()),
+        repr(sorted((load or {}).items())),
+    )
+
+
+def _names(columns: Columns) -> List[str]:
+    if columns is None:
+        return []
+    if isinstance(columns, str):
+        return [columns]
+    return list(columns)
 
 
 class ModelBase(object):
-    query: Query
+    """Attributes shared by every model; the query API lives in SyncModelBase/AsyncModelBase.
+
+    Models declared on ``db.Base`` get one of the two mixed in by the declarative metaclass,
+    depending on whether their SQLAlchemy instance was created with ``async_=True``.
+    """
+
     session: Session | AsyncSession
 
-    def __new__(cls, *args, **kwargs):
-        obj = super().__new__(cls)
-        if isinstance(obj.db.session, AsyncSession):
-            obj.query = cls.db.sync_session.query(cls)
-        else:
-            obj.query = cls.db.session.query(cls)
-        return obj
+    @property
+    def query(self) -> Query:
+        return self.db.sync_session.query(type(self))
 
     @property
     def session(self) -> Session | AsyncSession:
@@ -35,88 +165,462 @@ class ModelBase(object):
     def sync_session(self) -> Session:
         return self.db.sync_session
 
-    async def new(cls, **kwargs) -> Self:
-        obj: Self = cls(**kwargs)
-        await obj.save()
-        return obj
+    @classmethod
+    def _filter(cls, stmt: Select, criterion, kwargs: Dict[str, Any]) -> Select:
+        if criterion:
+            return stmt.filter(*criterion)
+        return stmt.filter_by(**kwargs)
 
     @classmethod
-    @awaitable(new)
-    def new(cls: Self, **kwargs) -> Union[Coroutine[Any, Any, Self], Self]:
+    def _select(
+        cls,
+        criterion: Tuple[ColumnExpressionArgument[bool], ...],
+        kwargs: Dict[str, Any],
+        only: Optional[Iterable[str]] = None,
+        defer: Optional[Iterable[str]] = None,
+        load: Optional[Mapping[str, str]] = None,
+        site: Optional[CallSite] = None,
+    ) -> Select:
+        stmt = cls._filter(select(cls), criterion, kwargs)
+        stmt = stmt.options(*_loader_options(cls, only, defer, load))
+        return stmt if site is None else stmt.options(site)
+
+    @classmethod
+    def _prefetch(
+        cls,
+        method: str,
+        load: Optional[Mapping[str, str]],
+        prefetch: Optional[Iterable[str]],
+    ) -> Tuple[Optional[Mapping[str, str]], Optional[CallSite]]:
+        """Add the ``prefetch`` paths to ``load`` as selectin loads.
+
+        When no paths are given and adaptive prefetching is on, use the paths learned for the
+        caller of ``method``, leaving out those at or below a path the caller set in ``load``.
+        The returned option then records the lazy loads of the results.
+        """
+        site = None
+        adaptive = cls.db.adaptive_prefetch
+        if prefetch is None and adaptive is not None:
+            site = adaptive.call(cls, method, sys._getframe(2))
+            prefetch = site.stats.prefetch
+            if prefetch and load:
+                prefetch = [path for path in prefetch if not _under(path, load)]
+        if not prefetch:
+            return load, site
+        merged = dict.fromkeys(prefetch, "selectin")
+        merged.update(load or {})
+        return merged, site
+
+    @classmethod
+    def _count_stmt(cls, criterion, kwargs: Dict[str, Any]) -> Select:
+        return cls._filter(select(func.count()).select_from(cls), criterion, kwargs)
+
+    @classmethod
+    def _exists_stmt(cls, criterion, kwargs: Dict[str, Any]) -> Select:
+        return select(
+            cls._filter(select(literal_column("1")).select_from(cls), criterion, kwargs).exists()
+        )
+
+    @classmethod
+    def _aggregate_stmt(
+        cls,
+        criterion,
+        kwargs: Dict[str, Any],
+        group_by: Columns,
+        count: bool,
+        **aggregates: Columns,
+    ) -> Select:
+        """``SELECT <group_by>, <aggregates> .. GROUP BY <group_by>``.
+
+        Group columns keep their attribute name, aggregates are labelled ``<function>_<name>``
+        (e.g. ``sum_amount``) and the row count, when ``count`` is True, ``count``.
+        """
+        group_columns = [getattr(cls, name).label(name) for name in _names(group_by)]
+        columns = list(group_columns)
+        for function, names in aggregates.items():
+            columns.extend(
+                AGGREGATES[function](getattr(cls, name)).label(f"{function}_{name}")
+                for name in _names(names)
+            )
+        if count:
+            columns.append(func.count().label("count"))
+        if len(columns) == len(group_columns):
+            raise ValueError("aggregate() needs at least one of sum, avg, min, max or count.")
+        stmt = cls._filter(select(*columns).select_from(cls), criterion, kwargs)
+        if group_columns:
+            stmt = stmt.group_by(*(getattr(cls, name) for name in _names(group_by)))
+        return stmt
+
+    @staticmethod
+    def _require_criterion(method: str, criterion, all: bool) -> None:
+        # Keyword arguments are the new values, an empty criterion would change every row.
+        if not criterion and not all:
+            raise ValueError(f"{method}() needs a criterion, pass all=True to change every row.")
+
+    @classmethod
+    def _update_stmt(cls, criterion, values: Dict[str, Any], synchronize_session, returning: bool):
+        stmt = (
+            update(cls)
+            .where(*criterion)
+            .values(**values)
+            .execution_options(synchronize_session=synchronize_session)
+        )
+        # Versioned rows changed in bulk must look stale to sessions that loaded them before.
+        version = sa_inspect(cls).version_id_col
+        if version is not None and version.key not in values:
+            stmt = stmt.values({version: version + 1})
+        return stmt.returning(cls) if returning else stmt
+
+    @classmethod
+    def _delete_stmt(cls, criterion, synchronize_session, returning: bool):
+        stmt = (
+            delete(cls).where(*criterion).execution_options(synchronize_session=synchronize_session)
+        )
+        return stmt.returning(cls) if returning else stmt
+
+    def _has_changes(self) -> bool:
+        """False only for a persistent instance none of whose attributes changed value."""
+        state = sa_inspect(self)
+        if not state.persistent:
+            return True
+        return any(attr.history.has_changes() for attr in state.attrs)
+
+    def to_dict(self, fields: Optional[Iterable[str]] = None, depth: int = 0) -> dict:
+        return serializers.to_dict(self, fields, depth)
+
+    def serialize(self, fields: Optional[Iterable[str]] = None, depth: int = 0) -> bytes:
+        return serializers.dumps(serializers.to_dict(self, fields, depth))
+
+    @classmethod
+    def serialize_many(
+        cls, objs: Sequence[Self], fields: Optional[Iterable[str]] = None, depth: int = 0
+    ) -> bytes:
+        return serializers.serialize_many(objs, fields, depth)
+
+
+class SyncModelBase(ModelBase):
+    @classmethod
+    def new(cls, **kwargs) -> Self:
         obj: Self = cls(**kwargs)
         obj.save()
         return obj
 
-    async def get_all(cls, *criterion: ColumnExpressionArgument[bool], **kwargs: Any) -> List[Self]:
-        if criterion:
-            stmt = select(cls).filter(*criterion)
-        else:
-            stmt = select(cls).filter_by(**kwargs)
-        result = await cls.session.execute(stmt)
-        objs = result.scalars().all()
+    @classmethod
+    def get_all(
+        cls,
+        *criterion: ColumnExpressionArgument[bool],
+        only: Optional[Iterable[str]] = None,
+        defer: Optional[Iterable[str]] = None,
+        load: Optional[Mapping[str, str]] = None,
+        prefetch: Optional[Iterable[str]] = None,
+        **kwargs: Any,
+    ) -> List[Self]:
+        load, site = cls._prefetch("get_all", load, prefetch)
+        session = cls.db.sync_session
+        memo = cls.db.memo_for(session)
+        if memo is not None:
+            key = _memo_key(cls, "get_all", criterion, kwargs, only, defer, load)
+            if key in memo:
+                return list(memo[key])
+        result = session.execute(cls._select(criterion, kwargs, only, defer, load, site))
+        objs = _scalars(result, load).all()
+        if memo is not None:
+            memo[key] = tuple(objs)
         return objs
 
     @classmethod
-    @awaitable(get_all)
-    def get_all(
-        cls, *criterion: ColumnExpressionArgument[bool], **kwargs: Any
-    ) -> Union[List[Self], Coroutine[Any, Any, List[Self]]]:
-        if criterion:
-            lst: List[Self] = cls.query.filter(*criterion, **kwargs).all()
-        else:
-            lst: List[Self] = cls.query.filter_by(**kwargs).all()
-        return lst
+    def get(
+        cls,
+        *criterion: ColumnExpressionArgument[bool],
+        only: Optional[Iterable[str]] = None,
+        defer: Optional[Iterable[str]] = None,
+        load: Optional[Mapping[str, str]] = None,
+        prefetch: Optional[Iterable[str]] = None,
+        **kwargs: Any,
+    ) -> Optional[Self]:
+        load, site = cls._prefetch("get", load, prefetch)
+        session = cls.db.sync_session
+        memo = cls.db.memo_for(session)
+        if memo is not None:
+            key = _memo_key(cls, "get", criterion, kwargs, only, defer, load)
+            if key in memo:
+                return memo[key]
+        result = session.execute(cls._select(criterion, kwargs, only, defer, load, site))
+        obj = _scalars(result, load).first()
+        if memo is not None:
+            memo[key] = obj
+        return obj
 
-    async def get(cls, *criterion: ColumnExpressionArgument[bool], **kwargs: Any) -> Self:
-        if criterion:
-            result = await cls.session.execute(select(cls).filter(*criterion))
-        else:
-            result = await cls.session.execute(select(cls).filter_by(**kwargs))
-        return result.scalars().first()
+    @classmethod
+    def count(cls, *criterion: ColumnExpressionArgument[bool], **kwargs: Any) -> int:
+        """Number of matching rows, counted by the database."""
+        return cls.db.sync_session.execute(cls._count_stmt(criterion, kwargs)).scalar_one()
 
     @classmethod
-    @awaitable(get)
-    def get(
-        cls, *criterion: ColumnExpressionArgument[bool], **kwargs: Any
-    ) -> Union[Coroutine[Any, Any, Self], Self]:
-        if criterion:
-            return cls.query.filter(*criterion, **kwargs).first()
-        return cls.query.filter_by(**kwargs).first()
+    def exists(cls, *criterion: ColumnExpressionArgument[bool], **kwargs: Any) -> bool:
+        """Whether any row matches, without loading it."""
+        return cls.db.sync_session.execute(cls._exists_stmt(criterion, kwargs)).scalar_one()
 
-    async def save(self) -> None:
-        t_e = self.session.sync_session.expire_on_commit
-        self.session.expire_on_commit = False
+    @classmethod
+    def aggregate(
+        cls,
+        *criterion: ColumnExpressionArgument[bool],
+        group_by: Columns = None,
+        sum: Columns = None,
+        avg: Columns = None,
+        min: Columns = None,
+        max: Columns = None,
+        count: bool = False,
+        **kwargs: Any,
+    ) -> List[Row]:
+        """Aggregate matching rows in one ``SELECT .. GROUP BY``, returning named tuples.
+
+        ``User.aggregate(group_by="country", sum="balance", count=True)`` returns rows with
+        ``country``, ``sum_balance`` and ``count`` attributes, one per group.
+        """
+        stmt = cls._aggregate_stmt(
+            criterion, kwargs, group_by, count, sum=sum, avg=avg, min=min, max=max
+        )
+        return cls.db.sync_session.execute(stmt).all()
+
+    @classmethod
+    def update_where(
+        cls,
+        *criterion: ColumnExpressionArgument[bool],
+        synchronize_session: SynchronizeSession = "auto",
+        returning: bool = False,
+        all: bool = False,
+        **values: Any,
+    ) -> Union[int, List[Self]]:
+        """Update matching rows with one ``UPDATE`` statement and commit.
+
+        Keyword arguments are the new values, the rows are chosen by ``criterion`` only; pass
+        ``all=True`` instead to update every row. Returns the number of matched rows, or the
+        updated instances when ``returning=True`` (the dialect must support
+        ``UPDATE .. RETURNING``).
+        """
+        cls._require_criterion("update_where", criterion, all)
+        session = cls.db.sync_session
+        result = session.execute(
+            cls._update_stmt(criterion, values, synchronize_session, returning)
+        )
+        rows = result.scalars().all() if returning else result.rowcount
+        session.commit()
+        return rows
+
+    @classmethod
+    def delete_where(
+        cls,
+        *criterion: ColumnExpressionArgument[bool],
+        synchronize_session: SynchronizeSession = "auto",
+        returning: bool = False,
+        all: bool = False,
+    ) -> Union[int, List[Self]]:
+        """Delete matching rows with one ``DELETE`` statement and commit, see update_where."""
+        cls._require_criterion("delete_where", criterion, all)
+        session = cls.db.sync_session
+        result = session.execute(cls._delete_stmt(criterion, synchronize_session, returning))
+        rows = result.scalars().all() if returning else result.rowcount
+        session.commit()
+        return rows
+
+    @classmethod
+    def import_stream(
+        cls,
+        source: importing.Source,
+        format: importing.ImportFormat = "csv",
+        batch_size: int = 1000,
+        **options: Any,
+    ) -> int:
+        """Insert the rows of a CSV or NDJSON stream in batches and commit; returns the count.
+
+        ``source`` is a path (read through mmap) or an iterable of bytes or str chunks, e.g. a
+        file opened in binary mode. It is parsed incrementally and values are coerced to the
+        column types, so memory stays bounded by ``batch_size``. ``options`` are ``encoding``
+        and, for CSV, ``delimiter``. Postgres with psycopg 3 or asyncpg uses COPY.
+        """
+        return importing.import_rows(
+            cls.db.sync_session, cls.__table__, source, format, batch_size, **options
+        )
+
+    @staticmethod
+    def _commit(session: Session) -> None:
         try:
-            self.session.add(self)
-        except:
-            pass
-        await self.session.commit()
-        self.session.sync_session.expire_on_commit = t_e
+            session.commit()
+        except StaleDataError:
+            # A versioned row changed since it was read: drop the stale state, so that the
+            # caller (or retrying_transaction) can load it again.
+            session.rollback()
+            raise
 
-    @awaitable(save)
     def save(self) -> None:
-        try:
-            self.sync_session.add(self)
-        except:
-            pass
-        self.sync_session.commit()
+        session = object_session(self) or self.sync_session
+        session.add(self)
+        self._commit(session)
 
-    async def update(self, **kwargs):
+    def update(self, **kwargs):
         for attr, value in kwargs.items():
             setattr(self, attr, value)
-        await self.save()
+        if self._has_changes():
+            self.save()
 
-    @awaitable(update)
-    def update(self, **kwargs):
+    def delete(self):
+        session = object_session(self) or self.sync_session
+        session.delete(self)
+        self._commit(session)
+
+
+class AsyncModelBase(ModelBase):
+    @classmethod
+    async def new(cls, **kwargs) -> Self:
+        obj: Self = cls(**kwargs)
+        await obj.save()
+        return obj
+
+    @classmethod
+    async def get_all(
+        cls,
+        *criterion: ColumnExpressionArgument[bool],
+        only: Optional[Iterable[str]] = None,
+        defer: Optional[Iterable[str]] = None,
+        load: Optional[Mapping[str, str]] = None,
+        prefetch: Optional[Iterable[str]] = None,
+        **kwargs: Any,
+    ) -> List[Self]:
+        load, site = cls._prefetch("get_all", load, prefetch)
+        session = cls.db.session
+        memo = cls.db.memo_for(session)
+        if memo is not None:
+            key = _memo_key(cls, "get_all", criterion, kwargs, only, defer, load)
+            if key in memo:
+                return list(memo[key])
+        result = await session.execute(cls._select(criterion, kwargs, only, defer, load, site))
+        objs = _scalars(result, load).all()
+        if memo is not None:
+            memo[key] = tuple(objs)
+        return objs
+
+    @classmethod
+    async def get(
+        cls,
+        *criterion: ColumnExpressionArgument[bool],
+        only: Optional[Iterable[str]] = None,
+        defer: Optional[Iterable[str]] = None,
+        load: Optional[Mapping[str, str]] = None,
+        prefetch: Optional[Iterable[str]] = None,
+        **kwargs: Any,
+    ) -> Optional[Self]:
+        load, site = cls._prefetch("get", load, prefetch)
+        session = cls.db.session
+        memo = cls.db.memo_for(session)
+        if memo is not None:
+            key = _memo_key(cls, "get", criterion, kwargs, only, defer, load)
+            if key in memo:
+                return memo[key]
+        result = await session.execute(cls._select(criterion, kwargs, only, defer, load, site))
+        obj = _scalars(result, load).first()
+        if memo is not None:
+            memo[key] = obj
+        return obj
+
+    @classmethod
+    async def count(cls, *criterion: ColumnExpressionArgument[bool], **kwargs: Any) -> int:
+        result = await cls.db.session.execute(cls._count_stmt(criterion, kwargs))
+        return result.scalar_one()
+
+    @classmethod
+    async def exists(cls, *criterion: ColumnExpressionArgument[bool], **kwargs: Any) -> bool:
+        result = await cls.db.session.execute(cls._exists_stmt(criterion, kwargs))
+        return result.scalar_one()
+
+    @classmethod
+    async def aggregate(
+        cls,
+        *criterion: ColumnExpressionArgument[bool],
+        group_by: Columns = None,
+        sum: Columns = None,
+        avg: Columns = None,
+        min: Columns = None,
+        max: Columns = None,
+        count: bool = False,
+        **kwargs: Any,
+    ) -> List[Row]:
+        stmt = cls._aggregate_stmt(
+            criterion, kwargs, group_by, count, sum=sum, avg=avg, min=min, max=max
+        )
+        result = await cls.db.session.execute(stmt)
+        return result.all()
+
+    @classmethod
+    async def update_where(
+        cls,
+        *criterion: ColumnExpressionArgument[bool],
+        synchronize_session: SynchronizeSession = "auto",
+        returning: bool = False,
+        all: bool = False,
+        **values: Any,
+    ) -> Union[int, List[Self]]:
+        cls._require_criterion("update_where", criterion, all)
+        session = cls.db.session
+        result = await session.execute(
+            cls._update_stmt(criterion, values, synchronize_session, returning)
+        )
+        rows = result.scalars().all() if returning else result.rowcount
+        await session.commit()
+        return rows
+
+    @classmethod
+    async def delete_where(
+        cls,
+        *criterion: ColumnExpressionArgument[bool],
+        synchronize_session: SynchronizeSession = "auto",
+        returning: bool = False,
+        all: bool = False,
+    ) -> Union[int, List[Self]]:
+        cls._require_criterion("delete_where", criterion, all)
+        session = cls.db.session
+        result = await session.execute(cls._delete_stmt(criterion, synchronize_session, returning))
+        rows = result.scalars().all() if returning else result.rowcount
+        await session.commit()
+        return rows
+
+    @classmethod
+    async def import_stream(
+        cls,
+        source: importing.Source,
+        format: importing.ImportFormat = "csv",
+        batch_size: int = 1000,
+        **options: Any,
+    ) -> int:
+        """See SyncModelBase.import_stream, ``source`` may also be ``request.stream()``."""
+        return await importing.aimport_rows(
+            cls.db.session, cls.__table__, source, format, batch_size, **options
+        )
+
+    @staticmethod
+    async def _commit(session: AsyncSession) -> None:
+        try:
+            await session.commit()
+        except StaleDataError:
+            await session.rollback()
+            raise
+
+    async def save(self) -> None:
+        from sqlalchemy.ext.asyncio import async_object_session
+
+        session = async_object_session(self) or self.session
+        session.add(self)
+        await self._commit(session)
+
+    async def update(self, **kwargs):
         for attr, value in kwargs.items():
             setattr(self, attr, value)
-        self.save()
+        if self._has_changes():
+            await self.save()
 
     async def delete(self):
-        await self.session.delete(self)
-        await self.session.commit()
+        from sqlalchemy.ext.asyncio import async_object_session
 
-    @awaitable(delete)
-    def delete(self):
-        self.sync_session.delete(self)
-        self.sync_session.commit()
+        session = async_object_session(self) or self.session
+        await session.delete(self)
+        await self._commit(session)
@@ -0,0 +1,376 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import Counter, deque
+from typing import TYPE_CHECKING, Any, Deque, Dict, Iterable, List, Literal, Optional, Tuple
+
+from sqlalchemy import insert
+
+from .retry import is_retryable
+
+if TYPE_CHECKING:
+    from .extensions import SQLAlchemy
+
+logger = logging.getLogger("fastapi_sqlalchemy.writebehind")
+
+OverflowPolicy = Literal["block", "drop", "spill"]
+
+Row = Tuple[float, Dict[str, Any]]
+
+
+class WriteBehind:
+    """Buffers rows of an append-only model and inserts them in the background, in batches.
+
+    ``add(**values)`` (or ``await aadd(**values)`` on async instances) only queues the row. A
+    background thread, or an asyncio task when the instance is async, inserts queued rows with
+    multi-row inserts once ``max_batch`` rows are waiting or the oldest has waited
+    ``max_latency_ms``. Rows are written outside of any request session and are lost if the
+    process dies before they are flushed, so only use it for data that can afford that.
+
+    When ``max_queue`` rows are waiting, ``overflow`` decides what happens to new ones:
+    ``"block"`` waits for room, ``"drop"`` discards them and ``"spill"`` appends them to
+    ``spill_path``, which is replayed once the queue has drained.
+
+    A batch failing with a retryable error is retried up to ``max_retries`` times in a row;
+    past that, or on any other error, its rows are dropped and logged. ``dropped_rows`` counts
+    the rows lost to overflow and failed batches. Unreadable spill files are set aside as
+    ``<spill_path>.corrupt-<ns>`` and logged.
+    """
+
+    def __init__(
+        self,
+        db: SQLAlchemy,
+        model: type,
+        max_batch: int = 500,
+        max_latency_ms: float = 50,
+        max_queue: int = 10_000,
+        overflow: OverflowPolicy = "block",
+        spill_path: Optional[str] = None,
+        max_retries: int = 10,
+    ):
+        if overflow not in ("block", "drop", "spill"):
+            raise ValueError(f"Unknown overflow policy {overflow!r}.")
+        if overflow == "spill" and not spill_path:
+            raise ValueError('overflow="spill" needs a spill_path.')
+        self.db = db
+        self.model = model
+        self.table = model.__table__
+        self.max_batch = max_batch
+        self.max_latency = max_latency_ms / 1000
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.max_retries = max_retries
+        self.stats: Counter = Counter()
+        self.max_flush_time = 0.0
+        self.max_row_latency = 0.0
+        self._rows: Deque[Row] = deque()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._closed = False
+        self._retries = 0
+        self._replay_offset = 0
+        self._thread: Optional[threading.Thread] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._room: Optional[asyncio.Event] = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._rows)
+
+    @property
+    def dropped_rows(self) -> int:
+        return self.stats["dropped"] + self.stats["failed"]
+
+    def snapshot(self) -> Dict[str, Any]:
+        oldest = self._rows[0][0] if self._rows else None
+        return {
+            "pending": self.pending,
+            "oldest_pending_age": time.monotonic() - oldest if oldest is not None else 0.0,
+            "max_row_latency": self.max_row_latency,
+            "max_flush_time": self.max_flush_time,
+            "dropped_rows": self.dropped_rows,
+            **self.stats,
+        }
+
+    def _accept(self, values: Dict[str, Any]) -> bool:
+        """Queue ``values`` under the lock, False if the queue is full."""
+        if self._closed:
+            raise RuntimeError(f"Write-behind buffer of {self.model.__name__} is closed.")
+        if len(self._rows) >= self.max_queue:
+            return False
+        self._rows.append((time.monotonic(), values))
+        self.stats["enqueued"] += 1
+        return True
+
+    def _overflow(self, values: Dict[str, Any]) -> None:
+        if self.overflow == "drop":
+            self.stats["dropped"] += 1
+        else:
+            with open(self.spill_path, "ab") as spill:
+                pickle.dump(values, spill)
+            self.stats["spilled"] += 1
+
+    def add(self, **values: Any) -> None:
+        """Queue a row, blocking the calling thread while the queue is full if overflow="block"."""
+        if self.db.async_:
+            raise TypeError("Use `await aadd(...)` with an async SQLAlchemy instance.")
+        self._start_thread()
+        with self._changed:
+            while not self._accept(values):
+                if self.overflow != "block":
+                    self._overflow(values)
+                    return
+                self.stats["blocked"] += 1
+                self._changed.notify_all()
+                self._changed.wait()
+            if len(self._rows) >= self.max_batch:
+                self._changed.notify_all()
+
+    async def aadd(self, **values: Any) -> None:
+        """Queue a row from a coroutine, waiting without blocking the loop if overflow="block"."""
+        if not self.db.async_:
+            raise TypeError("Use `add(...)` with a sync SQLAlchemy instance.")
+        self._start_task()
+        while True:
+            with self._lock:
+                if self._accept(values):
+                    break
+                if self.overflow != "block":
+                    self._overflow(values)
+                    return
+                self.stats["blocked"] += 1
+                self._room.clear()
+            self._wakeup.set()
+            await self._room.wait()
+        if len(self._rows) >= self.max_batch:
+            self._wakeup.set()
+
+    def _take(self) -> List[Row]:
+        batch = []
+        while self._rows and len(batch) < self.max_batch:
+            batch.append(self._rows.popleft())
+        return batch
+
+    def _due(self) -> Optional[float]:
+        """Seconds until the next batch is due, 0 if it is due now, None if nothing is queued."""
+        if not self._rows:
+            return None
+        if len(self._rows) >= self.max_batch or self._closed:
+            return 0
+        return max(0.0, self._rows[0][0] + self.max_latency - time.monotonic())
+
+    @staticmethod
+    def _group(batch: Iterable[Row]) -> Dict[Tuple[str, ...], List[Dict[str, Any]]]:
+        # A multi-row insert needs the same columns in every row.
+        groups: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+        for _, values in batch:
+            groups.setdefault(tuple(sorted(values)), []).append(values)
+        return groups
+
+    def _record(self, batch: List[Row], start: float) -> None:
+        now = time.monotonic()
+        self.max_flush_time = max(self.max_flush_time, now - start)
+        self.max_row_latency = max(self.max_row_latency, now - batch[0][0])
+        self.stats["written"] += len(batch)
+        self.stats["batches"] += 1
+        self._retries = 0
+
+    def _failed(self, batch: List[Row], exc: Exception) -> None:
+        # Retryable errors put the batch back, anything else would fail again: drop it.
+        self.stats["flush_errors"] += 1
+        if is_retryable(exc) and self._retries < self.max_retries:
+            self._retries += 1
+            with self._lock:
+                self._rows.extendleft(reversed(batch))
+            return
+        self._retries = 0
+        self.stats["failed"] += len(batch)
+        logger.error("Dropped %d %s rows after %r", len(batch), self.model.__name__, exc)
+
+    def _read_spill(self, limit: int) -> List[Row]:
+        """Read up to ``limit`` spilled rows, called under the lock.
+
+        The spill file is first moved to ``<spill_path>.replay``, so that rows spilled meanwhile
+        go to a fresh file, and is then read ``limit`` rows at a time until it is used up.
+        """
+        replay_path = f"{self.spill_path}.replay"
+        if not os.path.exists(replay_path):
+            if not os.path.exists(self.spill_path):
+                return []
+            os.replace(self.spill_path, replay_path)
+            self._replay_offset = 0
+        rows = []
+        error = None
+        with open(replay_path, "rb") as spill:
+            spill.seek(self._replay_offset)
+            while len(rows) < limit and spill.peek(1):
+                try:
+                    rows.append((time.monotonic(), pickle.load(spill)))
+                except Exception as exc:
+                    # Truncated or corrupt, e.g. by a crash while spilling: keep what was read
+                    # and set the file aside for inspection.
+                    error = exc
+                    break
+            self._replay_offset = spill.tell()
+            done = not spill.peek(1)
+        if error is not None:
+            quarantine = f"{self.spill_path}.corrupt-{time.time_ns()}"
+            os.replace(replay_path, quarantine)
+            self.stats["quarantined_spills"] += 1
+            logger.error(
+                "Unreadable %s spill file moved to %s after %d rows: %r",
+                self.model.__name__,
+                quarantine,
+                len(rows),
+                error,
+            )
+        elif done:
+            os.remove(replay_path)
+        self.stats["replayed"] += len(rows)
+        return rows
+
+    def _replay_spill(self) -> None:
+        # Under the lock, as _overflow appends to the spill file under it too.
+        with self._lock:
+            self._rows.extend(self._read_spill(self.max_queue - len(self._rows)))
+
+    # Sync engines: a daemon thread.
+
+    def _start_thread(self) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run_thread,
+                        name=f"fastapi-sqlalchemy-write-behind-{self.table.name}",
+                        daemon=True,
+                    )
+                    self._thread.start()
+
+    def _run_thread(self) -> None:
+        while True:
+            with self._changed:
+                while True:
+                    due = self._due()
+                    if due == 0 or (due is None and self._closed):
+                        break
+                    self._changed.wait(due)
+                if not self._rows and self._closed:
+                    return
+            if not self._flush_batch():
+                time.sleep(self.max_latency)
+
+    def _flush_batch(self) -> bool:
+        with self._write_lock:
+            with self._changed:
+                batch = self._take()
+                self._changed.notify_all()
+            if batch:
+                start = time.monotonic()
+                try:
+                    with self.db.engine.begin() as connection:
+                        for rows in self._group(batch).values():
+                            connection.execute(insert(self.table), rows)
+                except Exception as exc:
+                    self._failed(batch, exc)
+                    return False
+                self._record(batch, start)
+            if not self._rows and self.overflow == "spill":
+                self._replay_spill()
+            return True
+
+    def flush(self) -> None:
+        """Write every queued row now, from the calling thread."""
+        while self._rows and self._flush_batch():
+            pass
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Flush what is queued and stop the background thread, waiting at most ``timeout``.
+
+        Rows still queued after the timeout are left to the daemon thread and logged.
+        """
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                self._gave_up()
+                return
+        self.flush()
+
+    def _gave_up(self) -> None:
+        logger.error(
+            "Closed the %s write-behind buffer with %d rows still queued",
+            self.model.__name__,
+            self.pending,
+        )
+
+    # Async engines: a task on the running loop.
+
+    def _start_task(self) -> None:
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._room = asyncio.Event()
+            # A fresh context so that the task does not inherit the request's deadline.
+            self._task = contextvars.Context().run(
+                asyncio.get_running_loop().create_task, self._run_task()
+            )
+
+    async def _run_task(self) -> None:
+        while True:
+            due = self._due()
+            if due is None and self._closed:
+                return
+            if due != 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), due)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if not await self._aflush_batch():
+                await asyncio.sleep(self.max_latency)
+
+    async def _aflush_batch(self) -> bool:
+        with self._lock:
+            batch = self._take()
+        self._room.set()
+        if batch:
+            start = time.monotonic()
+            try:
+                async with self.db.async_engine.begin() as connection:
+                    for rows in self._group(batch).values():
+                        await connection.execute(insert(self.table), rows)
+            except Exception as exc:
+                self._failed(batch, exc)
+                return False
+            self._record(batch, start)
+        if not self._rows and self.overflow == "spill":
+            self._replay_spill()
+        return True
+
+    async def aflush(self) -> None:
+        while self._rows and await self._aflush_batch():
+            pass
+
+    async def aclose(self, timeout: Optional[float] = None) -> None:
+        """See close(), the flush task is cancelled after ``timeout``."""
+        self._closed = True
+        if self._task is not None:
+            self._wakeup.set()
+            await asyncio.wait({self._task}, timeout=timeout)
+            if not self._task.done():
+                self._task.cancel()
+                self._gave_up()
+                return
+        await self.aflush()
@@ -27,7 +27,7 @@ setup(
     package_data={"fastapi_sqlalchemy": ["py.typed"]},
     zip_safe=False,
     python_requires=">=3.7",
-    install_requires=["starlette>=0.12.9", "SQLAlchemy>=1.2", "fastapi>=0.52.0", "curio>=1.6"],
+    install_requires=["starlette>=0.12.9", "SQLAlchemy>=1.2", "fastapi>=0.52.0"],
     classifiers=[
         "Development Status :: 4 - Beta",
         "Environment :: Web Environment",
@@ -0,0 +1,753 @@
+import asyncio
+import json
+import os
+import pickle
+import threading
+import time
+
+import pytest
+from sqlalchemy import Column, ForeignKey, Integer, String, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, relationship
+
+from fastapi_sqlalchemy import (
+    ShardedSQLAlchemy,
+    SQLAlchemy,
+    TenantSQLAlchemy,
+    deadlines,
+    forking,
+    writebehind,
+)
+from fastapi_sqlalchemy.exceptions import ShardKeyMissing, StaleDataError, UnknownTenant
+from fastapi_sqlalchemy.extensions import MemoSession, _session, reset_session, start_session
+from fastapi_sqlalchemy.prefetch import AdaptivePrefetch
+from fastapi_sqlalchemy.testing import TestTransaction, create_schema
+from fastapi_sqlalchemy.tracing import InMemoryTracer
+
+
+@pytest.fixture
+def models(tmp_path):
+    db = SQLAlchemy(f"sqlite:///{tmp_path / 'models.db'}")
+
+    class User(db.Base):
+        __tablename__ = "users"
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+        bio = Column(String)
+        posts = relationship("Post", back_populates="user")
+
+    class Post(db.Base):
+        __tablename__ = "posts"
+        id = Column(Integer, primary_key=True)
+        user_id = Column(ForeignKey("users.id"))
+        user = relationship(User, back_populates="posts")
+
+    db.create_all()
+    yield db, User, Post
+    db.engine.dispose()
+
+
+def test_serialize(models):
+    db, User, Post = models
+    with db():
+        user = User.new(name="a", bio="long")
+        Post.new(user_id=user.id)
+        assert json.loads(user.serialize(fields=["name"])) == {"name": "a"}
+        assert json.loads(User.serialize_many(User.get_all(), depth=1)) == [
+            {"id": 1, "name": "a", "bio": "long", "posts": [{"id": 1, "user_id": 1}]}
+        ]
+
+
+def test_serialize_projection(models):
+    db, User, Post = models
+    statements = []
+    event.listen(db.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    with db():
+        for name in "abcde":
+            User.new(name=name, bio="long")
+    with db():
+        statements.clear()
+        data = json.loads(User.serialize_many(User.get_all(only=["name"])))
+        assert data[0] == {"id": 1, "name": "a"} and len(data) == 5
+        assert len(statements) == 1
+
+
+def test_async_models(tmp_path):
+    path = tmp_path / "async.db"
+    db = SQLAlchemy(f"sqlite:///{path}", async_url=f"sqlite+aiosqlite:///{path}", async_=True)
+
+    class User(db.Base):
+        __tablename__ = "users"
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+        bio = Column(String)
+        posts = relationship("Post", back_populates="user")
+
+    class Post(db.Base):
+        __tablename__ = "posts"
+        id = Column(Integer, primary_key=True)
+        user_id = Column(ForeignKey("users.id"))
+        user = relationship(User, back_populates="posts")
+
+    db.create_all()
+
+    async def run():
+        async with db():
+            user = await User.new(name="a", bio="long")
+            await Post.new(user_id=user.id)
+            await User.new(name="b")
+            assert [user.name for user in await User.get_all(User.name != "c")] == ["a", "b"]
+            assert (await User.get(name="b")).id == 2
+            assert await User.count() == 2 and await User.exists(name="a")
+            [row] = await User.aggregate(max="id", count=True)
+            assert (row.max_id, row.count) == (2, 2)
+            await user.update(bio="short")
+            assert await User.update_where(User.id == 2, bio="none") == 1
+            assert await User.import_stream([b"id,name\n3,c\n"]) == 1
+            last = await User.get(id=3)
+            await last.delete()
+            with pytest.raises(ValueError):
+                await User.delete_where()
+        async with db():
+            loaded = await User.get(id=1, only=["name"], load={"posts": "selectin"})
+            # Unloaded attributes are left out instead of failing with MissingGreenlet.
+            assert json.loads(loaded.serialize(depth=1)) == {
+                "id": 1,
+                "name": "a",
+                "posts": [{"id": 1, "user_id": 1}],
+            }
+            assert json.loads(User.serialize_many(await User.get_all(), depth=1))[1] == {
+                "id": 2,
+                "name": "b",
+                "bio": "none",
+            }
+            assert await User.delete_where(User.id == 2) == 1
+            assert await User.count() == 1
+        await db.adispose()
+
+    asyncio.run(run())
+    with pytest.raises(ValueError, match="async_"):
+        db.init(async_=False)
+
+
+def test_loader_options(models):
+    db, User, Post = models
+    with db():
+        user = User.new(name="a", bio="long")
+        Post.new(user_id=user.id)
+        db.session.expunge_all()
+        user = User.get(id=1, only=["name"], load={"posts": "selectin"})
+        assert "bio" not in user.__dict__
+        assert "posts" in user.__dict__
+        assert [u.name for u in User.get_all(defer=["bio"])] == ["a"]
+        with pytest.raises(ValueError):
+            User.get_all(load={"posts": "eager"})
+
+
+def test_nested_and_joined_loads(models):
+    db, User, Post = models
+    with db():
+        user = User.new(name="a")
+        Post.new(user_id=user.id)
+        Post.new(user_id=user.id)
+        db.session.expunge_all()
+        [user] = User.get_all(load={"posts": "selectin", "posts.user": "joined"})
+        assert len(user.posts) == 2 and "user" in user.posts[0].__dict__
+        db.session.expunge_all()
+        [user] = User.get_all(load={"posts.user": "selectin"})
+        assert "posts" not in user.__dict__ and "user" in user.posts[0].__dict__
+        db.session.expunge_all()
+        [user] = User.get_all(load={"posts": "joined"})
+        assert len(user.posts) == 2
+        assert len(User.get(id=user.id, load={"posts": "joined"}).posts) == 2
+
+
+def test_memoize(tmp_path):
+    db = SQLAlchemy(f"sqlite:///{tmp_path / 'memo.db'}", memoize=True)
+
+    class Item(db.Base):
+        __tablename__ = "items"
+        id = Column(Integer, primary_key=True)
+        status = Column(String)
+
+    db.create_all()
+    statements = []
+    event.listen(db.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    with db():
+        Item.new(status="active")
+        statements.clear()
+        first = Item.get_all(status="active")
+        assert Item.get_all(status="active") == first
+        assert len(statements) == 1
+        Item.new(status="active")
+        assert len(Item.get_all(status="active")) == 2
+        item = Item.get(id=1)
+        item.status = "inactive"
+        assert len(Item.get_all(status="active")) == 1
+    db.engine.dispose()
+
+
+def test_memoize_session_class(tmp_path):
+    class AuditSession(Session):
+        pass
+
+    with pytest.raises(ValueError, match="MemoSession"):
+        SQLAlchemy(
+            f"sqlite:///{tmp_path / 'memo.db'}", memoize=True, session_args={"class_": AuditSession}
+        )
+
+    class MemoAuditSession(MemoSession):
+        pass
+
+    db = SQLAlchemy(
+        f"sqlite:///{tmp_path / 'memo.db'}", memoize=True, session_args={"class_": MemoAuditSession}
+    )
+    with db():
+        assert isinstance(db.session, MemoAuditSession)
+    db.engine.dispose()
+
+
+def test_update_where_delete_where(models):
+    db, User, Post = models
+    with db():
+        user = User.new(name="a", bio="")
+        User.new(name="b", bio="")
+        assert User.update_where(User.name == "a", name="c") == 1
+        assert user.name == "c"
+        updated = User.update_where(User.name == "b", returning=True, bio="y")
+        assert [(u.name, u.bio) for u in updated] == [("b", "y")]
+        assert User.delete_where(User.name == "b") == 1
+        assert [u.name for u in User.get_all()] == ["c"]
+        with pytest.raises(ValueError, match="needs a criterion"):
+            User.update_where(name="x")
+        assert User.update_where(all=True, bio="z") == 1
+        assert User.delete_where(all=True) == 1
+
+
+def test_update_skips_commit_without_changes(models):
+    db, User, Post = models
+    with db():
+        user = User.new(name="a")
+        commits = []
+        event.listen(db.session, "after_commit", commits.append)
+        user.update(name="a")
+        assert commits == []
+        user.update(name="b")
+        assert len(commits) == 1
+
+
+def test_retrying_transaction(models):
+    db, User, Post = models
+    calls = []
+
+    @db.retrying_transaction(max_attempts=3, backoff=0)
+    def create(name):
+        calls.append(name)
+        db.session.add(User(name=name))
+        if len(calls) == 1:
+            raise OperationalError("INSERT", {}, Exception("database is locked"))
+        return name
+
+    with db():
+        assert create("a") == "a"
+        assert [u.name for u in User.get_all()] == ["a"]
+    assert len(calls) == 2
+    assert db.retry_stats["retries"] == 1
+    assert db.retry_stats["committed_after_retry"] == 1
+
+    with db(), pytest.raises(ValueError):
+        for attempt in db.retrying_transaction():
+            with attempt:
+                raise ValueError()
+    assert db.retry_stats["retries"] == 1
+
+
+def test_write_behind(models):
+    db, User, Post = models
+    buffer = db.write_behind(User, max_batch=10, max_latency_ms=1000)
+    for i in range(25):
+        buffer.add(name=str(i))
+    buffer.close()
+    assert buffer.snapshot()["written"] == 25
+    with db():
+        assert len(User.get_all()) == 25
+
+
+def test_write_behind_failures(models, tmp_path, monkeypatch, caplog):
+    db, User, Post = models
+
+    class Event(db.Base):
+        __tablename__ = "events"
+        id = Column(Integer, primary_key=True)
+        name = Column(String, nullable=False)
+
+    db.create_all()
+    buffer = db.write_behind(Event, max_latency_ms=1)
+    buffer.add(name=None)
+    buffer.close()
+    assert buffer.dropped_rows == 1 and "Dropped 1 Event rows" in caplog.text
+    # Retryable errors give up after max_retries, so close() returns.
+    monkeypatch.setattr(writebehind, "is_retryable", lambda exc: True)
+    buffer = db.write_behind(Event, max_latency_ms=1, max_retries=3)
+    buffer.add(name=None)
+    buffer.close(timeout=5)
+    assert (buffer.stats["flush_errors"], buffer.dropped_rows) == (4, 1)
+
+    spill_path = tmp_path / "users.spill"
+    with open(spill_path, "wb") as spill:
+        pickle.dump({"name": "kept"}, spill)
+        spill.write(pickle.dumps({"name": "truncated"})[:-3])
+    buffer = db.write_behind(User, overflow="spill", spill_path=str(spill_path))
+    assert [values for _, values in buffer._read_spill(10)] == [{"name": "kept"}]
+    assert buffer.stats["quarantined_spills"] == 1
+    assert [path.name.split("-")[0] for path in tmp_path.glob("users.spill*")] == [
+        "users.spill.corrupt"
+    ]
+    with pytest.raises(TypeError):
+        asyncio.run(buffer.aadd(name="sync instance"))
+
+
+def test_write_behind_spill_replay(models, tmp_path):
+    db, User, Post = models
+    spill_path = tmp_path / "users.spill"
+    buffer = db.write_behind(User, max_queue=2, overflow="spill", spill_path=str(spill_path))
+    with buffer._lock:
+        for i in range(5):
+            buffer._overflow({"name": str(i)})
+    buffer._replay_spill()
+    assert buffer.pending == 2
+    # Rows spilled while the file is being replayed go to a new one, read afterwards.
+    with buffer._lock:
+        buffer._rows.clear()
+        buffer._overflow({"name": "late"})
+    names = []
+    while True:
+        buffer._replay_spill()
+        if not buffer.pending:
+            break
+        names.extend(values["name"] for _, values in buffer._rows)
+        buffer._rows.clear()
+    assert names == ["2", "3", "4", "late"]
+    assert list(tmp_path.glob("users.spill*")) == []
+
+
+def test_shared_engines(tmp_path):
+    url = f"sqlite:///{tmp_path / 'shared.db'}"
+    first, second = SQLAlchemy(url), SQLAlchemy(url)
+    assert first.engine is second.engine
+    assert first.Base is not second.Base
+    assert SQLAlchemy(url, share_engines=False).engine is not first.engine
+    engine = first.engine
+    first.dispose()
+    assert second.engine is engine
+    second.dispose()
+    assert SQLAlchemy(url).engine is not engine
+
+    # Re-initialising disposes the old engine, unless another instance still uses it.
+    url = f"sqlite:///{tmp_path / 'reinit.db'}"
+    third, fourth = SQLAlchemy(url), SQLAlchemy(url)
+    engine = third.engine
+    assert fourth.engine is engine
+    with engine.connect():
+        pass
+    third.init(url=f"sqlite:///{tmp_path / 'other.db'}")
+    assert engine.pool.checkedin() == 1
+    fourth.init(url=f"sqlite:///{tmp_path / 'other.db'}")
+    assert engine.pool.checkedin() == 0
+
+
+def test_count_exists_aggregate(models):
+    db, User, Post = models
+    with db():
+        for name, bio in (("a", "x"), ("b", "x"), ("c", "y")):
+            User.new(name=name, bio=bio)
+        assert User.count() == 3
+        assert User.count(bio="x") == 2
+        assert User.exists(User.name == "c")
+        assert not User.exists(name="d")
+        rows = User.aggregate(group_by="bio", max="name", count=True)
+        assert sorted(tuple(row) for row in rows) == [("x", "b", 2), ("y", "c", 1)]
+        assert rows[0]._fields == ("bio", "max_name", "count")
+
+
+def test_blocking_detector(tmp_path):
+    db = SQLAlchemy(f"sqlite:///{tmp_path / 'blocking.db'}", detect_blocking=True)
+
+    class Item(db.Base):
+        __tablename__ = "items"
+        id = Column(Integer, primary_key=True)
+
+    db.create_all()
+
+    async def endpoint():
+        with db():
+            return Item.get_all()
+
+    with db():
+        Item.get_all()
+    assert not db.blocking_detector.offenders
+    asyncio.run(endpoint())
+    [offender] = db.blocking_detector.summary()
+    assert offender["site"].endswith("in endpoint")
+    assert offender["statement"].startswith("SELECT items.id")
+
+
+def test_engines_created_on_first_use(tmp_path):
+    path = tmp_path / "lazy.db"
+    db = SQLAlchemy(f"sqlite:///{path}")
+    assert db.initiated and db._engine is None
+    assert not path.exists()
+    db.create_engines()
+    assert db._engine is not None and db.engine is db._engine
+
+
+def test_tenant_engines(tmp_path):
+    db = TenantSQLAlchemy(lambda tenant: f"sqlite:///{tmp_path / tenant}.db", max_engines=2)
+
+    class Item(db.Base):
+        __tablename__ = "items"
+        id = Column(Integer, primary_key=True)
+
+    db.create_all()
+    for tenant, rows in (("a", 1), ("b", 2), ("c", 3), ("a", 1)):
+        with db.tenant(tenant), db():
+            for _ in range(rows):
+                Item.new()
+    with db.tenant("a"), db():
+        assert Item.count() == 2
+    assert db.tenants == ["c", "a"]
+    assert db.tenant_stats["evicted"] == 2
+    with pytest.raises(UnknownTenant), db():
+        Item.count()
+    with db.tenant("a"), db():
+        engine = db.engine
+        db.reconfigure(lambda tenant: f"sqlite:///{tmp_path / tenant}-moved.db")
+        assert db.tenants == [] and Item.count() == 2
+    assert engine.pool.checkedout() == 0
+    with db.tenant("a"), db():
+        assert db.engine is not engine and "a-moved" in str(db.engine.url)
+    # Tenants serving requests keep their engines until they are done.
+    with db.tenant("a"), db():
+        engine = db.engine
+        pool = engine.pool
+        db.dispose()
+        assert engine.pool is pool and Item.count() == 0
+    assert engine.pool is not pool
+
+
+def test_fork_guards(models, monkeypatch):
+    db, User, _ = models
+    with db.engine.connect() as connection:
+        inherited = connection.connection.dbapi_connection
+        connection.connection.info[forking.PID_KEY] = os.getpid() + 1
+    with db.engine.connect() as connection:
+        assert connection.connection.dbapi_connection is not inherited
+
+    disposed = []
+    dispose = Engine.dispose
+    monkeypatch.setattr(
+        Engine,
+        "dispose",
+        lambda engine, close=True: disposed.append(close) or dispose(engine, close),
+    )
+    token = start_session()
+    try:
+        db().__enter__()
+        session = db.session
+        raw = session.connection().connection.dbapi_connection
+        db._reset_after_fork()
+        assert disposed == [False]
+        assert db not in _session.get()["sync"]
+        # The parent's connection was left open.
+        assert raw.execute("SELECT 1").fetchone() == (1,)
+        session.close()
+    finally:
+        reset_session(token)
+
+
+def test_sqlite_profile(tmp_path):
+    db = SQLAlchemy(f"sqlite:///{tmp_path / 'profile.db'}", sqlite_profile={"busy_timeout": 2000})
+
+    class Entry(db.Base):
+        __tablename__ = "entries"
+        id = Column(Integer, primary_key=True)
+        writer = Column(String)
+
+    db.create_all()
+    with db.engine.connect() as connection:
+        pragmas = {
+            name: connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+            for name in ("journal_mode", "busy_timeout", "synchronous")
+        }
+    assert pragmas == {"journal_mode": "wal", "busy_timeout": 2000, "synchronous": 1}
+
+    lock = db.sqlite_writer_locks[db.engine]
+    barrier = threading.Barrier(2)
+    steps = []
+
+    def write(name):
+        barrier.wait()
+        with db.engine.begin() as connection:
+            connection.execute(Entry.__table__.insert(), {"writer": name})
+            steps.append(name)
+            time.sleep(0.1)
+            steps.append(name)
+
+    threads = [threading.Thread(target=write, args=(name,)) for name in "ab"]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert steps[0] == steps[1] and steps[2] == steps[3]
+    assert lock.stats["waited"] == 1
+    assert not lock.lock.locked()
+    db.engine.dispose()
+
+
+def test_test_transaction(tmp_path):
+    db = SQLAlchemy(f"sqlite:///{tmp_path / 'app.db'}")
+
+    class Item(db.Base):
+        __tablename__ = "items"
+        id = Column(Integer, primary_key=True)
+
+    path = create_schema(db, worker="gw1")
+    assert path.endswith("app.gw1.db") and len(list(tmp_path.glob("*.template.db"))) == 1
+    for _ in range(2):
+        with TestTransaction(db):
+            with db():
+                Item.new()
+                assert Item.count() == 1
+            with db():
+                assert Item.count() == 1
+    with db():
+        assert Item.count() == 0
+
+
+def test_tracing(tmp_path):
+    tracer = InMemoryTracer()
+    db = SQLAlchemy(f"sqlite:///{tmp_path / 'traced.db'}", tracing=tracer)
+
+    class Item(db.Base):
+        __tablename__ = "items"
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+
+    db.create_all()
+    tracer.spans.clear()
+    with db():
+        Item.new(name="secret")
+    session = tracer.named("db.session")[0]
+    [insert] = tracer.named("INSERT")
+    assert insert.attributes["db.statement"] == "INSERT INTO items (name) VALUES (?)"
+    assert insert.attributes["db.response.rows"] == 1
+    assert insert.parent.name == "db.transaction" and insert.parent.parent is session
+    assert tracer.named("db.commit")[0].parent is session
+    assert "db.pool.wait_ms" in insert.parent.attributes
+
+
+def test_versioned_update(tmp_path):
+    db = SQLAlchemy(f"sqlite:///{tmp_path / 'versioned.db'}")
+
+    class Counter(db.Base):
+        __tablename__ = "counters"
+        __versioned__ = True
+        id = Column(Integer, primary_key=True)
+        value = Column(Integer, default=0)
+
+    db.create_all()
+    with db():
+        Counter.new(id=1)
+
+    def bump(value):
+        with db.sync_session_maker() as other:
+            other.get(Counter, 1).value = value
+            other.commit()
+
+    with db():
+        stale = Counter.get(id=1)
+        bump(5)
+        with pytest.raises(StaleDataError):
+            stale.update(value=1)
+
+        @db.retrying_transaction()
+        def increment():
+            counter = Counter.get(id=1)
+            if not db.retry_stats["retries"]:
+                bump(10)
+            counter.value += 1
+            db.session.add(counter)
+
+        increment()
+        assert db.retry_stats["retries"] == 1
+        assert Counter.get(id=1).value == 11
+        assert Counter.get(id=1).version_id == 4
+        assert Counter.update_where(Counter.id == 1, value=0) == 1
+        assert Counter.get(id=1).version_id == 5
+    with db():
+        assert Counter.import_stream([b"id,value\n2,7\n"]) == 1
+        assert Counter.get(id=2).version_id == 1
+
+
+def test_import_stream(models, tmp_path):
+    db, User, _ = models
+    path = tmp_path / "users.csv"
+    path.write_text('id,name,bio\n1,a,"two\nlines, ""quoted"""\n2,b,\n')
+    ndjson = [b'{"id": 3, "na', b'me": "c"}\n{"id": "4"}\n']
+    with db():
+        assert User.import_stream(path, batch_size=1) == 2
+        assert User.import_stream(ndjson, format="ndjson") == 2
+        assert User.get(id=1).bio == 'two\nlines, "quoted"'
+        assert [user.name for user in User.get_all()] == ["a", "b", "c", None]
+        with pytest.raises(ValueError, match="Line 2, column 'id'"):
+            User.import_stream(["id\n", "x\n"])
+
+
+def test_unit_of_work(models):
+    db, User, _ = models
+    with db():
+        outer = db.session
+        with db.unit():
+            assert db.session is not outer
+            db.session.add(User(name="unit"))
+            db.session.flush()
+            assert db.engine.pool.checkedout() == 1
+        assert db.session is outer
+        assert db.engine.pool.checkedout() == 0
+        assert [user.name for user in User.get_all()] == ["unit"]
+        with pytest.raises(RuntimeError):
+            with db.unit():
+                User.new(name="committed")
+                db.session.add(User(name="rolled back"))
+                raise RuntimeError
+        assert [user.name for user in User.get_all()] == ["unit", "committed"]
+
+
+def test_reconfigure(models, tmp_path):
+    db, User, _ = models
+    old = db.engine
+    with db():
+        User.new(name="in flight")
+        db.reconfigure(engine_args={"pool_size": 2})
+        assert db.engine is not old and db.engine.pool.size() == 2
+        assert db.session.get_bind() is old
+        assert [user.name for user in User.get_all()] == ["in flight"]
+        pool = old.pool
+    # Disposed once the session that was in flight closed.
+    assert old.pool is not pool
+    with db():
+        assert db.session.get_bind() is db.engine
+    with pytest.raises(Exception):
+        db.reconfigure(url="nodriver://")
+    with pytest.raises(TypeError):
+        db.reconfigure(pool_size=2)
+    assert db.url == f"sqlite:///{tmp_path / 'models.db'}"
+
+
+def test_prefetch(models):
+    db, User, Post = models
+    db.adaptive_prefetch = AdaptivePrefetch(warmup=2)
+    statements = []
+    event.listen(db.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    with db():
+        for name in "abc":
+            Post.new(user=User.new(name=name))
+
+    def names(**options):
+        with db():
+            statements.clear()
+            names = [post.user.name for post in Post.get_all(**options)]
+        return names, len(statements)
+
+    assert names(prefetch=["user"]) == (["a", "b", "c"], 2)
+    assert [names()[1] for _ in range(3)] == [4, 4, 2]
+    [stats] = db.adaptive_prefetch.stats()
+    assert stats["prefetch"] == ["user"]
+    assert (stats["warmup_lazy_loads_per_call"], stats["lazy_loads_per_call"]) == (3, 0)
+
+
+def test_prefetch_keeps_caller_loads(models):
+    db, User, Post = models
+    db.adaptive_prefetch = AdaptivePrefetch(warmup=2)
+    with db():
+        for name in "ab":
+            Post.new(user=User.new(name=name))
+
+    def counts():
+        with db():
+            posts = Post.get_all(load={"user": "subquery"})
+            return [len(post.user.posts) for post in posts]
+
+    assert [counts() for _ in range(4)] == [[1, 1]] * 4
+    [stats] = db.adaptive_prefetch.stats()
+    assert stats["prefetch"] == ["user.posts"]
+    assert stats["lazy_loads_per_call"] == 2
+
+
+def test_sharding(tmp_path):
+    db = ShardedSQLAlchemy(
+        {"eu": f"sqlite:///{tmp_path / 'eu.db'}", "us": f"sqlite:///{tmp_path / 'us.db'}"},
+        shard_key="region",
+    )
+
+    class Order(db.Base):
+        __tablename__ = "orders"
+        id = Column(Integer, primary_key=True)
+        region = Column(String, nullable=False)
+        total = Column(Integer)
+
+    db.create_all()
+    with db():
+        for id, region, total in [(1, "eu", 10), (2, "eu", 20), (3, "us", 5)]:
+            Order.new(id=id, region=region, total=total)
+        with pytest.raises(ShardKeyMissing):
+            Order.new(id=4, total=1)
+    with db():
+        assert [order.id for order in Order.get_all(region="eu")] == [1, 2]
+        assert list(db.session.sessions) == ["eu"]
+        assert db.session.shard("us").get(Order, 3).total == 5
+        assert db.session.shard("us").get(Order, 1) is None
+        assert sorted(order.id for order in Order.get_all(Order.total > 1)) == [1, 2, 3]
+        assert Order.count() == 3 and Order.count(Order.region == "us") == 1
+        [row] = Order.aggregate(sum="total", max="total", count=True)
+        assert (row.sum_total, row.max_total, row.count) == (35, 20, 3)
+        by_region = Order.aggregate(group_by="region", sum="total")
+        assert sorted(tuple(row) for row in by_region) == [("eu", 30), ("us", 5)]
+        token = deadlines.set_deadline(30)
+        try:
+            left = db.scatter(["eu", "us"], lambda session: deadlines.remaining())
+        finally:
+            deadlines.reset_deadline(token)
+        assert all(seconds is not None and 0 < seconds <= 30 for seconds in left)
+        assert Order.update_where(Order.total > 5, total=0) == 2
+        assert Order.delete_where(Order.region == "us") == 1
+        with pytest.raises(ValueError, match="shard key"):
+            Order.update_where(Order.id == 1, region="us")
+    with db():
+        assert [(order.id, order.total) for order in Order.get_all()] == [(1, 0), (2, 0)]
+    with db():
+        assert Order.import_stream([b"id,region,total\n5,us,7\n6,eu,8\n"]) == 2
+        with pytest.raises(ShardKeyMissing):
+            Order.import_stream([b"id,total\n7,1\n"])
+    with db():
+        assert db.session.shard("us").get(Order, 5).total == 7
+        assert db.session.shard("eu").get(Order, 6).total == 8
+    eu, us = db.engines["eu"], db.engines["us"]
+    with db():
+        assert Order.get(Order.id == 1, region="eu").total == 0
+        db.reconfigure({"eu": f"sqlite:///{tmp_path}/./eu.db"})
+        assert db.engines["eu"] is not eu and db.engines["us"] is us
+        assert db.session.shard("eu").get_bind() is eu
+        eu_pool = eu.pool
+    assert eu.pool is not eu_pool and db.engines["us"] is us
+    with db():
+        assert db.session.shard("eu").get_bind() is db.engines["eu"]
+        assert Order.count() == 4
+    with pytest.raises(ValueError, match="Unknown shard"):
+        db.reconfigure({"asia": f"sqlite:///{tmp_path / 'asia.db'}"})
+    engines = db._engines()
+    pools = [engine.pool for engine in engines]
+    db.dispose()
+    assert all(engine.pool is not pool for engine, pool in zip(engines, pools))
+    assert db._executor is None and not db.engines
@@ -1,10 +1,204 @@
-from unittest.mock import Mock, patch
+import asyncio
+import threading
 
+import httpx
 import pytest
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
-from starlette.middleware.base import BaseHTTPMiddleware
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import text
 
-from fastapi_sqlalchemy.exceptions import MissingSessionError, SessionNotInitialisedError
+from fastapi_sqlalchemy import (
+    DBSessionMiddleware,
+    ShardedSQLAlchemy,
+    SQLAlchemy,
+    TenantSQLAlchemy,
+    deadlines,
+)
+from fastapi_sqlalchemy.admission import AdmissionController
 
-# TODO Add tests.
+ENDLESS_QUERY = text(
+    "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT count(*) FROM c"
+)
+
+
+def test_admission_sheds_load(tmp_path):
+    db = SQLAlchemy(f"sqlite:///{tmp_path / 'admission.db'}")
+    app = FastAPI()
+    started, finish = asyncio.Event(), asyncio.Event()
+
+    @app.get("/slow")
+    async def slow():
+        started.set()
+        await finish.wait()
+        return {}
+
+    app.add_middleware(
+        DBSessionMiddleware,
+        db=db,
+        admission_control=True,
+        admission_limit=1,
+        max_queue_depth=0,
+        retry_after=3,
+    )
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            first = asyncio.ensure_future(client.get("/slow"))
+            await started.wait()
+            shed = await client.get("/slow")
+            finish.set()
+            return (await first), shed
+
+    first, shed = asyncio.run(run())
+    assert first.status_code == 200
+    assert shed.status_code == 503 and shed.headers["Retry-After"] == "3"
+    assert db.admission.snapshot()["rejected_queue_full"] == 1
+
+
+def test_admission_limits(tmp_path):
+    tenants = TenantSQLAlchemy(
+        lambda tenant: f"sqlite:///{tmp_path / tenant}.db", max_connections=4
+    )
+    shards = ShardedSQLAlchemy(
+        {
+            "eu": f"sqlite:///{tmp_path / 'eu.db'}",
+            "us": f"sqlite:///{tmp_path / 'us.db'}",
+        },
+        shard_key="region",
+        engine_args={"pool_size": 3, "max_overflow": 1},
+    )
+    for db in (tenants, shards):
+        app = FastAPI()
+
+        @app.get("/")
+        def index():
+            return {}
+
+        app.add_middleware(DBSessionMiddleware, db=db, admission_control=True)
+        with TestClient(app) as client:
+            assert client.get("/", headers={"X-Tenant-ID": "acme"}).status_code == 200
+        assert db.admission.limit == 4
+
+
+def test_tenants_load_off_the_loop(tmp_path, monkeypatch):
+    db = TenantSQLAlchemy(lambda tenant: f"sqlite:///{tmp_path / tenant}.db")
+    loaded_on = []
+    load = db._load
+
+    def traced_load(tenant):
+        loaded_on.append(threading.current_thread())
+        return load(tenant)
+
+    monkeypatch.setattr(db, "_load", traced_load)
+    app = FastAPI()
+
+    @app.get("/")
+    async def index():
+        return {"tenant": db.current_tenant}
+
+    app.add_middleware(DBSessionMiddleware, db=db)
+    with TestClient(app) as client:
+        for _ in range(2):
+            assert client.get("/", headers={"X-Tenant-ID": "acme"}).json() == {"tenant": "acme"}
+        assert client.get("/").status_code == 404
+    assert len(loaded_on) == 1 and loaded_on[0] is not threading.main_thread()
+
+
+def test_admission_queue_and_cancellation(tmp_path):
+    controller = AdmissionController(SQLAlchemy(f"sqlite:///{tmp_path / 'a.db'}"), limit=1)
+
+    async def queued():
+        task = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        assert controller.queue_depth == 1
+        return task
+
+    async def run():
+        assert await controller.acquire()
+        waiting = await queued()
+        controller.release()
+        assert await waiting and controller.in_flight == 1
+        # Cancelled while queued.
+        waiting = await queued()
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert controller.queue_depth == 0
+        # Cancelled right after release() handed it the slot.
+        waiting = await queued()
+        controller.release()
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert controller.in_flight == 0
+        assert await controller.acquire()
+
+    asyncio.run(run())
+    assert controller.stats["cancelled"] == 2
+
+
+def deadline_app(tmp_path, **options):
+    db = SQLAlchemy(f"sqlite:///{tmp_path / 'deadlines.db'}", statement_timeouts=True)
+    app = FastAPI()
+
+    @app.get("/sleep")
+    async def sleep():
+        await asyncio.sleep(10)
+
+    @app.get("/query", dependencies=[Depends(deadlines.deadline(0.2))])
+    def query():
+        db.session.execute(ENDLESS_QUERY)
+
+    app.add_middleware(DBSessionMiddleware, db=db, **options)
+    return app
+
+
+def test_deadlines(tmp_path):
+    async def run():
+        transport = httpx.ASGITransport(app=deadline_app(tmp_path, request_timeout=0.2))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get("/sleep")
+
+    assert asyncio.run(run()).status_code == 504
+    # The route dependency bounds the statement, the slow query is interrupted.
+    with TestClient(deadline_app(tmp_path)) as client:
+        assert client.get("/query").status_code == 504
+    assert deadlines.remaining() is None
+
+
+def test_client_disconnect(tmp_path):
+    app = deadline_app(tmp_path, request_timeout=5)
+    sent = []
+
+    async def run():
+        started = asyncio.Event()
+
+        async def receive():
+            if not started.is_set():
+                started.set()
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await asyncio.sleep(0.1)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": "/sleep",
+            "raw_path": b"/sleep",
+            "root_path": "",
+            "query_string": b"",
+            "headers": [(b"host", b"test")],
+            "client": ("test", 1),
+            "server": ("test", 80),
+        }
+        await asyncio.wait_for(app(scope, receive, send), 5)
+
+    asyncio.run(run())
+    assert sent[0]["type"] == "http.response.start" and sent[0]["status"] == 499